@@ -0,0 +1,75 @@
+"""
+Compare near-duplicate lookups in a `SimhashIndex` with a full scan
+
+Fills the index with random fingerprints, a share of them close variants of
+earlier ones, then looks up variants of stored fingerprints. Checks that the
+index finds exactly what comparing against every fingerprint finds &
+reports the time per lookup. Run from the repository root:
+
+    python -m bench.dedup --documents 100000
+"""
+import random
+import time
+
+import click
+
+from crawl.dedup import SIMHASH_BITS, SimhashIndex
+from crawl.process import SIMHASH_THRESHOLD, is_near_duplicate_simhash
+
+
+def variant(simhash: int, rng: random.Random, max_flips: int) -> int:
+    for _ in range(rng.randrange(max_flips + 1)):
+        simhash ^= 1 << rng.randrange(SIMHASH_BITS)
+    return simhash
+
+
+@click.command()
+@click.option('--documents', default=100_000, type=click.IntRange(min=1))
+@click.option('--lookups', default=1000, type=click.IntRange(min=1))
+@click.option('--block_count', default=(16, ), multiple=True, type=click.IntRange(min=1), help='fixed block counts to compare with the chosen one')
+@click.option('--seed', default=0)
+def main(documents, lookups, block_count, seed):
+    rng = random.Random(seed)
+    fingerprints = []
+    for _ in range(documents):
+        if fingerprints and rng.random() < 0.1:
+            original = rng.choice(fingerprints)
+            fingerprints.append(variant(original, rng, 2 * SIMHASH_THRESHOLD))
+        else:
+            fingerprints.append(rng.getrandbits(SIMHASH_BITS))
+    queries = [
+        variant(rng.choice(fingerprints), rng, SIMHASH_THRESHOLD + 5)
+        for _ in range(lookups)
+    ]
+
+    start = time.perf_counter()
+    expected = [
+        [
+            doc_id
+            for doc_id, simhash in enumerate(fingerprints, start=1)
+            if is_near_duplicate_simhash(query, simhash)
+        ]
+        for query in queries
+    ]
+    elapsed = time.perf_counter() - start
+    print(f"{'scan':>14}: {elapsed / lookups * 1e6:10.1f} us per lookup")
+
+    for blocks in (None, *block_count):
+        index = SimhashIndex(block_count=blocks)
+        start = time.perf_counter()
+        for doc_id, simhash in enumerate(fingerprints, start=1):
+            index.add(doc_id, simhash)
+        built = time.perf_counter() - start
+        start = time.perf_counter()
+        found = [index.near_duplicates(query) for query in queries]
+        elapsed = time.perf_counter() - start
+        differing = sum(a != b for a, b in zip(expected, found))
+        print(
+            f"{len(index.tables):>4} tables: {elapsed / lookups * 1e6:10.1f} us",
+            f"per lookup{' (chosen)' if blocks is None else ''},",
+            f"built in {built:.1f}s, {differing} lookups differ"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Compare the crawl engines against a local HTTP stand-in
+
+Serves generated pages with artificial latency on localhost, seeds a fresh
+crawler database with them and measures how long each engine takes to make
+the given number of requests. Run from the repository root:
+
+    python -m bench.fetch --requests 2000 --latency 0.05
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import multiprocessing as mp
+import os
+import socket
+import tempfile
+import time
+
+import apsw
+from apsw import bestpractice
+import click
+
+from crawl.loop import AsyncCrawler, Crawler, DEFAULT_CONCURRENCY, DEFAULT_WORKER_COUNT
+from crawl.robots import Host
+
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+    latency = 0.0
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.path == "/robots.txt":
+            body = b"User-agent: *\nAllow: /\n"
+            content_type = "text/plain"
+        else:
+            paragraphs = "".join(
+                f"<p>paragraph {i} of {self.path}</p>" for i in range(40)
+            )
+            body = (
+                f"<html><head><title>{self.path}</title></head>"
+                f"<body>{paragraphs}</body></html>"
+            ).encode()
+            content_type = "text/html; charset=utf-8"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, latency):
+    # separate process, so the stand-in doesn't compete for the GIL
+    server = StandIn(("127.0.0.1", port), Handler)
+    server.latency = latency
+    server.serve_forever()
+
+
+def free_port() -> int:
+    with ThreadingHTTPServer(("127.0.0.1", 0), Handler) as server:
+        return server.server_address[1]
+
+
+def run_engine(engine, origin, requests, workers, concurrency) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        crawl_db = os.path.join(tmp, "crawler.db")
+        con = apsw.Connection(crawl_db)
+        with open("crawler.sql") as sql:
+            con.execute(sql.read())
+        con.close()
+
+        hosts_db = os.path.join(tmp, "hosts.db")
+        # no rate limit for the stand-in
+        host = Host(origin)
+        host.global_policy = True
+        host.robots_txt = None
+        host.refill_rate = 1e9
+        host.refill_cap = 1e9
+        host.updated = time.time()
+        host.fetched = host.updated
+        host.tokens = host.refill_cap
+        host.store(Host.open_db(hosts_db))
+
+        crawler_class = AsyncCrawler if engine == "async" else Crawler
+        crawler = crawler_class(
+            crawl_db,
+            hosts_db,
+            seen_capacity=requests * 2,
+            seen_file=False,
+            simhash_file=False
+        )
+        crawler.queue.push_many_if_new(
+            f"{origin}/page/{i}" for i in range(requests)
+        )
+        start = time.perf_counter()
+        if engine == "async":
+            crawler.start(workers, concurrency)
+        else:
+            crawler.start(workers)
+        crawler.run(limit=requests)
+        elapsed = time.perf_counter() - start
+        print()
+        return elapsed
+
+
+@click.command()
+@click.option('--requests', default=1000, type=click.IntRange(min=1))
+@click.option('--latency', default=0.05, help='seconds per response')
+@click.option('--workers', default=DEFAULT_WORKER_COUNT)
+@click.option('--concurrency', default=DEFAULT_CONCURRENCY)
+def main(requests, latency, workers, concurrency):
+    # same connection setup as the CLI
+    bestpractice.apply(bestpractice.recommended[:-1])
+    port = free_port()
+    server = mp.Process(target=serve, args=[port, latency], daemon=True)
+    server.start()
+    origin = f"http://127.0.0.1:{port}"
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+    results = {}
+    for engine in ("process", "async"):
+        results[engine] = run_engine(
+            engine,
+            origin,
+            requests,
+            workers,
+            concurrency
+        )
+    server.terminate()
+
+    for engine, elapsed in results.items():
+        print(
+            f"{engine:>8}: {requests} requests in {elapsed:.2f}s,",
+            f"{requests / elapsed:.1f} req/s"
+        )
+
+
+if __name__ == '__main__':
+    main()
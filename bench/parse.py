@@ -0,0 +1,97 @@
+"""
+Compare the HTML extraction backends of `Document.parse` on stored pages
+
+Parses a random sample of the response bodies in a crawler database with
+every parser, checks that they extract the same lang, title, meta
+description, text & links, and reports their throughput. Run from the
+repository root:
+
+    python -m bench.parse --db crawler.db --pages 500
+"""
+import time
+
+import apsw
+import click
+
+from crawl import DEFAULT_CRAWLER_DB
+from crawl.compress import decompress
+from crawl.document import Document
+from crawl.extract import DEFAULT_PARSER, PARSERS
+
+
+def load_pages(con: apsw.Connection, count: int) -> list[tuple[str, bytes]]:
+    return [
+        (url, decompress(data, encoding, con))
+        for url, data, encoding in con.execute(
+            "SELECT \
+                (SELECT url.url FROM request \
+                JOIN url ON url_id = url.id \
+                WHERE body_id = body.id \
+                LIMIT 1), \
+                data, \
+                encoding \
+            FROM body \
+            ORDER BY random() \
+            LIMIT ?1",
+            (count, )
+        )
+    ]
+
+
+def parse(url: str, data: bytes, parser: str) -> tuple:
+    doc = Document(None, url, None, data)
+    doc.parser = parser
+    if not doc.parse():
+        return None
+    return (
+        doc.lang,
+        doc.title,
+        doc.meta_description,
+        doc.text_content,
+        doc.link_urls
+    )
+
+
+@click.command()
+@click.option('--db', default=DEFAULT_CRAWLER_DB, type=click.Path(exists=True))
+@click.option('--pages', default=500, type=click.IntRange(min=1))
+@click.option('--show', default=3, help='number of differing pages to print')
+def main(db, pages, show):
+    con = apsw.Connection(db)
+    sample = load_pages(con, pages)
+    if not sample:
+        print(f"no stored pages in {db}")
+        return
+    size = sum(len(data) for _, data in sample)
+    print(f"{len(sample)} pages, {size / 2**20:.1f} MiB")
+
+    results = {}
+    for parser in PARSERS:
+        start = time.perf_counter()
+        results[parser] = [parse(url, data, parser) for url, data in sample]
+        elapsed = time.perf_counter() - start
+        print(
+            f"{parser:>8}: {len(sample) / elapsed:8.1f} pages/s,",
+            f"{size / 2**20 / elapsed:6.2f} MiB/s"
+        )
+
+    expected = results[DEFAULT_PARSER]
+    fields = ("lang", "title", "meta description", "text", "links")
+    for parser in PARSERS:
+        if parser == DEFAULT_PARSER:
+            continue
+        differing = [
+            i for i, result in enumerate(results[parser])
+            if result != expected[i]
+        ]
+        print(f"{parser}: {len(differing)} of {len(sample)} pages differ")
+        for i in differing[:show]:
+            a = expected[i] or (None, ) * len(fields)
+            b = results[parser][i] or (None, ) * len(fields)
+            print(f"  {sample[i][0]}:", ", ".join(
+                field for field, x, y in zip(fields, a, b) if x != y
+            ))
+
+
+if __name__ == '__main__':
+    main()
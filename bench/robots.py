@@ -0,0 +1,119 @@
+"""
+Compare the compiled robots.txt rules with `urllib.robotparser`
+
+Checks a set of URL paths derived from every robots.txt in the corpus
+directory against both matchers, reports how often they agree & how long
+each one takes. The stdlib parser uses the first matching rule & knows no
+wildcards, so they disagree wherever the longest match or `*` / `$` decide.
+The bundled samples are only shaped like real files, fetch the robots.txt of
+the hosts in a URL list into the corpus first for real ones:
+
+    python -m bench.robots --download seed.urls
+"""
+import os
+import random
+import time
+from urllib import error, request
+from urllib.robotparser import RobotFileParser
+
+import click
+
+from crawl.robots import USER_AGENT, RobotRules, get_host
+
+ORIGIN = "https://robots.example"
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), "data", "robots")
+
+
+def fetch_corpus(urls, corpus):
+    for url in urls:
+        origin = get_host(url.strip())
+        name = origin.split("://", 1)[1].replace(":", "_") + ".txt"
+        try:
+            with request.urlopen(origin + "/robots.txt", timeout=10) as f:
+                raw = f.read()
+        except (error.URLError, TimeoutError) as e:
+            print(f"failed to fetch robots.txt for {origin}: {e}")
+            continue
+        with open(os.path.join(corpus, name), "wb") as file:
+            file.write(raw)
+
+
+def sample_paths(rules: RobotRules, count: int, rng: random.Random):
+    """
+    Paths close to the rules of a file, plus some that no rule mentions
+    """
+    stems = [
+        pattern.replace("*", "x").rstrip("$")
+        for pattern, _ in rules.rules
+    ] or ["/"]
+    suffixes = ["", "x", "/", "/index.html", "?page=2", ".pdf", "/a/b?c=d"]
+    paths = []
+    while len(paths) < count:
+        if rng.random() < 0.2:
+            paths.append(f"/article/{rng.randrange(10**6)}")
+        else:
+            paths.append(rng.choice(stems) + rng.choice(suffixes))
+    return paths
+
+
+@click.command()
+@click.option(
+    '--corpus',
+    default=DEFAULT_CORPUS,
+    help='directory of robots.txt files',
+    type=click.Path(file_okay=False)
+)
+@click.option(
+    '--download',
+    help='fetch the robots.txt of the hosts in this URL list into the corpus',
+    type=click.File()
+)
+@click.option('--paths', default=20000, help='URL paths per robots.txt')
+@click.option('--seed', default=0)
+def main(corpus, download, paths, seed):
+    if download:
+        os.makedirs(corpus, exist_ok=True)
+        fetch_corpus(download, corpus)
+    rng = random.Random(seed)
+    total = {"stdlib": 0.0, "compiled": 0.0}
+    checked = 0
+    agreed = 0
+    for name in sorted(os.listdir(corpus)):
+        with open(os.path.join(corpus, name), encoding="utf-8") as file:
+            robots_txt = file.read()
+        rfp = RobotFileParser()
+        rfp.parse(robots_txt.splitlines())
+        rules = RobotRules.load(RobotRules.parse(robots_txt).dump())
+        urls = [ORIGIN + path for path in sample_paths(rules, paths, rng)]
+
+        start = time.perf_counter()
+        expected = [rfp.can_fetch(USER_AGENT, url) for url in urls]
+        stdlib = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = [rules.allows(url[len(ORIGIN):] or "/") for url in urls]
+        compiled = time.perf_counter() - start
+
+        same = sum(a == b for a, b in zip(expected, actual))
+        print(
+            f"{name:>24}: {len(rules.rules): 3} rules,",
+            f"{stdlib / len(urls) * 1e6:6.2f} / {compiled / len(urls) * 1e6:6.2f}",
+            f"us per URL (stdlib / compiled), {same / len(urls):6.1%} agree"
+        )
+        total["stdlib"] += stdlib
+        total["compiled"] += compiled
+        checked += len(urls)
+        agreed += same
+
+    if not checked:
+        print(f"no robots.txt files in {corpus}")
+        return
+    print(
+        f"{'total':>24}: {checked} URLs,",
+        f"{total['stdlib'] / total['compiled']:.1f}x faster,",
+        f"{agreed / checked:.1%} agree"
+    )
+
+
+if __name__ == '__main__':
+    main()
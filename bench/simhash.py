@@ -0,0 +1,83 @@
+"""
+Compare the simhash implementations on stored pages
+
+Computes the fingerprint of a random sample of the pages in a crawler
+database with the original bit loop & with `compute_simhash` for every
+hash, checks that the MD5 fingerprints are identical to the bit loop's &
+reports the time per page. Run from the repository root:
+
+    python -m bench.simhash --db crawler.db --pages 200
+"""
+import time
+
+import apsw
+import click
+
+from bench.parse import load_pages
+from crawl import DEFAULT_CRAWLER_DB
+from crawl.document import Document
+from crawl.process import SIMHASH_HASHES, compute_simhash, hash_shingle, shingle
+
+
+def loop_simhash(texts, k=5):
+    """
+    `compute_simhash` before it was vectorized
+    """
+    shingles = set()
+    for text in texts:
+        shingles.update(shingle(text, k))
+    v = [0] * 128
+    for sh in shingles:
+        h = hash_shingle(sh)
+        for i in range(128):
+            bitmask = 1 << i
+            if h & bitmask:
+                v[i] += 1
+            else:
+                v[i] -= 1
+    fingerprint = 0
+    for i in range(128):
+        if v[i] >= 0:
+            fingerprint |= 1 << i
+    return fingerprint
+
+
+def page_texts(url: str, data: bytes) -> list[str] | None:
+    doc = Document(None, url, None, data)
+    if not doc.parse():
+        return None
+    texts = (doc.title, doc.meta_description, doc.text_content)
+    return [t for t in texts if t]
+
+
+@click.command()
+@click.option('--db', default=DEFAULT_CRAWLER_DB, type=click.Path(exists=True))
+@click.option('--pages', default=200, type=click.IntRange(min=1))
+def main(db, pages):
+    con = apsw.Connection(db)
+    sample = [
+        texts
+        for url, data in load_pages(con, pages)
+        if (texts := page_texts(url, data)) is not None
+    ]
+    if not sample:
+        print(f"no stored pages in {db}")
+        return
+
+    implementations = {"loop": loop_simhash} | {
+        hash: lambda texts, hash=hash: compute_simhash(texts, hash=hash)
+        for hash in SIMHASH_HASHES
+    }
+    results = {}
+    for name, simhash in implementations.items():
+        start = time.perf_counter()
+        results[name] = [simhash(texts) for texts in sample]
+        elapsed = time.perf_counter() - start
+        print(f"{name:>6}: {elapsed / len(sample) * 1000:8.3f} ms per page")
+
+    differing = sum(a != b for a, b in zip(results["loop"], results["md5"]))
+    print(f"md5: {differing} of {len(sample)} fingerprints differ from loop")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Measure how long the CLI takes to start, per command
+
+Runs `python -m crawl.cli <command> --help` in fresh interpreters, which
+imports everything the command needs without doing any work, and reports
+the fastest wall time & how much of the import time NLTK & other heavy
+packages account for. Spawned crawler workers import `crawl.loop`, which is
+measured as well. Run from the repository root:
+
+    python -m bench.startup --runs 5
+"""
+import re
+import subprocess
+import sys
+import time
+
+import click
+
+from crawl.cli import c
+
+# top-level packages whose cumulative import time is reported
+HEAVY = ("nltk", "bs4", "requests", "numpy")
+IMPORT_TIME = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)$")
+
+
+def measure(args: list[str]) -> tuple[float, dict[str, float]]:
+    """
+    Wall time of a fresh interpreter in seconds & cumulative import time of
+    the heavy packages in milliseconds, `-X importtime` reports microseconds
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        text=True
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise Exception(f"{' '.join(args)} failed: {result.stderr[-500:]}")
+    imports = {}
+    for line in result.stderr.splitlines():
+        if (m := IMPORT_TIME.match(line)) and m.group(2) in HEAVY:
+            imports[m.group(2)] = int(m.group(1)) / 1000
+    return elapsed, imports
+
+
+@click.command()
+@click.option('--runs', default=3, type=click.IntRange(min=1))
+def main(runs):
+    targets = {
+        name: ["-m", "crawl.cli", name, "--help"]
+        for name in sorted(c.commands)
+    }
+    targets["(worker)"] = ["-c", "import crawl.loop"]
+    for name, args in targets.items():
+        results = [measure(args) for _ in range(runs)]
+        elapsed, imports = min(results, key=lambda result: result[0])
+        heavy = ", ".join(
+            f"{package} {ms:.0f} ms" for package, ms in imports.items()
+        )
+        print(f"{name:>18}: {elapsed * 1000:6.0f} ms  {heavy}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,14 +4,17 @@ import click
 import apsw
 from apsw import bestpractice
 
-import nltk
 import requests
+from tqdm import tqdm
 
 from crawl import DEFAULT_CRAWLER_DB, DEFAULT_HOSTS_DB, DEFAULT_INDEX_DB
-from crawl.loop import Crawler
+from crawl.compress import CODECS, DEFAULT_CODEC, decompress, recompress_db, store_dictionary, train_dictionary
+from crawl.extract import DEFAULT_PARSER, PARSERS
+from crawl.loop import AsyncCrawler, Crawler, DEFAULT_CONCURRENCY, DEFAULT_WORKER_COUNT
 from crawl.queue import Queue
-from crawl.request import Request, Status
+from crawl.request import MAX_CONTENT_SIZE, Request, Status
 from crawl.robots import can_crawl
+from crawl.seen import DEFAULT_SEEN_CAPACITY, DEFAULT_SEEN_ERROR_RATE
 from crawl.process import process_batch_file
 import crawl.index
 
@@ -88,6 +91,7 @@ def download_corpora(path):
     Run `nltk.download()` for all the required corpora.
     The `path` argument needs to be one of the directories that NLTK checks when looking for the downloaded corpora.
     """
+    import nltk
     NLTK_CORPORA = [
         'punkt',
         'stopwords',
@@ -144,8 +148,7 @@ def load_urls(db, urls):
     Load URLs from file and insert into the frontier
     '''
     queue = Queue(db)
-    for url in urls:
-        queue.push(url.strip())
+    queue.push_many_if_new(url.strip() for url in urls if url.strip())
 
 
 @c.command()
@@ -172,14 +175,13 @@ def crawl_next(db):
             exit(0)
         case limited if type(limited) == float and limited > time.time():
             print(f"{url} throttled for another {limited - time.time()}s")
-            queue.push(url)
+            queue.defer(url, limited)
             exit(0)
 
     res = can_crawl(url)
     if type(res) == float:
         print(f"host rate-limited for {res}s")
-        Request.rate_limited(url, res).save(db)
-        queue.push(url)
+        queue.defer(url, time.time() + res)
         exit(0)
     elif res != True:
         Request.prohibited(url).save(db)
@@ -199,11 +201,9 @@ def crawl_next(db):
             exit(0)
         doc.save(db)
         if doc.is_relevant():
-            link_count = 0
-            for link in doc.links():
-                queue.push_if_new(link)
-                link_count += 1
-            print(f"extracted {link_count} links")
+            links = list(doc.links())
+            new = queue.push_many_if_new(links)
+            print(f"extracted {len(links)} links, {len(new)} new")
         else:
             print("document is irrelevant, ignoring links")
 
@@ -215,13 +215,187 @@ def crawl_next(db):
     help='location of the SQLite database file',
     type=click.Path()
 )
-def crawl_loop(db):
+@click.option(
+    '--seen_capacity',
+    default=DEFAULT_SEEN_CAPACITY,
+    help='number of URLs the seen URL filter is sized for, determines its memory use',
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--seen_error_rate',
+    default=DEFAULT_SEEN_ERROR_RATE,
+    help='false positive rate of the seen URL filter at full capacity',
+    type=click.FloatRange(min=0, max=1, min_open=True, max_open=True)
+)
+@click.option(
+    '--seen_file/--no_seen_file',
+    default=True,
+    help='persist the seen URL filter next to the database file'
+)
+@click.option(
+    '--simhash_file/--no_simhash_file',
+    default=True,
+    help='persist the near-duplicate index of document fingerprints next to the database file'
+)
+@click.option(
+    '--engine',
+    default='process',
+    help='make requests in worker processes, or dispatch them from an asyncio event loop (blocking requests in a thread per concurrent request)',
+    type=click.Choice(['process', 'async'])
+)
+@click.option(
+    '--workers',
+    default=DEFAULT_WORKER_COUNT,
+    help='number of worker processes, only used for parsing by the async engine',
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--concurrency',
+    default=DEFAULT_CONCURRENCY,
+    help='maximum number of requests in flight at the same time in the async engine',
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--max_size',
+    default=MAX_CONTENT_SIZE,
+    help='maximum size of a response body in bytes, larger downloads are aborted',
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--recrawl_days',
+    default=None,
+    help='revisit pages fetched more than this many days ago, only downloading them again if they changed',
+    type=click.FloatRange(min=0)
+)
+@click.option(
+    '--compression',
+    default=DEFAULT_CODEC,
+    help='how to compress stored response bodies',
+    type=click.Choice([*CODECS, 'none'])
+)
+@click.option(
+    '--parser',
+    default=DEFAULT_PARSER,
+    help='extract text & links with BeautifulSoup, or stream them without building a tree',
+    type=click.Choice(PARSERS)
+)
+def crawl_loop(
+    db,
+    seen_capacity,
+    seen_error_rate,
+    seen_file,
+    simhash_file,
+    engine,
+    workers,
+    concurrency,
+    max_size,
+    recrawl_days,
+    compression,
+    parser
+):
     """
     Run the crawler loop
     """
-    crawler = Crawler(db, DEFAULT_HOSTS_DB)
-    crawler.start()
-    crawler.run()
+    crawler_class = AsyncCrawler if engine == 'async' else Crawler
+    crawler = crawler_class(
+        db,
+        DEFAULT_HOSTS_DB,
+        seen_capacity=seen_capacity,
+        seen_error_rate=seen_error_rate,
+        seen_file=seen_file,
+        simhash_file=simhash_file,
+        max_size=max_size,
+        recrawl_days=recrawl_days,
+        compression=None if compression == 'none' else compression,
+        parser=parser
+    )
+    try:
+        if engine == 'async':
+            crawler.start(workers, concurrency)
+        else:
+            crawler.start(workers)
+        crawler.run()
+    finally:
+        crawler.close()
+
+
+@c.command()
+@click.option(
+    '--db',
+    default=DEFAULT_CRAWLER_DB,
+    help='location of the SQLite database file',
+    type=click.Path()
+)
+@click.option(
+    '--codec',
+    default=DEFAULT_CODEC,
+    help='how to compress the stored response bodies',
+    type=click.Choice([*CODECS, 'none'])
+)
+@click.option(
+    '--dictionary/--no_dictionary',
+    default=False,
+    help='train a shared zlib dictionary on a sample of the stored pages'
+)
+@click.option(
+    '--samples',
+    default=1000,
+    help='number of pages to train the dictionary on',
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--batch_size',
+    default=500,
+    help='number of bodies to re-encode per transaction',
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--vacuum/--no_vacuum',
+    default=False,
+    help='shrink the database file afterwards, temporarily needs as much space again'
+)
+def compress_db(db, codec, dictionary, samples, batch_size, vacuum):
+    """
+    Compress the stored response bodies of an existing database in place
+    """
+    con = apsw.Connection(db)
+    # moves the bodies into their own table if necessary
+    Queue(con)
+    codec = None if codec == 'none' else codec
+
+    zdict = None
+    if dictionary and codec == 'zlib':
+        sample = [
+            decompress(data, encoding, con)
+            for data, encoding in con.execute(
+                "SELECT data, encoding FROM body \
+                ORDER BY random() \
+                LIMIT ?1",
+                (samples, )
+            )
+        ]
+        trained = train_dictionary(sample)
+        with con:
+            zdict = (store_dictionary(con, trained), trained)
+        print(f"trained a {len(trained)} byte dictionary on {len(sample)} pages")
+
+    (total, ) = con.execute("SELECT COUNT() FROM body").fetchone()
+    before = 0
+    after = 0
+    with tqdm(total=total) as progress:
+        for count, batch_before, batch_after in recompress_db(
+            con,
+            codec,
+            zdict,
+            batch_size
+        ):
+            before += batch_before
+            after += batch_after
+            progress.update(count)
+            progress.set_postfix(ratio=f"{after / max(before, 1):.3f}")
+    print(f"{before / 2**20:.1f} MiB -> {after / 2**20:.1f} MiB")
+    if vacuum:
+        con.execute("VACUUM")
 
 
 @c.command()
@@ -243,7 +417,19 @@ def crawl_loop(db):
     help='SQL to initialize index database tables',
     type=click.File()
 )
-def index_all(crawl_db, index_db, index_sql):
+@click.option(
+    '--batch_size',
+    default=crawl.index.DEFAULT_BATCH_SIZE,
+    help='number of postings written per transaction',
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--jobs',
+    default=1,
+    help='number of worker processes that tokenize documents in parallel',
+    type=click.IntRange(min=1)
+)
+def index_all(crawl_db, index_db, index_sql, batch_size, jobs):
     """
     Index all documents in the crawl database.
 
@@ -255,7 +441,7 @@ def index_all(crawl_db, index_db, index_sql):
         db = apsw.Connection(index_db)
         db.execute(sql_script)
         db.close()
-    crawl.index.index_all_db(crawl_db, index_db)
+    crawl.index.index_all_db(crawl_db, index_db, batch_size, jobs)
 
 
 if __name__ == '__main__':
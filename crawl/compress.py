@@ -0,0 +1,175 @@
+from collections import Counter
+import lzma
+import re
+import zlib
+
+import apsw
+
+# codecs for response bodies stored in `body.data`, the codec is stored in
+# `body.encoding`: NULL (uncompressed), "zlib", "lzma" or "zlib:<id>" for
+# zlib with a preset dictionary from the `compression_dict` table
+CODECS = ("zlib", "lzma")
+DEFAULT_CODEC = "zlib"
+# zlib only looks back 32 KiB, a longer dictionary would be wasted
+DICTIONARY_SIZE = 32 * 2**10
+
+_dictionaries: dict[int, bytes] = {}
+
+
+def compress(
+    data: bytes,
+    codec: str | None,
+    dictionary: tuple[int, bytes] | None = None
+) -> tuple[bytes, str | None]:
+    '''
+    Compress a response body for storage.
+
+    Parameters:
+    data (bytes): The uncompressed body.
+    codec (str): One of `CODECS`, or `None` to store the body as is.
+    dictionary (tuple[int, bytes]): Id & content of a preset dictionary, only used with zlib.
+
+    Returns:
+    tuple[bytes, str]: The stored data and its encoding.
+    '''
+    match codec:
+        case None:
+            return data, None
+        case "zlib" if dictionary:
+            dict_id, zdict = dictionary
+            compressor = zlib.compressobj(zdict=zdict)
+            return (
+                compressor.compress(data) + compressor.flush(),
+                f"zlib:{dict_id}"
+            )
+        case "zlib":
+            return zlib.compress(data), "zlib"
+        case "lzma":
+            return lzma.compress(data), "lzma"
+        case other:
+            raise Exception(f"unknown compression codec {other}")
+
+
+def decompress(
+    data: bytes,
+    encoding: str | None,
+    con: apsw.Connection | None = None
+) -> bytes:
+    '''
+    Restore a stored response body, `con` is needed for dictionary encodings
+    '''
+    match encoding:
+        case None:
+            return data
+        case "zlib":
+            return zlib.decompress(data)
+        case "lzma":
+            return lzma.decompress(data)
+        case dict_encoding if dict_encoding.startswith("zlib:"):
+            if con is None:
+                raise Exception(f"need the database to decompress {encoding}")
+            zdict = load_dictionary(con, int(dict_encoding[len("zlib:"):]))
+            decompressor = zlib.decompressobj(zdict=zdict)
+            return decompressor.decompress(data) + decompressor.flush()
+        case other:
+            raise Exception(f"unknown encoding {other}")
+
+
+def train_dictionary(samples: list[bytes], size=DICTIONARY_SIZE) -> bytes:
+    '''
+    Build a zlib preset dictionary out of markup that is common across pages.
+
+    Splits the samples after every tag, prefers fragments that are long and
+    occur in many samples. The most valuable ones go to the end of the
+    dictionary, where back-references are cheapest.
+    '''
+    counts = Counter()
+    for sample in samples:
+        fragments = set(
+            fragment.strip()
+            for fragment in re.split(rb"(?<=>)", sample)
+        )
+        counts.update(fragment for fragment in fragments if len(fragment) > 3)
+
+    chosen = []
+    total = 0
+    for fragment, count in sorted(
+        counts.items(),
+        key=lambda item: len(item[0]) * item[1],
+        reverse=True
+    ):
+        if count < 2:
+            continue
+        if total + len(fragment) > size:
+            continue
+        chosen.append(fragment)
+        total += len(fragment)
+    return b"".join(reversed(chosen))
+
+
+def store_dictionary(con: apsw.Connection, zdict: bytes) -> int:
+    (dict_id, ) = con.execute(
+        "INSERT INTO compression_dict (data) VALUES (?1) RETURNING id",
+        (zdict, )
+    ).fetchone()
+    _dictionaries[dict_id] = zdict
+    return dict_id
+
+
+def load_dictionary(con: apsw.Connection, dict_id: int) -> bytes:
+    if dict_id not in _dictionaries:
+        res = con.execute(
+            "SELECT data FROM compression_dict WHERE id = ?1",
+            (dict_id, )
+        ).fetchone()
+        if not res:
+            raise Exception(f"compression dictionary {dict_id} not found")
+        (_dictionaries[dict_id], ) = res
+    return _dictionaries[dict_id]
+
+
+def recompress_db(
+    con: apsw.Connection,
+    codec: str | None,
+    dictionary: tuple[int, bytes] | None = None,
+    batch_size=500
+):
+    '''
+    Re-encode all stored response bodies in place, one transaction per batch.
+
+    Yields the number of bodies, bytes before & bytes after for every batch.
+    '''
+    if dictionary and codec == "zlib":
+        target = f"zlib:{dictionary[0]}"
+    else:
+        target = codec
+    last_id = 0
+    while True:
+        with con:
+            rows = con.execute(
+                "SELECT id, data, encoding FROM body \
+                WHERE id > ?1 \
+                ORDER BY id \
+                LIMIT ?2",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            before = 0
+            after = 0
+            updates = []
+            for body_id, data, encoding in rows:
+                before += len(data)
+                if encoding == target:
+                    after += len(data)
+                    continue
+                raw = decompress(data, encoding, con)
+                stored, new_encoding = compress(raw, codec, dictionary)
+                after += len(stored)
+                updates.append((stored, new_encoding, body_id))
+            con.executemany(
+                "UPDATE body SET data = ?1, encoding = ?2 WHERE id = ?3",
+                updates
+            )
+        yield len(rows), before, after
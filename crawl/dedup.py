@@ -0,0 +1,243 @@
+import hashlib
+from itertools import combinations
+from math import comb
+import os
+import struct
+
+import apsw
+
+from crawl.process import SIMHASH_THRESHOLD
+
+SIMHASH_BITS = 128
+
+# magic, number of fingerprints, highest document id contained & a digest
+# of that document, which tells whether the file belongs to the database
+HEADER = struct.Struct("<8sQq16s")
+ENTRY = struct.Struct("<q16s")
+MAGIC = b"MSESIMH2"
+# the block count is chosen for at least this many documents
+PLANNED_DOCUMENTS = 1024
+
+
+def probes(block_count: int, threshold: int, documents: int) -> float:
+    """
+    Expected dictionary lookups & candidate comparisons of a near-duplicate
+    lookup among `documents` random fingerprints, with `block_count` blocks
+    """
+    radius = threshold // block_count
+    cost = 0.0
+    for i in range(block_count):
+        width = (SIMHASH_BITS + i) // block_count
+        keys = sum(comb(width, flips) for flips in range(radius + 1))
+        cost += keys + documents * keys / 2**width
+    return cost
+
+
+def best_block_count(threshold: int, documents: int) -> int:
+    return min(
+        range(1, min(threshold + 1, SIMHASH_BITS) + 1),
+        key=lambda block_count: probes(block_count, threshold, documents)
+    )
+
+
+class SimhashIndex:
+    """
+    Finds the stored fingerprints within `threshold` bits of a simhash
+    without comparing it to all of them
+
+    Multi-index hashing: the fingerprint is cut into disjoint blocks, each
+    with a table from its bits to the documents. Two fingerprints that differ
+    in at most `threshold` bits differ in at most `threshold // block_count`
+    bits of one of the blocks, so a lookup probes every key within that
+    radius of the block in each table.
+
+    Fewer, wider blocks make more probes but smaller buckets. The block count
+    is chosen for the number of documents & the tables are rebuilt with a
+    new one as the index grows: 16 tables keyed by 8 bits up to a few
+    thousand documents, 8 tables of 16 bit keys probed at radius 1 after &
+    6 tables of 21 & 22 bit keys probed at radius 2 around a million
+    documents. A lookup then takes about 2000 probes instead of N / 16, the
+    cost grows about with the square root of N & every document has at most
+    16 table entries.
+    """
+    def __init__(self, threshold: int = SIMHASH_THRESHOLD, block_count: int | None = None):
+        """
+        Parameters:
+        threshold (int): Maximum number of differing bits of near duplicates.
+        block_count (int): Fixed number of blocks, by default chosen for the
+        number of documents.
+        """
+        self.threshold = threshold
+        self.fixed_block_count = block_count
+        self.fingerprints: dict[int, int] = {}
+        # highest `document.id` that has been added, for catching up
+        self.max_doc_id = 0
+        self.plan(block_count or best_block_count(threshold, PLANNED_DOCUMENTS))
+
+
+    def plan(self, block_count: int):
+        """
+        Cut the fingerprints into `block_count` blocks & rebuild the tables
+        """
+        if not 1 <= block_count <= min(self.threshold + 1, SIMHASH_BITS):
+            raise Exception(f"invalid block count {block_count} for threshold {self.threshold}")
+        self.block_count = block_count
+        # documents the block count was chosen for
+        self.planned_for = max(len(self.fingerprints), PLANNED_DOCUMENTS)
+        radius = self.threshold // block_count
+        # (shift, width) of every block, the last ones are a bit wider
+        self.blocks = []
+        end = SIMHASH_BITS
+        for i in range(block_count):
+            width = (SIMHASH_BITS + i) // block_count
+            end -= width
+            self.blocks.append((end, width))
+        # the keys within `radius` bits of a block value are its XOR with these
+        self.masks = {
+            width: [
+                sum(1 << bit for bit in bits)
+                for flips in range(radius + 1)
+                for bits in combinations(range(width), flips)
+            ]
+            for _, width in self.blocks
+        }
+        self.tables: list[dict[int, list[int]]] = [{} for _ in self.blocks]
+        for doc_id, simhash in self.fingerprints.items():
+            self.insert(doc_id, simhash)
+
+
+    def insert(self, doc_id: int, simhash: int):
+        for (shift, width), buckets in zip(self.blocks, self.tables):
+            key = (simhash >> shift) & ((1 << width) - 1)
+            if key in buckets:
+                buckets[key].append(doc_id)
+            else:
+                buckets[key] = [doc_id]
+
+
+    def add(self, doc_id: int, simhash: int):
+        if doc_id in self.fingerprints:
+            return
+        self.fingerprints[doc_id] = simhash
+        self.max_doc_id = max(self.max_doc_id, doc_id)
+        if self.fixed_block_count is None and len(self.fingerprints) > 2 * self.planned_for:
+            # amortized like growing a dict, the tables are rebuilt at most
+            # once per doubling
+            block_count = best_block_count(self.threshold, 2 * len(self.fingerprints))
+            if block_count != self.block_count:
+                self.plan(block_count)
+                return
+            self.planned_for = len(self.fingerprints)
+        self.insert(doc_id, simhash)
+
+
+    def near_duplicates(self, simhash: int) -> list[int]:
+        """
+        Ids of the documents whose fingerprint is within `threshold` bits
+        """
+        candidates = set()
+        for (shift, width), buckets in zip(self.blocks, self.tables):
+            value = (simhash >> shift) & ((1 << width) - 1)
+            for mask in self.masks[width]:
+                if bucket := buckets.get(value ^ mask):
+                    candidates.update(bucket)
+        return sorted(
+            doc_id for doc_id in candidates
+            if (self.fingerprints[doc_id] ^ simhash).bit_count() <= self.threshold
+        )
+
+
+    def __len__(self) -> int:
+        return len(self.fingerprints)
+
+
+    def catch_up(self, con: apsw.Connection) -> int:
+        """
+        Add all documents from the `document` table that are newer than the
+        index
+        """
+        count = 0
+        for doc_id, simhash_bytes in con.execute(
+            "SELECT id, simhash FROM document WHERE id > ?1 ORDER BY id",
+            (self.max_doc_id, )
+        ):
+            self.add(doc_id, int.from_bytes(simhash_bytes, byteorder='big'))
+            count += 1
+        return count
+
+
+    @staticmethod
+    def document_digest(con: apsw.Connection, doc_id: int) -> bytes | None:
+        """
+        Digest of the id, fingerprint & request time of a document, `None` if
+        there is none
+        """
+        row = con.execute(
+            "SELECT simhash, request.time FROM document \
+            JOIN request ON request_id = request.id \
+            WHERE document.id = ?1",
+            (doc_id, )
+        ).fetchone()
+        if row is None:
+            return None
+        simhash_bytes, request_time = row
+        return hashlib.blake2b(
+            struct.pack("<q", doc_id) + simhash_bytes + struct.pack("<d", request_time),
+            digest_size=16
+        ).digest()
+
+
+    def save(self, path: str, con: apsw.Connection):
+        """
+        Write the fingerprints to `path`, replacing it atomically. The tables
+        are rebuilt when loading.
+        """
+        digest = SimhashIndex.document_digest(con, self.max_doc_id) or bytes(16)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as file:
+            file.write(HEADER.pack(
+                MAGIC,
+                len(self.fingerprints),
+                self.max_doc_id,
+                digest
+            ))
+            file.write(b"".join(
+                ENTRY.pack(doc_id, simhash.to_bytes(16, byteorder='big'))
+                for doc_id, simhash in self.fingerprints.items()
+            ))
+        os.replace(tmp, path)
+
+
+    @staticmethod
+    def load(
+        path: str,
+        con: apsw.Connection,
+        threshold: int = SIMHASH_THRESHOLD
+    ) -> 'SimhashIndex':
+        """
+        Load the fingerprints saved at `path` & add the documents stored
+        since, or build the index from the `document` table if there is no
+        valid file for this database.
+        """
+        index = SimhashIndex(threshold)
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                header = file.read(HEADER.size)
+                if len(header) == HEADER.size:
+                    magic, count, max_doc_id, digest = HEADER.unpack(header)
+                    # the document it ends with has to be the same, the file
+                    # of a recreated database would hide its documents
+                    if max_doc_id > 0:
+                        belongs = SimhashIndex.document_digest(con, max_doc_id) == digest
+                    else:
+                        belongs = True
+                    entries = file.read()
+                    if belongs and magic == MAGIC and len(entries) == count * ENTRY.size:
+                        for doc_id, simhash_bytes in ENTRY.iter_unpack(entries):
+                            index.add(
+                                doc_id,
+                                int.from_bytes(simhash_bytes, byteorder='big')
+                            )
+                        index.max_doc_id = max_doc_id
+        index.catch_up(con)
+        return index
@@ -1,17 +1,25 @@
 from collections import Counter
+from email.utils import parsedate_to_datetime
+from functools import cache
 import json
 import re
-from urllib.parse import urldefrag, urljoin
 
 import apsw
 from bs4 import BeautifulSoup
 
 from crawl import DEFAULT_CRAWLER_DB
-from crawl.process import compute_simhash, is_near_duplicate_simhash, normalize_url, preprocess_text
+from crawl.compress import decompress
+from crawl.dedup import SimhashIndex
+from crawl.extract import DEFAULT_PARSER, StreamExtractor
+from crawl.links import LinkNormalizer
+from crawl.process import compute_simhash, is_near_duplicate_simhash, preprocess_text
 
 # e.g. if 1 out of 100 words is a keyword, site is relevant
 KEYWORD_DENSITY_THRESHOLD = 0.01
 
+# shared by all documents of a process, so that its cache pays off
+LINK_NORMALIZER = LinkNormalizer()
+
 
 KEYWORD_WEIGHTS = {
     "tübingen": 1.0,
@@ -31,12 +39,35 @@ KEYWORD_WEIGHTS = {
     "schwabisch": 0.7,
 }
 
-# Stem keywords as well
-STEMMED_KEYWORDS = {
-    preprocess_text(keyword).pop(): weight
-    for keyword, weight
-    in KEYWORD_WEIGHTS.items()
-}
+
+@cache
+def stemmed_keywords() -> dict[str, float]:
+    """
+    Stem keywords as well, on first use since that loads NLTK
+    """
+    return {
+        preprocess_text(keyword).pop(): weight
+        for keyword, weight
+        in KEYWORD_WEIGHTS.items()
+    }
+
+
+@cache
+def keyword_prefilter() -> re.Pattern:
+    """
+    Matches within every word that lemmatizes to one of the stemmed
+    keywords: the WordNet noun rules only strip endings, except for turning
+    -ies into -y & -men into -man
+    """
+    forms = set()
+    for stem in stemmed_keywords():
+        forms.add(stem)
+        if stem.endswith("y"):
+            forms.add(stem[:-1] + "ies")
+        if stem.endswith("man"):
+            forms.add(stem[:-3] + "men")
+    return re.compile("|".join(map(re.escape, sorted(forms))))
+
 
 IRRELEVANT_TAGS = [
     "script",
@@ -80,54 +111,56 @@ IRRELEVANT_TAGS = [
 ]
 
 
+def parse_http_date(value: str | None) -> int | None:
+    if not value:
+        return None
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
 class Document:
-    def __init__(self, request_id, url, headers, data: bytes):
+    def __init__(
+        self,
+        request_id,
+        url,
+        headers,
+        data: bytes,
+        encoding: str | None = None
+    ):
         self.text_content = None
         self.request_id = request_id
         self.url = url
         if headers:
             self.language_header = headers.get("Content-Language")
+            self.last_modified = parse_http_date(headers.get("Last-Modified"))
         else:
             self.language_header = None
+            self.last_modified = None
+        # stored (compressed) response body, see `crawl.compress`
         self.data = data
+        self.encoding = encoding
         self.relevance_score = None
+        # whether `relevance` knew it is 0 without lemmatizing the text
+        self.prefiltered = False
         self.simhash_value = None
         self.id = None
         self.parsed = False
+        # normalized links, collected while parsing
+        self.link_urls = None
+        # one of `crawl.extract.PARSERS`
+        self.parser = DEFAULT_PARSER
+
+    def raw(self) -> bytes:
+        return decompress(self.data, self.encoding)
 
     def parse(self) -> bool:
         try:
-            soup = BeautifulSoup(self.data, 'html.parser')
-            if soup.html and (lang_tag := soup.html.get('lang')):
-                if type(lang_tag) == str:
-                    self.lang = lang_tag
-                elif lang_tag:
-                    self.lang = lang_tag[0]
-                else:
-                    self.lang = None
-            else: self.lang = None
-
-            self.title = str(soup.title.string) if soup.title else None
-            meta_description = soup.find(
-                "meta",
-                attrs={"name": "description"}
-            )
-            if meta_description:
-                self.meta_description = meta_description.get("content")
+            if self.parser == "stream":
+                self.parse_stream()
             else:
-                self.meta_description = None
-
-            for tag in soup(IRRELEVANT_TAGS):
-                tag.extract()
-
-            text = soup.get_text(separator=' ')
-            lines = (line.strip() for line in text.splitlines())
-            chunks = (
-                phrase.strip()
-                for line in lines
-                for phrase in line.split()
-            )
-            self.text_content = ' '.join(chunk for chunk in chunks if chunk)
+                self.parse_soup()
         except Exception as e:
             print(f"failed to parse {self.url}: {e}")
             return False
@@ -136,6 +169,58 @@ class Document:
             return True
 
 
+    def parse_soup(self):
+        soup = BeautifulSoup(self.raw(), 'html.parser')
+        if soup.html and (lang_tag := soup.html.get('lang')):
+            if type(lang_tag) == str:
+                self.lang = lang_tag
+            elif lang_tag:
+                self.lang = lang_tag[0]
+            else:
+                self.lang = None
+        else: self.lang = None
+
+        # before removing navigation etc., their links count as well
+        self.link_urls = self.extract_links(soup)
+
+        self.title = str(soup.title.string) if soup.title else None
+        meta_description = soup.find(
+            "meta",
+            attrs={"name": "description"}
+        )
+        if meta_description:
+            self.meta_description = meta_description.get("content")
+        else:
+            self.meta_description = None
+
+        for tag in soup(IRRELEVANT_TAGS):
+            tag.extract()
+
+        text = soup.get_text(separator=' ')
+        lines = (line.strip() for line in text.splitlines())
+        chunks = (
+            phrase.strip()
+            for line in lines
+            for phrase in line.split()
+        )
+        self.text_content = ' '.join(chunk for chunk in chunks if chunk)
+
+
+    def parse_stream(self):
+        """
+        Same result as `parse_soup`, without building a tree
+        """
+        extractor = StreamExtractor.extract(self.raw(), IRRELEVANT_TAGS)
+        self.lang = extractor.lang
+        self.link_urls = self.normalize_links(extractor.hrefs)
+        if extractor.title_node is not None:
+            self.title = str(extractor.title())
+        else:
+            self.title = None
+        self.meta_description = extractor.meta_description
+        self.text_content = extractor.text()
+
+
     def is_english(self) -> bool:
         if type(self.lang) == str and self.lang.lower().startswith("en"):
             return True
@@ -145,13 +230,23 @@ class Document:
 
 
     def relevance(self) -> float:
-        if self.relevance_score:
+        if self.relevance_score is not None:
             return self.relevance_score
 
         if not self.is_english():
             self.relevance_score = 0.0
             return self.relevance_score
 
+        # most pages don't mention any keyword, no need to lemmatize them
+        prefilter = keyword_prefilter()
+        if not (
+            prefilter.search(self.url.lower())
+            or prefilter.search(self.text_content.lower())
+        ):
+            self.prefiltered = True
+            self.relevance_score = 0.0
+            return self.relevance_score
+
         # stem words in URL
         url_words = preprocess_text(self.url)
         # Stem words on site
@@ -163,7 +258,7 @@ class Document:
 
         # Count the number of relevant words on a site
         relevant_count = 0
-        for word, weight in STEMMED_KEYWORDS.items():
+        for word, weight in stemmed_keywords().items():
             if word in word_counts:
                 relevant_count += word_counts[word] * weight
 
@@ -189,8 +284,13 @@ class Document:
 
     def check_for_duplicates(
         self,
-        db: apsw.Connection | str = DEFAULT_CRAWLER_DB
+        db: apsw.Connection | str = DEFAULT_CRAWLER_DB,
+        index: SimhashIndex | None = None
     ) -> bool:
+        """
+        Whether a document of another URL is a near duplicate, looked up in
+        `index` if given instead of comparing against every stored one
+        """
         if type(db) == str:
             con = apsw.Connection(db)
         elif type(db) == apsw.Connection:
@@ -198,7 +298,32 @@ class Document:
         else:
             raise Exception("invalid db argument")
 
-        hashes = con.execute("SELECT id, simhash FROM document").fetchall()
+        if index is not None:
+            for doc_id in index.near_duplicates(self.simhash()):
+                row = con.execute(
+                    "SELECT url.url FROM document \
+                    JOIN request ON request_id = request.id \
+                    JOIN url ON request.url_id = url.id \
+                    WHERE document.id = ?1",
+                    (doc_id, )
+                ).fetchone()
+                if row is None:
+                    # not (or no longer) in this database
+                    continue
+                # earlier versions of the same page don't count when recrawling
+                if row[0] != self.url:
+                    print(f"document is near duplicate of {doc_id}")
+                    return True
+            return False
+
+        # earlier versions of the same page don't count when recrawling
+        hashes = con.execute(
+            "SELECT document.id, simhash FROM document \
+            JOIN request ON request_id = request.id \
+            JOIN url ON request.url_id = url.id \
+            WHERE url.url != ?1",
+            (self.url, )
+        ).fetchall()
         for doc_id, simhash_bytes in hashes:
             assert type(simhash_bytes) == bytes, "invalid simhash type"
             simhash = int.from_bytes(simhash_bytes, byteorder='big')
@@ -207,22 +332,41 @@ class Document:
                 return True
         return False
 
-    def links(self):
-        soup = BeautifulSoup(self.data, 'html.parser')
-        for link_tag in soup.find_all('a', href=True):
-            if link := link_tag.get('href'):
-                if link[0] == "#": continue
-                absolute = urljoin(self.url, urldefrag(link).url)
-                if not absolute.startswith("http"): continue
-                norm = normalize_url(absolute)
-                is_wiki = re.compile("^https?://([a-z]{2})[.]wikipedia[.]org/")
-                if (m := is_wiki.match(norm)) and m.group(1) != 'en': continue
-                yield norm
+    def extract_links(self, soup: BeautifulSoup) -> list[str]:
+        return self.normalize_links(
+            link_tag.get('href')
+            for link_tag in soup.find_all('a', href=True)
+        )
+
+
+    def normalize_links(self, hrefs) -> list[str]:
+        return LINK_NORMALIZER.normalize_all(self.url, hrefs)
+
+
+    def links(self) -> list[str]:
+        if self.link_urls is None:
+            soup = BeautifulSoup(self.raw(), 'html.parser')
+            self.link_urls = self.extract_links(soup)
+        return self.link_urls
 
 
-    def save(self, db: apsw.Connection | str = DEFAULT_CRAWLER_DB):
+    def strip(self):
         """
-        Store the document in the database.
+        Drop what the crawler doesn't need back from a worker: the body, &
+        the links unless the document is relevant
+        """
+        self.data = None
+        if not self.is_relevant():
+            self.link_urls = None
+
+
+    def save(
+        self,
+        db: apsw.Connection | str = DEFAULT_CRAWLER_DB,
+        index: SimhashIndex | None = None
+    ):
+        """
+        Store the document in the database, & its simhash in `index` if given.
         """
         if not self.request_id:
             raise Exception("cannot store document without request id")
@@ -241,9 +385,10 @@ class Document:
                 relevance, \
                 language, \
                 title, \
-                content \
+                content, \
+                last_modified \
             ) \
-            VALUES (?1, ?2, ?3, ?4, ?5, ?6) \
+            VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7) \
             RETURNING id",
             (
                 self.request_id,
@@ -251,11 +396,21 @@ class Document:
                 self.relevance(),
                 self.lang,
                 self.title,
-                self.text_content
+                self.text_content,
+                self.last_modified
             )
         ).fetchone()
         if res:
             (self.id,) = res
+            # the current document of the URL, replaces that of a previous
+            # crawl in the index
+            con.execute(
+                "UPDATE url SET document_id = ?1 \
+                WHERE id = (SELECT url_id FROM request WHERE id = ?2)",
+                (self.id, self.request_id)
+            )
+            if index is not None:
+                index.add(self.id, self.simhash())
             return self.id
         else:
             raise Exception("failed to store document")
@@ -304,9 +459,11 @@ class Document:
 
 
     @staticmethod
-    def load_all(con: apsw.Connection):
-        rows = con.execute(
-            "SELECT \
+    def load_all(con: apsw.Connection, doc_ids: list[int] | None = None):
+        """
+        Load every document, or only the ones with the given ids
+        """
+        sql = "SELECT \
                 document.id, \
                 url.url, \
                 request_id, \
@@ -317,8 +474,14 @@ class Document:
                 content \
             FROM document \
             JOIN request ON request_id = request.id \
-            JOIN url ON request.url_id = url.id",
-        ).fetchall()
+            JOIN url ON request.url_id = url.id"
+        if doc_ids is None:
+            rows = con.execute(sql).fetchall()
+        else:
+            rows = con.execute(
+                sql + " WHERE document.id IN (SELECT value FROM json_each(?1))",
+                (json.dumps(doc_ids), )
+            ).fetchall()
         for row in rows:
             doc = Document(None, None, None, None)
             (
@@ -346,17 +509,20 @@ class Document:
             raise Exception("invalid db argument")
 
         row = con.execute(
-            "SELECT url.url, JSON(headers), data \
+            "SELECT url.url, JSON(headers), body.data, body.encoding \
             FROM request \
             JOIN url ON url_id = url.id \
+            LEFT JOIN body ON body_id = body.id \
             WHERE request.id = ?1",
             (request_id, )
         ).fetchone()
         if row:
-            url, headers_json, data = row
+            url, headers_json, data, encoding = row
             if not headers_json:
                 return None
             headers = json.loads(headers_json)
+            if data is not None:
+                data = decompress(data, encoding, con)
             doc = Document(request_id, url, headers, data)
             return doc
         return None
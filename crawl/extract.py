@@ -0,0 +1,164 @@
+from html.parser import HTMLParser
+
+from bs4 import UnicodeDammit
+
+# how `Document.parse` turns HTML into text, title, meta description & links
+PARSERS = ("soup", "stream")
+DEFAULT_PARSER = "soup"
+
+# tags without content, closed right away like BeautifulSoup does
+VOID_TAGS = {
+    "area", "base", "basefont", "bgsound", "br", "col", "command", "embed",
+    "frame", "hr", "image", "img", "input", "isindex", "keygen", "link",
+    "menuitem", "meta", "nextid", "param", "source", "spacer", "track", "wbr",
+}
+# BeautifulSoup's `get_text` skips the strings of ruby annotations as well
+NO_TEXT_TAGS = {"rp", "rt"}
+# whitespace-only strings are collapsed outside of these
+PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+
+def title_string(node: list) -> str | None:
+    # like `Tag.string`: only defined if there is exactly one child
+    if len(node) != 1:
+        return None
+    if type(node[0]) == str:
+        return node[0]
+    return title_string(node[0])
+
+
+class StreamExtractor(HTMLParser):
+    """
+    Extracts what `Document.parse` needs from the parser events, without
+    building a tree
+
+    Keeps a stack of the open tag names that nests like the tree
+    BeautifulSoup builds with `html.parser`, so that the text of irrelevant
+    subtrees can be skipped while they stream past.
+    """
+    def __init__(self, skip_tags):
+        super().__init__(convert_charrefs=True)
+        self.skip_tags = set(skip_tags) | NO_TEXT_TAGS
+        # (tag name, title node) of every open tag, the node is only set
+        # within the first <title>
+        self.stack: list[tuple[str, list | None]] = []
+        self.open_counts: dict[str, int] = {}
+        # end tags of void elements that are still expected to show up
+        self.closed_void: list[str] = []
+        # stack depth below which the text is skipped
+        self.skip_at = None
+        self.preserve = 0
+        self.strings: list[str] = []
+        self.hrefs: list[str] = []
+        self.lang = None
+        self.html_seen = False
+        self.title_node = None
+        self.meta_description = None
+        self.meta_seen = False
+
+
+    @staticmethod
+    def extract(data: bytes, skip_tags) -> 'StreamExtractor':
+        markup = UnicodeDammit(data, is_html=True).unicode_markup
+        if markup is None:
+            raise Exception("unable to decode document")
+        extractor = StreamExtractor(skip_tags)
+        extractor.feed(markup)
+        extractor.close()
+        return extractor
+
+
+    def text(self) -> str:
+        return ' '.join(' '.join(self.strings).split())
+
+
+    def title(self) -> str | None:
+        if self.title_node is None:
+            return None
+        return title_string(self.title_node)
+
+
+    def handle_starttag(self, tag, attrs):
+        self.start(tag, attrs)
+        if tag in VOID_TAGS:
+            self.pop()
+            self.closed_void.append(tag)
+
+
+    def handle_startendtag(self, tag, attrs):
+        self.start(tag, attrs)
+        self.pop()
+
+
+    def start(self, tag: str, attrs):
+        attrs = {name: value or "" for name, value in attrs}
+        match tag:
+            case "html" if not self.html_seen:
+                self.html_seen = True
+                self.lang = attrs.get("lang") or None
+            case "meta" if not self.meta_seen and attrs.get("name") == "description":
+                self.meta_seen = True
+                self.meta_description = attrs.get("content")
+            case "a" if "href" in attrs:
+                self.hrefs.append(attrs["href"])
+
+        parent = self.stack[-1][1] if self.stack else None
+        if parent is not None:
+            node = []
+            parent.append(node)
+        elif tag == "title" and self.title_node is None:
+            node = self.title_node = []
+        else:
+            node = None
+        if tag in self.skip_tags and self.skip_at is None:
+            self.skip_at = len(self.stack)
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve += 1
+        self.stack.append((tag, node))
+        self.open_counts[tag] = self.open_counts.get(tag, 0) + 1
+
+
+    def pop(self):
+        tag, _ = self.stack.pop()
+        self.open_counts[tag] -= 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve -= 1
+        if self.skip_at is not None and len(self.stack) <= self.skip_at:
+            self.skip_at = None
+
+
+    def handle_endtag(self, tag):
+        if tag in self.closed_void:
+            self.closed_void.remove(tag)
+            return
+        # close everything up to the most recent open tag with this name
+        if self.open_counts.get(tag):
+            while self.pop_name() != tag:
+                pass
+
+
+    def pop_name(self) -> str:
+        tag = self.stack[-1][0]
+        self.pop()
+        return tag
+
+
+    def handle_data(self, data):
+        if not self.preserve and not data.strip(ASCII_SPACES):
+            data = "\n" if "\n" in data else " "
+        if self.stack and (node := self.stack[-1][1]) is not None:
+            node.append(data)
+        if self.skip_at is None:
+            self.strings.append(data)
+
+
+    def handle_comment(self, data):
+        # comments aren't text, but they are children of the title
+        if self.stack and (node := self.stack[-1][1]) is not None:
+            node.append(data)
+
+
+    def unknown_decl(self, data):
+        if data.upper().startswith("CDATA["):
+            self.handle_data(data[len("CDATA["):])
@@ -3,22 +3,400 @@
 #index: The location of the local index storing the discovered documents.
 import apsw
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import json
+import math
+import os
+import tempfile
+import time
 
 from tqdm import tqdm
 
 from crawl import DEFAULT_CRAWLER_DB, DEFAULT_INDEX_DB
 from crawl.document import Document
-from crawl.process import preprocess_text
+from crawl.process import LEMMA_TABLE_SQL, lemma_cache, preprocess_text
 
 
-def index_all_db(crawl_db=DEFAULT_CRAWLER_DB, index_db=DEFAULT_INDEX_DB):
+# postings buffered before they are written in one transaction
+DEFAULT_BATCH_SIZE = 1_000_000
+# dropped during bulk loads & built again afterwards, as in index.sql
+INDEXES = {
+    "inverted_index_position": 'CREATE UNIQUE INDEX IF NOT EXISTS \
+        "inverted_index_position" ON "inverted_index" ("document_id", "position")',
+    "inverted_index_word": 'CREATE INDEX IF NOT EXISTS \
+        "inverted_index_word" ON "inverted_index" ("word_id")',
+}
+# `inverted_index` of an index created before the UNIQUE constraint was an
+# explicit index, SQLite can't drop the index behind an inline constraint
+LEGACY_AUTOINDEX = "sqlite_autoindex_inverted_index_1"
+# runs per worker with `--jobs`, so that workers finishing early get more
+RUNS_PER_JOB = 4
+
+
+def migrate_inverted_index(con: apsw.Connection):
+    """
+    Rebuild the `inverted_index` of an older index as in the current
+    `index.sql`, so that bulk loads can drop all of its indexes
+    """
+    if not con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?1",
+        (LEGACY_AUTOINDEX, )
+    ).fetchone():
+        return
+    print("migrating inverted_index to explicit indexes")
+    with con:
+        con.execute(
+            'CREATE TABLE "inverted_index_new" ( \
+                "word_id" INTEGER NOT NULL, \
+                "document_id" INTEGER NOT NULL, \
+                "position" INTEGER NOT NULL, \
+                FOREIGN KEY("word_id") REFERENCES "word", \
+                FOREIGN KEY("document_id") REFERENCES "document" \
+            ); \
+            INSERT INTO "inverted_index_new" (word_id, document_id, position) \
+                SELECT word_id, document_id, position FROM "inverted_index"; \
+            DROP TABLE "inverted_index"; \
+            ALTER TABLE "inverted_index_new" RENAME TO "inverted_index";'
+        )
+
+
+def drop_indexes(con: apsw.Connection):
+    with con:
+        for name in INDEXES:
+            con.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+
+def build_indexes(con: apsw.Connection):
+    with con:
+        for sql in INDEXES.values():
+            con.execute(sql)
+
+
+def indexed_documents(con: apsw.Connection) -> dict[str, int]:
+    """
+    Ids of the documents in an index by URL
+    """
+    return {
+        url: doc_id
+        for doc_id, url in con.execute("SELECT id, url FROM document")
+    }
+
+
+def remove_documents(con: apsw.Connection, doc_ids: list[int]):
+    with con:
+        for table, column in (("inverted_index", "document_id"), ("document", "id")):
+            con.execute(
+                f"DELETE FROM {table} \
+                WHERE {column} IN (SELECT value FROM json_each(?1))",
+                (json.dumps(doc_ids), )
+            )
+
+
+def select_documents(
+    crawl_con: apsw.Connection,
+    index_con: apsw.Connection
+) -> list[int]:
+    """
+    Ids of the documents to index: the current document of every URL, unless
+    it is indexed already. Indexed documents that a recrawl has superseded are
+    removed from the index, their URL is indexed with the new document.
+    """
+    indexed = indexed_documents(index_con)
+    doc_ids = set(indexed.values())
+    selected = []
+    stale = []
+    for doc_id, url in crawl_con.execute(
+        "SELECT document_id, url FROM url \
+        WHERE document_id IS NOT NULL \
+        ORDER BY document_id"
+    ):
+        if doc_id in doc_ids:
+            continue
+        if url in indexed:
+            stale.append(indexed[url])
+        selected.append(doc_id)
+    if stale:
+        # while the postings can still be found by document
+        remove_documents(index_con, stale)
+    return selected
+
+
+class BulkIndexer:
+    """
+    Adds many documents to an index database at once
+
+    Word ids come from an in-memory lexicon & postings are buffered, then
+    written with `executemany` in one transaction per batch. The indexes of
+    `inverted_index` are dropped while loading, `close` builds them again.
+    """
+    def __init__(self, con: apsw.Connection, batch_size=DEFAULT_BATCH_SIZE):
+        self.con = con
+        self.batch_size = batch_size
+        self.lexicon: dict[str, int] = dict(
+            con.execute("SELECT word, id FROM word")
+        )
+        self.next_word_id = max(self.lexicon.values(), default=0) + 1
+        # documents are only indexed once, like the constraints of `document`
+        indexed = indexed_documents(con)
+        self.doc_ids = set(indexed.values())
+        self.urls = set(indexed)
+        self.words: list[tuple[int, str]] = []
+        self.documents: list[tuple] = []
+        self.postings: list[tuple[int, int, int]] = []
+        self.tokens = 0
+        migrate_inverted_index(con)
+        drop_indexes(con)
+
+
+    def add(self, doc: Document) -> int:
+        """
+        Buffer the postings of a document, writing the batch once it is full
+
+        Returns:
+        int: The number of tokens indexed, 0 if the document already was.
+        """
+        if doc.id in self.doc_ids or doc.url in self.urls:
+            return 0
+        self.doc_ids.add(doc.id)
+        self.urls.add(doc.url)
+        self.documents.append((doc.id, doc.text_content, doc.title, doc.url))
+
+        words = preprocess_text(doc.text_content)
+        lexicon = self.lexicon
+        postings = self.postings
+        for position, word in enumerate(words):
+            word_id = lexicon.get(word)
+            if word_id is None:
+                word_id = lexicon[word] = self.next_word_id
+                self.next_word_id += 1
+                self.words.append((word_id, word))
+            postings.append((word_id, doc.id, position))
+        self.tokens += len(words)
+
+        if len(postings) >= self.batch_size:
+            self.flush()
+        return len(words)
+
+
+    def flush(self):
+        with self.con:
+            self.con.executemany(
+                "INSERT INTO word (id, word) VALUES (?1, ?2)",
+                self.words
+            )
+            self.con.executemany(
+                "INSERT INTO document (id, content, title, url) \
+                VALUES (?1, ?2, ?3, ?4)",
+                self.documents
+            )
+            self.con.executemany(
+                "INSERT INTO inverted_index (word_id, document_id, position) \
+                VALUES (?1, ?2, ?3)",
+                self.postings
+            )
+        self.words.clear()
+        self.documents.clear()
+        self.postings.clear()
+
+
+    def close(self):
+        """
+        Write the remaining postings & build the indexes, even if writing
+        fails: queries are unusably slow without them
+        """
+        try:
+            self.flush()
+        finally:
+            build_indexes(self.con)
+
+
+def index_all_db(
+    crawl_db=DEFAULT_CRAWLER_DB,
+    index_db=DEFAULT_INDEX_DB,
+    batch_size=DEFAULT_BATCH_SIZE,
+    jobs=1
+):
+    if jobs > 1:
+        return index_all_parallel(crawl_db, index_db, jobs, batch_size)
+
     crawl_con = apsw.Connection(crawl_db)
     index_con = apsw.Connection(index_db)
 
-    (total, ) = crawl_con.execute("SELECT COUNT() FROM document").fetchone()
+    selected = select_documents(crawl_con, index_con)
+    lemma_cache.load(index_con)
+
+    indexer = BulkIndexer(index_con, batch_size)
+    start = time.perf_counter()
+    # an interrupted run keeps the documents written so far, the next one
+    # goes on from there
+    try:
+        with tqdm(
+            Document.load_all(crawl_con, selected),
+            total=len(selected),
+            unit="doc"
+        ) as progress:
+            for doc in progress:
+                indexer.add(doc)
+                rate = indexer.tokens / (time.perf_counter() - start)
+                progress.set_postfix_str(f"{rate:,.0f} tokens/s", refresh=False)
+    finally:
+        print("building indexes")
+        indexer.close()
+    elapsed = time.perf_counter() - start
+    print(
+        f"indexed {indexer.tokens} tokens in {elapsed:.1f}s,",
+        f"{indexer.tokens / elapsed:,.0f} tokens/s"
+    )
+
+    lemma_cache.store(index_con)
+    stats = lemma_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    if lookups:
+        print(
+            f"lemma cache: {stats['size']} words,",
+            f"{stats['hits'] / lookups:.1%} of {lookups} lookups hit"
+        )
+
+
+def load_lemmas(index_db: str):
+    # warm-start the lemma cache of a worker process
+    con = apsw.Connection(index_db, flags=apsw.SQLITE_OPEN_READONLY)
+    lemma_cache.load(con)
+    con.close()
 
-    for doc in tqdm(Document.load_all(crawl_con), total=total):
-        index(doc, index_con)
+
+def build_run(
+    crawl_db: str,
+    run_db: str,
+    schema: list[str],
+    doc_ids: list[int],
+    batch_size=DEFAULT_BATCH_SIZE
+) -> int:
+    """
+    Index the documents into a new database with its own word ids, along
+    with the lemmas the worker knows by then
+
+    Returns:
+    int: The number of tokens indexed.
+    """
+    crawl_con = apsw.Connection(crawl_db, flags=apsw.SQLITE_OPEN_READONLY)
+    run_con = apsw.Connection(run_db)
+    # nobody reads the run before it is complete
+    run_con.execute("PRAGMA journal_mode = OFF")
+    run_con.execute("PRAGMA synchronous = OFF")
+    for sql in schema:
+        run_con.execute(sql)
+    indexer = BulkIndexer(run_con, batch_size)
+    for doc in Document.load_all(crawl_con, doc_ids):
+        indexer.add(doc)
+    indexer.flush()
+    lemma_cache.store(run_con)
+    run_con.close()
+    crawl_con.close()
+    return indexer.tokens
+
+
+def merge_run(con: apsw.Connection, run_db: str):
+    """
+    Add the documents of a run to the index, translating its word ids
+    """
+    con.execute("ATTACH DATABASE ?1 AS run", (run_db, ))
+    try:
+        with con:
+            con.execute(
+                "INSERT OR IGNORE INTO main.word (word) \
+                SELECT word FROM run.word ORDER BY id"
+            )
+            con.execute(
+                "INSERT INTO main.document (id, content, title, url) \
+                SELECT id, content, title, url FROM run.document"
+            )
+            con.execute(
+                "INSERT INTO main.inverted_index (word_id, document_id, position) \
+                SELECT main_word.id, posting.document_id, posting.position \
+                FROM run.inverted_index AS posting \
+                JOIN run.word AS run_word ON run_word.id = posting.word_id \
+                JOIN main.word AS main_word ON main_word.word = run_word.word"
+            )
+            con.execute(
+                "INSERT OR IGNORE INTO main.lemma (word, lemma) \
+                SELECT word, lemma FROM run.lemma"
+            )
+    finally:
+        con.execute("DETACH DATABASE run")
+
+
+def index_all_parallel(
+    crawl_db: str,
+    index_db: str,
+    jobs: int,
+    batch_size=DEFAULT_BATCH_SIZE
+):
+    """
+    Index the documents in worker processes, SPIMI-style
+
+    Every worker tokenizes a share of the documents into a run: a database
+    of its own, with word ids of its own. The runs are merged into the index
+    in order while the workers go on, which gives the words their final ids.
+    """
+    crawl_con = apsw.Connection(crawl_db)
+    index_con = apsw.Connection(index_db)
+
+    # which documents to index is decided up front, the workers can't know
+    # about the URLs in each other's runs
+    selected = select_documents(crawl_con, index_con)
+    run_size = max(1, math.ceil(len(selected) / (jobs * RUNS_PER_JOB)))
+    runs = [
+        selected[i:i + run_size]
+        for i in range(0, len(selected), run_size)
+    ]
+
+    # the runs use the same tables as the index
+    migrate_inverted_index(index_con)
+    schema = [
+        sql for (sql, ) in index_con.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' \
+            AND name IN ('document', 'word', 'inverted_index')"
+        )
+    ]
+    index_con.execute(LEMMA_TABLE_SQL)
+    drop_indexes(index_con)
+
+    tokens = 0
+    start = time.perf_counter()
+    # merged runs stay in the index if the others fail
+    try:
+        with (
+            tempfile.TemporaryDirectory(
+                dir=os.path.dirname(os.path.abspath(index_db))
+            ) as tmp,
+            ProcessPoolExecutor(
+                jobs,
+                initializer=load_lemmas,
+                initargs=(index_db, )
+            ) as pool,
+            tqdm(total=len(selected), unit="doc") as progress
+        ):
+            run_dbs = [os.path.join(tmp, f"run{i}.db") for i in range(len(runs))]
+            futures = [
+                pool.submit(build_run, crawl_db, run_db, schema, run, batch_size)
+                for run_db, run in zip(run_dbs, runs)
+            ]
+            for run_db, run, future in zip(run_dbs, runs, futures):
+                tokens += future.result()
+                merge_run(index_con, run_db)
+                os.remove(run_db)
+                progress.update(len(run))
+                rate = tokens / (time.perf_counter() - start)
+                progress.set_postfix_str(f"{rate:,.0f} tokens/s", refresh=False)
+    finally:
+        print("building indexes")
+        build_indexes(index_con)
+    elapsed = time.perf_counter() - start
+    print(
+        f"indexed {tokens} tokens in {elapsed:.1f}s with {jobs} jobs,",
+        f"{tokens / elapsed:,.0f} tokens/s"
+    )
 
 
 def index(doc: Document, con: apsw.Connection):
@@ -26,16 +404,24 @@ def index(doc: Document, con: apsw.Connection):
     words = preprocess_text(doc.text_content)
 
     with con:
-        try:
-            #insert document
-            con.execute(
-                "INSERT INTO document (id, content, title, url) \
-                VALUES (?1, ?2, ?3, ?4)",
-                (doc.id, doc.text_content, doc.title, doc.url)
-            )
-        except apsw.ConstraintError:
-            # assumes that the document is fully hashed if it exists
+        indexed = con.execute(
+            "SELECT id FROM document WHERE url = ?1",
+            (doc.url, )
+        ).fetchone()
+        if indexed and indexed[0] >= doc.id:
+            # assumes that the document is fully hashed if it exists, or
+            # that of a later recrawl
             return
+        if indexed:
+            # superseded by a recrawl
+            remove_documents(con, [indexed[0]])
+
+        #insert document
+        con.execute(
+            "INSERT INTO document (id, content, title, url) \
+            VALUES (?1, ?2, ?3, ?4)",
+            (doc.id, doc.text_content, doc.title, doc.url)
+        )
 
         for word_index, word in enumerate(words):
             con.execute(
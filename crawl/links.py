@@ -0,0 +1,133 @@
+from collections import OrderedDict
+import re
+from urllib.parse import urldefrag, urljoin
+
+from crawl.process import normalize_url
+
+# number of links whose result is kept in memory
+DEFAULT_LINK_CACHE_SIZE = 100_000
+# only follow links to the English Wikipedia
+DEFAULT_WIKIPEDIA_LANGUAGES = ("en", )
+DEFAULT_SCHEMES = ("http", "https")
+
+WIKIPEDIA_LANGUAGE = re.compile("^https?://([a-z]{2})[.]wikipedia[.]org/")
+# hrefs with a host, which only depend on the scheme of the base
+ABSOLUTE = re.compile(r"([A-Za-z][A-Za-z0-9+.-]*:)?//[^/?#]")
+# scheme & authority of a base URL
+ORIGIN = re.compile(r"[^:/?#]+://[^/?#]*")
+
+
+class LinkNormalizer:
+    """
+    Turns the hrefs of a page into the absolute, normalized URLs to follow
+
+    Results are cached, since the navigation of a site links to the same
+    pages from all of its documents. The key only holds the part of the base
+    that the result depends on, see `key`, so that it is shared by the pages
+    of a site. Links are dropped if they
+    - only point to a fragment of the same page (unless `skip_fragments` is
+      false, then they point to the page itself), fragments are always
+      removed otherwise
+    - don't use one of `schemes`
+    - point to a Wikipedia that isn't in `wikipedia_languages`, `None`
+      follows all of them
+    """
+    def __init__(
+        self,
+        size=DEFAULT_LINK_CACHE_SIZE,
+        schemes=DEFAULT_SCHEMES,
+        wikipedia_languages=DEFAULT_WIKIPEDIA_LANGUAGES,
+        skip_fragments=True
+    ):
+        self.size = size
+        self.schemes = frozenset(scheme.lower() for scheme in schemes)
+        if wikipedia_languages is None:
+            self.wikipedia_languages = None
+        else:
+            self.wikipedia_languages = frozenset(wikipedia_languages)
+        self.skip_fragments = skip_fragments
+        # `None` for links that are filtered out
+        self.entries: OrderedDict[tuple[str, str], str | None] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def normalize(self, base: str, href: str | None) -> str | None:
+        """
+        The normalized URL `href` points to from `base`, `None` if filtered
+        """
+        if not href:
+            return None
+        key = self.key(base, href)
+        entries = self.entries
+        if key in entries:
+            self.hits += 1
+            entries.move_to_end(key)
+            return entries[key]
+        self.misses += 1
+        url = self.resolve(base, href)
+        entries[key] = url
+        if len(entries) > self.size:
+            entries.popitem(last=False)
+        return url
+
+
+    @staticmethod
+    def key(base: str, href: str) -> tuple[str, str]:
+        """
+        Cache key of a link, with as little of `base` as `resolve` needs
+        """
+        if ABSOLUTE.match(href):
+            # the scheme of the base is taken by protocol-relative hrefs &
+            # `urljoin` only removes dot segments if the schemes are equal
+            return (base.partition(":")[0], href)
+        if href[0] == "/" and href[1:2] != "/" and (m := ORIGIN.match(base)):
+            # root-relative, "//" without a host keeps the path of the base
+            return (m.group(), href)
+        return (base, href)
+
+
+    def normalize_all(self, base: str, hrefs) -> list[str]:
+        """
+        The normalized URLs of all links of a page in order, filtered ones
+        left out
+
+        Parameters:
+        base (str): URL of the page the links are on.
+        hrefs (Iterable[str | None]): The links as they appear on the page.
+
+        Returns:
+        list[str]: The URLs to follow, with duplicates.
+        """
+        normalize = self.normalize
+        return [
+            url
+            for href in hrefs
+            if (url := normalize(base, href)) is not None
+        ]
+
+
+    def resolve(self, base: str, href: str) -> str | None:
+        """
+        Uncached `normalize`
+        """
+        if href[0] == "#" and self.skip_fragments:
+            return None
+        absolute = urljoin(base, urldefrag(href).url)
+        scheme, colon, _ = absolute.partition(":")
+        if not colon or scheme.lower() not in self.schemes:
+            return None
+        url = normalize_url(absolute)
+        if self.wikipedia_languages is not None:
+            m = WIKIPEDIA_LANGUAGE.match(url)
+            if m and m.group(1) not in self.wikipedia_languages:
+                return None
+        return url
+
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
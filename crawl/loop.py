@@ -1,3 +1,7 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import heapq
 import multiprocessing as mp
 from multiprocessing.connection import Connection, wait
 import time
@@ -5,35 +9,143 @@ import time
 import apsw
 
 from crawl import DEFAULT_HOSTS_DB
+from crawl.compress import DEFAULT_CODEC
+from crawl.dedup import SimhashIndex
 from crawl.document import Document
+from crawl.extract import DEFAULT_PARSER
+from crawl.process import should_crawl
 from crawl.queue import Queue
-from crawl.request import Request, Status
-from crawl.robots import can_crawl, Host, get_host
+from crawl.request import MAX_CONTENT_SIZE, Request, Status
+from crawl.robots import Host, HostCache, RobotsPrefetcher, get_host
+from crawl.seen import DEFAULT_SEEN_CAPACITY, DEFAULT_SEEN_ERROR_RATE, SeenFilter
 
-class QueueEmpty(Exception):
-    pass
+# maximum number of URLs buffered in the per-host queues
+BACK_QUEUE_CAPACITY = 5000
+# maximum number of URLs buffered per host, the rest waits in the frontier so
+# that a host with many queued URLs can't crowd out all others
+HOST_QUEUE_CAPACITY = 100
+# frontier entries looked at by one refill, & seconds to wait before looking
+# again when none of them could be buffered
+REFILL_SCAN = 20_000
+REFILL_INTERVAL = 1.0
 
+# minimum seconds between looking for pages that are due for a recrawl
+RECRAWL_CHECK_INTERVAL = 600.0
 
+# minimum seconds between status lines
+STATUS_INTERVAL = 0.5
+
+# seconds to wait when only hosts whose robots.txt is being fetched have URLs
+ROBOTS_WAIT = 0.1
+
+DEFAULT_WORKER_COUNT = 8
+# requests in flight at the same time in the async engine
+DEFAULT_CONCURRENCY = 256
 
 
 # type of messages sent from crawler to workers
-#   - Request & Host for which robots.txt needs to be fetched first
 #   - Request that needs to be made
 #   - Document that needs to be parsed
-#   - Document whose links need to be extracted
 #   - amount of seconds to sleep until new work
-#type Work = tuple[Request, Host] | Request | Document | float
+#type Work = Request | Document | float
 
-#type Result = tuple[Request, Host] | Request | Document | list[str] | None
+#type Result = Request | Document | None
 
 class Crawler:
-    def __init__(self, crawl_db: str, hosts_db: str) -> None:
+    def __init__(
+        self,
+        crawl_db: str,
+        hosts_db: str,
+        seen_capacity: int = DEFAULT_SEEN_CAPACITY,
+        seen_error_rate: float = DEFAULT_SEEN_ERROR_RATE,
+        seen_file: bool = True,
+        simhash_file: bool = True,
+        max_size: int = MAX_CONTENT_SIZE,
+        recrawl_days: float | None = None,
+        compression: str | None = DEFAULT_CODEC,
+        parser: str = DEFAULT_PARSER
+    ) -> None:
         self.crawl_db = apsw.Connection(crawl_db)
         self.hosts_db = Host.open_db(hosts_db)
+        self.host_cache = HostCache(self.hosts_db)
+        # robots.txt are fetched in the background, ahead of the requests
+        self.prefetcher = RobotsPrefetcher(self.host_cache)
+        self.max_size = max_size
+        self.compression = compression
+        self.parser = parser
+        # revisit pages after this many days, with conditional requests
+        self.recrawl_days = recrawl_days
+        self.recrawl_checked = 0.0
+        # the dispatcher commits after every result, don't wait for fsync
+        # each time (still durable with WAL, except on power loss)
+        for con in (self.crawl_db, self.hosts_db):
+            con.execute("PRAGMA synchronous = NORMAL")
+        # stored next to the crawler database so restarts don't have to
+        # re-read the whole `url` table
+        self.seen_path = crawl_db + ".seen" if seen_file else None
         self.queue = Queue(self.crawl_db)
+        if self.seen_path:
+            seen = SeenFilter.load(
+                self.seen_path,
+                self.crawl_db,
+                seen_capacity,
+                seen_error_rate
+            )
+        else:
+            seen = SeenFilter(seen_capacity, seen_error_rate)
+            seen.catch_up(self.crawl_db)
+        print(f"seen URL filter uses {seen.memory() / 2**20:.1f} MiB")
+        self.queue.seen = seen
+        # fingerprints of the stored documents, for finding near duplicates
+        # without comparing against all of them
+        self.simhash_path = crawl_db + ".simhash" if simhash_file else None
+        if self.simhash_path:
+            self.simhash_index = SimhashIndex.load(
+                self.simhash_path,
+                self.crawl_db
+            )
+        else:
+            self.simhash_index = SimhashIndex()
+            self.simhash_index.catch_up(self.crawl_db)
 
+        # Mercator-style back queues: URLs from the frontier are sorted into
+        # one FIFO per host, hosts are handed out by the time their next
+        # token becomes available
+        self.back_queues: dict[str, deque[Request]] = {}
+        self.hosts: dict[str, Host] = {}
+        # heap of (next allowed time, origin), only contains hosts with
+        # queued URLs & known robots.txt
+        self.ready: list[tuple[float, str]] = []
+        self.buffered = 0
+        # buffered URLs stay in the frontier until they are dispatched, so
+        # that they aren't lost if the crawler is killed
+        self.buffered_urls: set[str] = set()
+        # position up to which the frontier has been scanned, `None` to start
+        # over from its head
+        self.scan_position: int | None = None
+        self.refill_paused_until = 0.0
+        # requests made since starting, `run` stops after `limit` of them
+        self.requests_made = 0
+        self.limit = None
+        self.status_printed = 0.0
+        # documents found irrelevant without lemmatizing them
+        self.prefiltered = 0
 
-    def start(self, worker_count=8):
+
+    def close(self):
+        # the URLs in the back queues are still in the frontier
+        self.back_queues.clear()
+        self.buffered_urls.clear()
+        self.buffered = 0
+        self.host_cache.checkpoint(force=True)
+        self.prefetcher.close()
+        if self.seen_path and self.queue.seen is not None:
+            self.queue.seen.save(self.seen_path, self.crawl_db)
+        if self.simhash_path:
+            self.simhash_index.save(self.simhash_path, self.crawl_db)
+
+
+    def start(self, worker_count=DEFAULT_WORKER_COUNT):
         self.workers = []
         self.pipes = []
         for _ in range(worker_count):
@@ -41,7 +153,6 @@ class Crawler:
             w = mp.Process(target=Crawler.worker, args=[their], daemon=True)
             w.start()
             self.workers.append(w)
-            # TODO: this breaks if the frontier is shorter than worker_count
             self.give_work(our)
             self.pipes.append(our)
 
@@ -49,7 +160,7 @@ class Crawler:
     @staticmethod
     def worker(pipe: Connection):
         try:
-            while work := pipe.recv():
+            while (work := pipe.recv()) is not None:
                 result = Crawler.work(work)
                 pipe.send(result)
         except KeyboardInterrupt:
@@ -58,25 +169,19 @@ class Crawler:
     @staticmethod
     def work(work):
         match work:
-            case req, host if type(req) == Request and type(host) == Host:
-                # fetch robots.txt
-                host.fetch()
-                return (req, host)
             case request if type(request) == Request:
                 # make the request
                 request.make()
                 return request
             case document if type(document) == Document:
-                if not document.parsed:
-                    # parse the document & calculate relevance
-                    document.parse()
+                # parse the document, calculate relevance & extract links
+                # in one pass, only the relevant links are sent back
+                document.parse()
+                # only relevant documents are checked for near duplicates
+                if document.is_relevant():
                     document.simhash()
-                    # TODO: could skip calculating relevance if duplicate
-                    document.relevance()
-                    return document
-                else:
-                    # extract links
-                    return list(document.links())
+                document.strip()
+                return document
             case idle_for if type(idle_for) == float:
                 print(f"idling for {idle_for}s")
                 time.sleep(idle_for)
@@ -86,118 +191,211 @@ class Crawler:
 
 
     def give_work(self, pipe: Connection):
-        try:
-            # TODO: count skips and give up eventually
-            skips = 0
-            while (work := self.next_url()) == None:
-                skips += 1
-            if skips > 30:
-                print(f"Skipped {skips} URLs to get work")
-            #print(f"got work after {skips} skips")
+        if work := self.next_work():
             pipe.send(work)
-        except QueueEmpty:
-            now_ish = time.time()
-            rows = self.crawl_db.execute(
-                "SELECT url_id, MAX(time) \
-                FROM request \
-                GROUP BY url_id \
-                HAVING TYPEOF(status) == 'real' \
-                AND status < ?1",
-                [now_ish]
-            ).fetchall()
-            queued = 0
-            for url_id, _ in rows:
-                assert type(url_id) == int
-                self.queue.push_id(url_id)
-                queued += 1
-            if queued == 0:
-                # stalled, wait for next token to become available
-                res = self.crawl_db.execute(
-                    "SELECT status, MAX(time) \
-                    FROM request \
-                    GROUP BY url_id \
-                    HAVING TYPEOF(status) = 'real' \
-                    ORDER BY status ASC \
-                    LIMIT 1"
-                ).fetchone()
-                if not res:
-                    #print("completely done!")
-                    #raise QueueEmpty
-                    pipe.send(3.0)
-                else:
-                    (soonest, ) = res
-                    assert type(soonest) == float
-                    pipe.send(soonest - now_ish)
+            return
+        if self.buffered > 0:
+            if self.ready:
+                # all hosts with queued URLs are throttled
+                pipe.send(max(self.ready[0][0] - time.time(), 0.0))
             else:
-                self.give_work(pipe)
+                # their robots.txt haven't arrived yet
+                pipe.send(ROBOTS_WAIT)
+            return
+
+        now_ish = time.time()
+        if self.queue.requeue_due(now_ish) > 0 or self.queue_recrawls(now_ish):
+            self.give_work(pipe)
+        elif (soonest := self.queue.next_due()) is None:
+            #print("completely done!")
+            pipe.send(3.0)
+        else:
+            # stalled, wait for the next deferred URL to become ready
+            pipe.send(max(soonest - now_ish, 0.0))
 
 
+    def queue_recrawls(self, now: float) -> bool:
+        """
+        Queue pages that are due for a recrawl, at most every RECRAWL_CHECK_INTERVAL
+        """
+        if self.recrawl_days is None:
+            return False
+        if now - self.recrawl_checked < RECRAWL_CHECK_INTERVAL:
+            return False
+        self.recrawl_checked = now
+        before = now - self.recrawl_days * 24 * 60 * 60
+        return self.queue.push_due_recrawls(before) > 0
 
-    def next_url(self) -> tuple[Request, Host] | Request | None:
-        url = self.queue.pop()
-        if not url:
-            raise QueueEmpty
+
+    def refill(self):
+        """
+        Buffer URLs from the frontier in the back queues of their hosts, at
+        most `HOST_QUEUE_CAPACITY` per host
+        """
+        # refill in bulk once half of the back queue capacity is used up
+        if self.buffered > BACK_QUEUE_CAPACITY // 2:
+            return
+        if time.time() < self.refill_paused_until:
+            return
+        before = self.buffered
+        scanned = 0
+        while self.buffered < BACK_QUEUE_CAPACITY and scanned < REFILL_SCAN:
+            from_head = self.scan_position is None
+            entries = self.queue.scan(self.scan_position, BACK_QUEUE_CAPACITY)
+            scanned += len(entries)
+            for position, url in entries:
+                if self.buffered >= BACK_QUEUE_CAPACITY:
+                    return
+                self.scan_position = position
+                self.buffer(url)
+            if len(entries) < BACK_QUEUE_CAPACITY:
+                # end of the frontier, hosts that were full may have room for
+                # the URLs at its head again
+                self.scan_position = None
+                if from_head:
+                    break
+        if self.buffered == before and self.buffered > 0:
+            # only hosts with full queues left, don't scan the frontier for
+            # every request
+            self.refill_paused_until = time.time() + REFILL_INTERVAL
+
+
+    def buffer(self, url: str):
+        """
+        Add a frontier entry to the back queue of its host, unless it is full
+        """
+        if url in self.buffered_urls:
+            return
+        origin = get_host(url)
+        back_queue = self.back_queues.get(origin)
+        if back_queue is not None and len(back_queue) >= HOST_QUEUE_CAPACITY:
+            return
         req = Request(url)
         match req.check_status(self.crawl_db):
-            case Status.PROHIBITED | Status.TIMEOUT | Status.FAILED as s:
-                #print(f"{url} previously not fetched ({s.name})")
-                return None
-            case status if type(status) == Status:
+            case Status() if self.recrawl_days is not None and should_crawl(
+                self.crawl_db,
+                url,
+                self.recrawl_days
+            ):
+                # only download it again if it changed
+                req.load_validators(self.crawl_db)
+            case Status() as status:
                 #print(f"{url} already fetched with status {status}")
-                return None
-            case limited if type(limited) == float and limited > time.time():
-                #print(f"{url} throttled for another {limited - time.time()}s")
-                #TOOD remove this now==
-                self.queue.push(url)
-                return None
-        host = Host(get_host(url))
-        if host.try_load(self.hosts_db):
-            return self.try_request(req, host)
+                self.queue.remove(url)
+                return
+            case float() as limited if limited > time.time():
+                # throttled by a previous run, defer until then
+                with self.crawl_db:
+                    self.queue.defer(url, limited)
+                    self.queue.remove(url)
+                return
+        if back_queue is None:
+            back_queue = self.back_queues[origin] = deque()
+            # otherwise scheduled once its robots.txt is collected
+            if host := self.prefetcher.check(origin):
+                self.hosts[origin] = host
+                heapq.heappush(self.ready, (host.next_token_time(), origin))
+        back_queue.append(req)
+        self.buffered_urls.add(url)
+        self.buffered += 1
+
+
+    def schedule(self, origin: str):
+        """
+        Put the host back on the heap, or drop its back queue if it is empty
+        """
+        if self.back_queues[origin]:
+            host = self.hosts[origin]
+            heapq.heappush(self.ready, (host.next_token_time(), origin))
         else:
-            return (req, host)
+            del self.back_queues[origin]
+            del self.hosts[origin]
+
+
+    def collect_robots(self):
+        """
+        Store fetched robots.txt & schedule the hosts that were waiting for them
+        """
+        for host in self.prefetcher.collect():
+            if host.origin not in self.back_queues:
+                continue
+            if host.origin not in self.hosts:
+                heapq.heappush(
+                    self.ready,
+                    (host.next_token_time(), host.origin)
+                )
+            self.hosts[host.origin] = host
+
+
+    def next_work(self) -> Request | None:
+        """
+        Get a request for a host that can be crawled right now
+        """
+        self.refill()
+        while self.ready and self.ready[0][0] <= time.time():
+            _, origin = heapq.heappop(self.ready)
+            req = self.back_queues[origin].popleft()
+            self.buffered -= 1
+            work = self.try_request(req, self.hosts[origin])
+            self.schedule(origin)
+            if work:
+                return work
+        return None
 
 
     def try_request(self, req: Request, host: Host) -> Request | None:
-        res = host.try_take_token(self.hosts_db, req.url)
+        res = self.host_cache.try_take_token(host, req.url)
         if type(res) == float:
             #print(f"host rate-limited for {res}s")
-            Request.rate_limited(req.url, res).save(self.crawl_db)
-            self.queue.push(req.url)
-            #return False
+            # keep its place at the head of the back queue
+            self.back_queues[host.origin].appendleft(req)
+            self.buffered += 1
         elif res != True:
-            Request.prohibited(req.url).save(self.crawl_db)
+            with self.crawl_db:
+                Request.prohibited(req.url).save(self.crawl_db)
+                self.queue.remove(req.url)
+            self.buffered_urls.discard(req.url)
             #print(f"crawling prohibited for {url}")
-            #return True
         else:
+            # dispatched, a crash from here on loses the URL like a failed
+            # request
+            self.queue.remove(req.url)
+            self.buffered_urls.discard(req.url)
+            req.origin = host.origin
+            req.refill_rate = host.refill_rate
+            req.max_size = self.max_size
+            req.compression = self.compression
             return req
 
 
     def handle_result(self, pipe: Connection, result):
+        # persist the token buckets every CHECKPOINT_INTERVAL seconds
+        self.host_cache.checkpoint()
+        self.collect_robots()
         match result:
-            case req, host if type(req) == Request and type(host) == Host:
-                # store robots.txt & get token
-                host.store(self.hosts_db)
-                if req := self.try_request(req, host):
-                    pipe.send(req)
-                    return
             case request if type(request) == Request:
-                # save the request
+                # save the request, exact duplicates of a stored body
+                # have no document & aren't parsed again
                 request.save(self.crawl_db)
+                self.requests_made += 1
                 if doc := request.document():
+                    doc.parser = self.parser
                     pipe.send(doc)
                     return
             case document if type(document) == Document:
+                self.prefiltered += document.prefiltered
                 if document.is_relevant():
                     # store the document & check for duplicates
                     # TODO: save dupes also? as reference to the original?
-                    if not document.check_for_duplicates(self.crawl_db):
-                        document.save(self.crawl_db)
-                        pipe.send(document)
-                        return
-            case links if type(links) == list:
-                # TODO: implement batched queuing
-                for link in links:
-                    self.queue.push_if_new(link)
+                    if not document.check_for_duplicates(
+                        self.crawl_db,
+                        self.simhash_index
+                    ):
+                        document.save(self.crawl_db, self.simhash_index)
+                        new = self.queue.push_many_if_new(document.links())
+                        # robots.txt of new hosts are ready by the time
+                        # they're popped
+                        self.prefetcher.watch(new)
             case None:
                 # worker finished idling, try to give new work
                 pass
@@ -207,20 +405,34 @@ class Crawler:
         self.give_work(pipe)
 
 
-    def run(self):
-        while self.pipes:
+    def done(self) -> bool:
+        return self.limit is not None and self.requests_made >= self.limit
+
+
+    def print_status(self):
+        # gathering the stats scans the request table, don't do it too often
+        now = time.time()
+        if now - self.status_printed < STATUS_INTERVAL:
+            return
+        self.status_printed = now
+        q_size = len(self.queue)
+        avg, rate, ok, failed, timed_out, prohibited = Request.stats(
+            self.crawl_db
+        )
+        print(
+            f"\r{rate:.4f} req/s, {avg or 0.0:.4f} s/req, {q_size} queued,",
+            f"{failed: 3} / {timed_out: 3} / {prohibited: 3} (f/t/p),",
+            f"{ok: 4} ok, {self.prefiltered} prefiltered ",
+            flush=True,
+            end=""
+        )
+
+
+    def run(self, limit: int | None = None):
+        self.limit = limit
+        while self.pipes and not self.done():
             for pipe in wait(self.pipes):
-                q_size = len(Queue(self.crawl_db))
-                avg, rate, ok, failed, timed_out, prohibited = Request.stats(
-                    self.crawl_db
-                )
-                print(
-                    f"\r{rate:.4f} req/s, {avg:.4f} s/req, {q_size} queued,",
-                    f"{failed: 3} / {timed_out: 3} / {prohibited: 3} (f/t/p),",
-                    f"{ok: 4} ok ",
-                    flush=True,
-                    end=""
-                )
+                self.print_status()
                 assert type(pipe) == Connection
                 assert pipe.poll()
                 try:
@@ -231,3 +443,85 @@ class Crawler:
                     self.handle_result(pipe, result)
 
 
+class Slot:
+    """
+    Stand-in for a worker pipe in the async engine, holds the next work
+    """
+    def __init__(self):
+        self.work = None
+
+
+    def send(self, work):
+        self.work = work
+
+
+class AsyncCrawler(Crawler):
+    """
+    Crawler that dispatches from a single asyncio event loop
+
+    Each of the `concurrency` slots takes work from the dispatcher like a
+    worker process would & up to `concurrency` requests are in flight behind
+    a semaphore. The requests themselves are still the blocking
+    `Request.make`, run in a thread pool with one thread per slot, as there's
+    no async HTTP client among the dependencies. Documents are parsed in a
+    process pool.
+    """
+    def start(
+        self,
+        worker_count=DEFAULT_WORKER_COUNT,
+        concurrency=DEFAULT_CONCURRENCY
+    ):
+        self.worker_count = worker_count
+        self.concurrency = concurrency
+
+
+    def run(self, limit: int | None = None):
+        self.limit = limit
+        asyncio.run(self.run_async())
+
+
+    async def run_async(self):
+        # set after every result, idle slots wake up early to look for work
+        self.wakeup = asyncio.Event()
+        self.in_flight = asyncio.Semaphore(self.concurrency)
+        with (
+            ThreadPoolExecutor(self.concurrency, "fetch") as self.fetch_pool,
+            ProcessPoolExecutor(self.worker_count) as self.parse_pool
+        ):
+            await asyncio.gather(
+                *(self.drive(Slot()) for _ in range(self.concurrency))
+            )
+
+
+    async def drive(self, slot: Slot):
+        self.give_work(slot)
+        while not self.done():
+            result = await self.work_async(slot.work)
+            self.print_status()
+            self.handle_result(slot, result)
+            self.wakeup.set()
+            self.wakeup = asyncio.Event()
+
+
+    async def work_async(self, work):
+        loop = asyncio.get_running_loop()
+        match work:
+            case idle_for if type(idle_for) == float:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), idle_for)
+                except TimeoutError:
+                    pass
+                return None
+            case document if type(document) == Document:
+                return await loop.run_in_executor(
+                    self.parse_pool,
+                    Crawler.work,
+                    document
+                )
+            case request:
+                async with self.in_flight:
+                    return await loop.run_in_executor(
+                        self.fetch_pool,
+                        Crawler.work,
+                        request
+                    )
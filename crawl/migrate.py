@@ -0,0 +1,211 @@
+import hashlib
+
+import apsw
+
+from crawl.compress import decompress
+
+# gap between the positions of consecutively pushed frontier entries,
+# leaves room for `Queue.insert` without renumbering the whole frontier
+POSITION_GAP = 1024
+
+
+def frontier_gaps(con: apsw.Connection):
+    """
+    Spread out frontier positions & keep track of the frontier size
+    """
+    # renumber via negative positions to avoid UNIQUE conflicts mid-update
+    con.execute(
+        "UPDATE frontier \
+        SET position = -1 - ranked.rank * ?1 \
+        FROM ( \
+            SELECT url_id, row_number() OVER (ORDER BY position) - 1 AS rank \
+            FROM frontier \
+        ) AS ranked \
+        WHERE frontier.url_id = ranked.url_id",
+        (POSITION_GAP, )
+    )
+    con.execute("UPDATE frontier SET position = -(position + 1)")
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS frontier_size ( \
+            size INTEGER NOT NULL \
+        ); \
+        INSERT INTO frontier_size (size) SELECT COUNT() FROM frontier; \
+        CREATE TRIGGER IF NOT EXISTS frontier_size_insert \
+        AFTER INSERT ON frontier BEGIN \
+            UPDATE frontier_size SET size = size + 1; \
+        END; \
+        CREATE TRIGGER IF NOT EXISTS frontier_size_delete \
+        AFTER DELETE ON frontier BEGIN \
+            UPDATE frontier_size SET size = size - 1; \
+        END;"
+    )
+
+
+def deferred(con: apsw.Connection):
+    """
+    Move rate-limited URLs out of the request history into their own table
+    """
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS deferred ( \
+            url_id INTEGER PRIMARY KEY, \
+            ready REAL NOT NULL, \
+            FOREIGN KEY(url_id) REFERENCES url \
+        ); \
+        CREATE INDEX IF NOT EXISTS deferred_ready ON deferred (ready);"
+    )
+    # URLs whose latest request is a rate limit & that aren't queued anyway
+    con.execute(
+        "INSERT INTO deferred (url_id, ready) \
+        SELECT url_id, status FROM ( \
+            SELECT url_id, status, MAX(time) \
+            FROM request \
+            GROUP BY url_id \
+        ) \
+        WHERE TYPEOF(status) = 'real' \
+        AND url_id NOT IN (SELECT url_id FROM frontier)"
+    )
+
+
+def request_url_index(con: apsw.Connection):
+    """
+    Index the request history by URL, to look up the latest request of a URL
+    """
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS request_url_time ON request (url_id, time)"
+    )
+
+
+def compression(con: apsw.Connection):
+    """
+    Keep track of how response bodies are compressed, see `crawl.compress`
+    """
+    con.execute(
+        "ALTER TABLE request ADD COLUMN encoding TEXT; \
+        CREATE TABLE IF NOT EXISTS compression_dict ( \
+            id INTEGER PRIMARY KEY, \
+            data BLOB NOT NULL \
+        );"
+    )
+
+
+def body_table(con: apsw.Connection):
+    """
+    Move response bodies out of the request history into a table keyed by
+    their digest, so that identical bodies are only stored once
+    """
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS body ( \
+            id INTEGER NOT NULL PRIMARY KEY, \
+            digest BLOB NOT NULL UNIQUE, \
+            data BLOB NOT NULL, \
+            encoding TEXT \
+        ) STRICT; \
+        ALTER TABLE request ADD COLUMN body_id INTEGER REFERENCES body;"
+    )
+    body_ids = {}
+    updates = []
+    for request_id, data, encoding in con.execute(
+        "SELECT id, data, encoding FROM request WHERE data IS NOT NULL"
+    ):
+        digest = hashlib.sha256(decompress(data, encoding, con)).digest()
+        if digest not in body_ids:
+            (body_ids[digest], ) = con.execute(
+                "INSERT INTO body (digest, data, encoding) \
+                VALUES (?1, ?2, ?3) \
+                RETURNING id",
+                (digest, data, encoding)
+            ).fetchone()
+        updates.append((body_ids[digest], request_id))
+    con.executemany(
+        "UPDATE request SET body_id = ?1 WHERE id = ?2",
+        updates
+    )
+    # columns can't be dropped while views use them
+    con.execute(
+        "DROP VIEW IF EXISTS request_urls; \
+        DROP VIEW IF EXISTS size_by_extension; \
+        ALTER TABLE request DROP COLUMN data; \
+        ALTER TABLE request DROP COLUMN encoding; \
+        CREATE VIEW request_urls AS \
+            SELECT \
+                request.id, \
+                url.url AS 'URL', \
+                time, \
+                duration, \
+                status, \
+                headers, \
+                body.data, \
+                body.encoding \
+            FROM request \
+            JOIN url ON url_id = url.id \
+            LEFT JOIN body ON body_id = body.id \
+            ORDER BY time; \
+        CREATE VIEW size_by_extension AS \
+            WITH extension AS ( \
+                SELECT \
+                    id, \
+                    CASE \
+                        WHEN substr(url, -4) LIKE '%/%' THEN NULL \
+                        WHEN url LIKE '%.___'  THEN substr(url, -3) \
+                        WHEN url LIKE '%.____' THEN substr(url, -4) \
+                    END AS extension \
+                FROM url \
+            ) \
+            SELECT \
+                extension, \
+                COUNT() AS 'count', \
+                SUM(length(data)) / COUNT() AS avg_size, \
+                SUM(length(data)) AS total \
+            FROM request \
+            JOIN extension on url_id = extension.id \
+            JOIN url on url_id = url.id \
+            LEFT JOIN body on body_id = body.id \
+            WHERE extension IS NOT NULL \
+            GROUP BY extension \
+            ORDER BY total DESC;"
+    )
+
+
+def current_documents(con: apsw.Connection):
+    """
+    Point every URL at its latest document, recrawls used to leave it unset
+    """
+    con.execute(
+        "UPDATE url SET document_id = latest.id \
+        FROM ( \
+            SELECT request.url_id, MAX(document.id) AS id \
+            FROM document \
+            JOIN request ON request_id = request.id \
+            GROUP BY request.url_id \
+        ) AS latest \
+        WHERE url.id = latest.url_id"
+    )
+
+
+# migration `i` upgrades a crawler database from `user_version` i to i + 1
+MIGRATIONS = [
+    frontier_gaps,
+    deferred,
+    request_url_index,
+    compression,
+    body_table,
+    current_documents,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(con: apsw.Connection) -> int:
+    '''
+    Bring a crawler database created by an older `crawler.sql` up to date.
+
+    Returns:
+    int: The number of migrations that were applied.
+    '''
+    (version, ) = con.execute("PRAGMA user_version").fetchone()
+    for i, migration in enumerate(MIGRATIONS[version:], start=version):
+        print(f"migrating crawler database to version {i + 1}")
+        with con:
+            migration(con)
+            con.execute(f"PRAGMA user_version = {i + 1}")
+    return max(SCHEMA_VERSION - version, 0)
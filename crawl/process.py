@@ -3,13 +3,9 @@ import math
 from collections import Counter
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import cache
 from bs4 import BeautifulSoup
-import nltk
-from nltk.corpus import stopwords, wordnet
-from nltk.stem import WordNetLemmatizer
-from nltk.chunk import ne_chunk
-from nltk.tokenize import word_tokenize
-from nltk.tree import Tree
+import numpy as np
 from url_normalize import url_normalize
 import re
 import apsw
@@ -100,24 +96,89 @@ def hash_shingle(shingle):
     return int(hashlib.md5(shingle.encode('utf-8')).hexdigest(), 16)
 
 
-def compute_simhash(texts, k=5):
+# how shingles are hashed: MD5 is what the stored fingerprints use, FNV-1a
+# is cheaper but gives different fingerprints, so one database can't mix them
+SIMHASH_HASHES = ("md5", "fnv")
+DEFAULT_SIMHASH_HASH = "md5"
+# shingles whose bits are unpacked at once, 128 bytes each
+SIMHASH_CHUNK = 1 << 16
+
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+# seeds of the two 64-bit halves derived from the FNV-1a hash
+FNV_SEEDS = (np.uint64(0x9e3779b97f4a7c15), np.uint64(0xc2b2ae3d27d4eb4f))
+
+
+def md5_digests(shingles) -> np.ndarray:
+    """
+    MD5 of every shingle as a row of 16 bytes, like `hash_shingle`
+    """
+    md5 = hashlib.md5
+    digests = b"".join(md5(sh.encode('utf-8')).digest() for sh in shingles)
+    return np.frombuffer(digests, dtype=np.uint8).reshape(-1, 16)
+
+
+def fmix64(h: np.ndarray) -> np.ndarray:
+    # MurmurHash3 finalizer, spreads every input bit over all output bits
+    h = h ^ (h >> np.uint64(33))
+    h = h * np.uint64(0xff51afd7ed558ccd)
+    h = h ^ (h >> np.uint64(33))
+    h = h * np.uint64(0xc4ceb9fe1a85ec53)
+    return h ^ (h >> np.uint64(33))
+
+
+def fnv_digests(shingles, k: int) -> np.ndarray:
+    """
+    128 bits per shingle as a row of 16 bytes, hashing all shingles at once
+
+    FNV-1a over the code points of the shingles, the two halves are the
+    hash mixed with different seeds.
+    """
+    shingles = list(shingles)
+    if not shingles:
+        return np.empty((0, 16), dtype=np.uint8)
+    # shorter shingles are padded with zeros
+    points = np.array(shingles, dtype=f"<U{k}").view(np.uint32)
+    points = points.reshape(len(shingles), k).astype(np.uint64)
+    h = np.full(len(shingles), FNV_OFFSET)
+    with np.errstate(over='ignore'):
+        for column in points.T:
+            h = (h ^ column) * FNV_PRIME
+        halves = [fmix64(h ^ seed) for seed in FNV_SEEDS]
+    return np.stack(halves, axis=1).astype(">u8").view(np.uint8)
+
+
+def compute_simhash(texts, k=5, hash=DEFAULT_SIMHASH_HASH):
+    """
+    128-bit simhash of the k-character shingles of the texts
+
+    Every shingle votes for each bit of the fingerprint with its hash: bits
+    that are set in at least half of the hashes are set in the fingerprint.
+
+    Parameters:
+    texts (Iterable[str]): The texts of the document.
+    k (int): Length of the shingles.
+    hash (str): One of `SIMHASH_HASHES`.
+
+    Returns:
+    int: The fingerprint, bit i is bit i of the shingle hashes.
+    """
     shingles = set()
     for text in texts:
         shingles.update(shingle(text, k))
-    v = [0] * 128
-    for sh in shingles:
-        h = hash_shingle(sh)
-        for i in range(128):
-            bitmask = 1 << i
-            if h & bitmask:
-                v[i] += 1
-            else:
-                v[i] -= 1
-    fingerprint = 0
-    for i in range(128):
-        if v[i] >= 0:
-            fingerprint |= 1 << i
-    return fingerprint
+    if hash == "md5":
+        digests = md5_digests(shingles)
+    elif hash == "fnv":
+        digests = fnv_digests(shingles, k)
+    else:
+        raise Exception(f"unknown simhash hash {hash}")
+    # the digests are big-endian, column 0 is bit 127
+    ones = np.zeros(128, dtype=np.int64)
+    for start in range(0, len(digests), SIMHASH_CHUNK):
+        bits = np.unpackbits(digests[start:start + SIMHASH_CHUNK], axis=1)
+        ones += bits.sum(axis=0, dtype=np.int64)
+    fingerprint = np.packbits(2 * ones >= len(digests))
+    return int.from_bytes(fingerprint.tobytes(), byteorder='big')
 
 
 def hamming_distance(x, y):
@@ -125,7 +186,9 @@ def hamming_distance(x, y):
 
 
 #TODO:set appropiate treshold (might need some more testing)
-def is_near_duplicate_simhash(simhash1, simhash2, threshold=15):
+SIMHASH_THRESHOLD = 15
+
+def is_near_duplicate_simhash(simhash1, simhash2, threshold=SIMHASH_THRESHOLD):
     return hamming_distance(simhash1, simhash2) <= threshold
 
 
@@ -156,54 +219,157 @@ def normalize_url(url):
     return url_normalize(url)
 
 
-#WARNING: Hasn't been tested yet
 def should_crawl(con, url, recrawl_interval_days=30):
     '''
     Determines if the given URL should be crawled based on whether it has been previously crawled
-    and the time since it was last modified or fetched.
+    and the time since it was last fetched successfully.
 
     Parameters:
-    con (sqlite3.Connection): Active SQLite database connection.
+    con (apsw.Connection): Connection to the crawler database.
     url (str): The URL to be checked.
-    recrawl_interval_days (int): The interval in days after which a URL should be recrawled. Default is 30 days.
+    recrawl_interval_days (float): The interval in days after which a URL should be recrawled. Default is 30 days.
 
     Returns:
     bool: True if the URL should be crawled, False otherwise.
     '''
-    cur = con.cursor()
-    cur.execute(
-        "SELECT document_id, (SELECT last_modified FROM document WHERE id = document_id) FROM url WHERE url = ?",
-        (url,))
-    result = cur.fetchone()
+    result = con.execute(
+        "SELECT request.time, status FROM request \
+        JOIN url ON url_id = url.id \
+        WHERE url = ?1 AND TYPEOF(status) = 'integer' \
+        ORDER BY request.time DESC \
+        LIMIT 1",
+        (url, )
+    ).fetchone()
 
     if result:
-        document_id, last_modified = result
-        if document_id:
-            if last_modified:
-                last_modified_date = datetime.fromtimestamp(last_modified)
-                if datetime.now() - last_modified_date > timedelta(days=recrawl_interval_days):
-                    return True
-            else:
-                cur.execute("SELECT fetched FROM document WHERE id = ?", (document_id,))
-                fetched = cur.fetchone()[0]
-                fetched_date = datetime.fromtimestamp(fetched)
-                if datetime.now() - fetched_date > timedelta(days=recrawl_interval_days):
-                    return True
+        fetched, status = result
+        # only revisit pages that could be fetched, or haven't changed
+        if not (200 <= status < 300 or status == 304):
             return False
+        fetched_date = datetime.fromtimestamp(fetched)
+        return datetime.now() - fetched_date > timedelta(days=recrawl_interval_days)
     return True
 
 
-lemmatizer = WordNetLemmatizer()
-stop_words = set(stopwords.words('english'))
+# NLTK takes a while to import & its corpora to load, so that only happens
+# once something needs them: crawling & indexing need the lemmatizer & the
+# stop words, the tagger & NE chunker are only used for long queries
+
+@cache
+def lemmatizer():
+    from nltk.stem import WordNetLemmatizer
+    return WordNetLemmatizer()
+
+
+@cache
+def stop_words() -> frozenset[str]:
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words('english'))
+
+
+# number of words whose lemma is kept in memory
+LEMMA_CACHE_SIZE = 500_000
+LEMMA_TABLE_SQL = 'CREATE TABLE IF NOT EXISTS "lemma" ( \
+    "word"  TEXT NOT NULL PRIMARY KEY, \
+    "lemma" TEXT NOT NULL \
+) WITHOUT ROWID'
+
+
+class LemmaCache:
+    """
+    Bounded memo of `lemmatizer().lemmatize`
+
+    Word frequencies follow Zipf's law, so almost every token of a document
+    or query is a word that was lemmatized before. When full, the oldest
+    entry is evicted, frequent words are back in no time. The entries can be
+    stored in & loaded from the `lemma` table of an index database.
+    """
+    def __init__(self, size=LEMMA_CACHE_SIZE):
+        self.size = size
+        self.entries: dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def lemmatize_all(self, words: list[str]) -> list[str]:
+        entries = self.entries
+        lemmas = [entries.get(word) for word in words]
+        misses = 0
+        for i, lemma in enumerate(lemmas):
+            if lemma is None:
+                # the same word may be missing several times in one text
+                lemma = entries.get(words[i])
+                if lemma is None:
+                    misses += 1
+                    lemma = self.put(words[i], lemmatizer().lemmatize(words[i]))
+                lemmas[i] = lemma
+        self.misses += misses
+        self.hits += len(words) - misses
+        return lemmas
+
+
+    def put(self, word: str, lemma: str) -> str:
+        if len(self.entries) >= self.size:
+            del self.entries[next(iter(self.entries))]
+        self.entries[word] = lemma
+        return lemma
+
+
+    def load(self, con: apsw.Connection) -> int:
+        """
+        Fill the cache from the `lemma` table, if the database has one
+
+        Returns:
+        int: The number of entries loaded.
+        """
+        exists = con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'lemma'"
+        ).fetchone()
+        if not exists:
+            return 0
+        loaded = 0
+        for word, lemma in con.execute(
+            "SELECT word, lemma FROM lemma LIMIT ?1",
+            (self.size, )
+        ):
+            self.put(word, lemma)
+            loaded += 1
+        return loaded
+
+
+    def store(self, con: apsw.Connection):
+        """
+        Write the cached entries to the `lemma` table, creating it if needed
+        """
+        with con:
+            con.execute(LEMMA_TABLE_SQL)
+            con.executemany(
+                "INSERT OR REPLACE INTO lemma (word, lemma) VALUES (?1, ?2)",
+                self.entries.items()
+            )
+
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# per process, shared by relevance scoring, indexing & queries
+lemma_cache = LemmaCache()
 
 def preprocess_text(text):
     low = text.lower()
     words = re.findall(r'\b\w+\b', low)
-    stemmed_words = [lemmatizer.lemmatize(word) for word in words]
-    filtered_words = [word for word in stemmed_words if word not in stop_words]
+    stemmed_words = lemma_cache.lemmatize_all(words)
+    stop = stop_words()
+    filtered_words = [word for word in stemmed_words if word not in stop]
     return filtered_words
 
 def find_synonyms(word, max_terms_per_token=3):
+    from nltk.corpus import wordnet
     synonyms = set()
     for syn in wordnet.synsets(word, lang='eng'):
         for lemma in syn.lemmas(lang='eng'):
@@ -216,9 +382,11 @@ def find_synonyms(word, max_terms_per_token=3):
     return list(synonyms)
 
 def named_entities_nltk(text):
-    tokens = word_tokenize(text)
+    import nltk
+    from nltk.tree import Tree
+    tokens = nltk.word_tokenize(text)
     tagged_tokens = nltk.pos_tag(tokens)
-    chunked_tokens = ne_chunk(tagged_tokens)
+    chunked_tokens = nltk.ne_chunk(tagged_tokens)
     entities = set()
     for chunk in chunked_tokens:
         if isinstance(chunk, Tree):
@@ -240,6 +408,7 @@ def term_priority(term, term_freq, named_entities):
     )
 
 def truncate_query(preprocessed_query, max_terms=20):
+    import nltk
     tagged_tokens = nltk.pos_tag(preprocessed_query)
     term_freq = Counter(preprocessed_query)
     
@@ -1,5 +1,9 @@
+import json
+
 import apsw
-import warnings
+
+from crawl.migrate import POSITION_GAP, migrate
+from crawl.seen import SeenFilter
 
 class Index:
     def __init__(self, db: apsw.Connection | str):
@@ -13,6 +17,18 @@ class Index:
 
 
 class Queue(Index):
+    def __init__(
+        self,
+        db: apsw.Connection | str,
+        seen: SeenFilter | None = None
+    ):
+        super().__init__(db)
+        migrate(self.con)
+        # optional filter of URLs in the `url` table, lets `push_many_if_new`
+        # skip the database for URLs that have probably been seen before
+        self.seen = seen
+
+
     def __iter__(self):
         return self
 
@@ -25,7 +41,7 @@ class Queue(Index):
 
 
     def __len__(self) -> int:
-        res = self.con.execute("SELECT COUNT() FROM frontier").fetchone()
+        res = self.con.execute("SELECT size FROM frontier_size").fetchone()
         assert res != None, "failed to determine frontier size"
         (count, ) = res
         assert type(count) == int, ("failed to determine frontier size")
@@ -37,6 +53,7 @@ class Queue(Index):
         Move all rows in the frontier >= `position` back by `amount`
 
         Negative `amount`s shift them forward.
+        Only needed by `insert` when there is no gap left between two entries.
         '''
         # push forward or back
         # can't be done in one statement due to this limitation:
@@ -66,7 +83,7 @@ class Queue(Index):
             id_and_position = self.con.execute(
                 "SELECT id, frontier.position FROM url \
                 FULL OUTER JOIN frontier ON url.id = frontier.url_id \
-                WHERE url.url LIKE ?1",
+                WHERE url.url = ?1",
                 (url, )
             ).fetchone()
             if id_and_position:
@@ -86,15 +103,17 @@ class Queue(Index):
                 assert self.con.changes() == 1, f"failed to store {url} in db"
                 assert res != None
                 (url_id, ) = res
+                if self.seen is not None:
+                    self.seen.add(url)
 
             # insert frontier entry at the end
             self.con.execute(
                 "INSERT INTO frontier (position, url_id) \
                 VALUES ( \
-                    IFNULL((SELECT max(position) + 1 FROM frontier), 0), \
+                    IFNULL((SELECT max(position) + ?2 FROM frontier), 0), \
                     ?1 \
                 )",
-                (url_id, )
+                (url_id, POSITION_GAP)
             )
 
 
@@ -103,10 +122,10 @@ class Queue(Index):
         self.con.execute(
             "INSERT INTO frontier (position, url_id) \
             VALUES ( \
-                IFNULL((SELECT max(position) + 1 FROM frontier), 0), \
+                IFNULL((SELECT max(position) + ?2 FROM frontier), 0), \
                 ?1 \
             )",
-            [url_id]
+            [url_id, POSITION_GAP]
         )
 
 
@@ -123,6 +142,8 @@ class Queue(Index):
                 RETURNING url.id",
                 (url, )
             ).fetchone()
+            if self.seen is not None:
+                self.seen.add(url)
             if self.con.changes() != 1:
                 # URL already exists, skip it
                 return
@@ -133,11 +154,144 @@ class Queue(Index):
             self.con.execute(
                 "INSERT INTO frontier (position, url_id) \
                 VALUES ( \
-                    IFNULL((SELECT max(position) + 1 FROM frontier), 0), \
+                    IFNULL((SELECT max(position) + ?2 FROM frontier), 0), \
                     ?1 \
                 )",
-                (url_id, )
+                (url_id, POSITION_GAP)
+            )
+
+
+    def push_many_if_new(self, urls) -> list[str]:
+        '''
+        Same as `push_if_new` for many URLs at once, using a single transaction.
+
+        Returns:
+        list[str]: The URLs that were new & got queued, in order.
+        '''
+        # drop duplicates, keeping the order
+        urls = list(dict.fromkeys(urls))
+        if self.seen is not None:
+            # only URLs that are definitely new need to reach the database
+            urls = [url for url in urls if url not in self.seen]
+        if not urls:
+            return []
+        with self.con:
+            # try to insert all URLs, only new ones are returned
+            # (`WHERE true` is needed to parse the upsert after a SELECT)
+            new = self.con.execute(
+                "INSERT INTO url (url) \
+                SELECT value FROM json_each(?1) WHERE true \
+                ON CONFLICT DO NOTHING \
+                RETURNING id, url",
+                (json.dumps(urls), )
+            ).fetchall()
+            # all of them are in the `url` table now
+            if self.seen is not None:
+                self.seen.update(urls)
+            if not new:
+                return []
+            # ids are handed out in insertion order, RETURNING order isn't guaranteed
+            new.sort()
+
+            # insert frontier entries at the end
+            (tail, ) = self.con.execute(
+                "SELECT max(position) FROM frontier"
+            ).fetchone()
+            start = 0 if tail is None else tail + POSITION_GAP
+            self.con.executemany(
+                "INSERT INTO frontier (position, url_id) VALUES (?1, ?2)",
+                (
+                    (start + i * POSITION_GAP, url_id)
+                    for i, (url_id, _) in enumerate(new)
+                )
+            )
+        return [url for _, url in new]
+
+
+    def defer(self, url: str, ready: float):
+        '''
+        Don't fetch the URL before `ready` (a timestamp), see `requeue_due`
+
+        Assumes the URL already exists in the `url` table.
+        '''
+        self.con.execute(
+            "INSERT INTO deferred (url_id, ready) \
+            SELECT id, ?2 FROM url WHERE url = ?1 \
+            ON CONFLICT (url_id) DO UPDATE SET ready = excluded.ready",
+            (url, ready)
+        )
+
+
+    def requeue_due(self, now: float) -> int:
+        '''
+        Move all deferred URLs that are ready by `now` to the end of the frontier
+
+        Returns:
+        int: The number of URLs that were requeued.
+        '''
+        with self.con:
+            rows = self.con.execute(
+                "DELETE FROM deferred WHERE ready <= ?1 \
+                RETURNING ready, url_id",
+                (now, )
+            ).fetchall()
+            if not rows:
+                return 0
+            rows.sort()
+            (tail, ) = self.con.execute(
+                "SELECT max(position) FROM frontier"
+            ).fetchone()
+            start = 0 if tail is None else tail + POSITION_GAP
+            # skip URLs that are queued already
+            self.con.executemany(
+                "INSERT OR IGNORE INTO frontier (position, url_id) \
+                VALUES (?1, ?2)",
+                (
+                    (start + i * POSITION_GAP, url_id)
+                    for i, (_, url_id) in enumerate(rows)
+                )
+            )
+        return len(rows)
+
+
+    def next_due(self) -> float | None:
+        '''
+        Time at which the next deferred URL becomes ready, `None` if there is none
+        '''
+        (ready, ) = self.con.execute(
+            "SELECT min(ready) FROM deferred"
+        ).fetchone()
+        return ready
+
+
+    def push_due_recrawls(self, before: float) -> int:
+        '''
+        Queue all URLs that were last fetched successfully before `before` (a timestamp)
+
+        Returns:
+        int: The number of URLs that were queued.
+        '''
+        with self.con:
+            (tail, ) = self.con.execute(
+                "SELECT max(position) FROM frontier"
+            ).fetchone()
+            start = 0 if tail is None else tail + POSITION_GAP
+            # skips URLs that are queued already
+            self.con.execute(
+                "INSERT OR IGNORE INTO frontier (position, url_id) \
+                SELECT ?2 + (row_number() OVER (ORDER BY time) - 1) * ?3, url_id \
+                FROM ( \
+                    SELECT url_id, status, MAX(time) AS time \
+                    FROM request \
+                    WHERE TYPEOF(status) = 'integer' \
+                    GROUP BY url_id \
+                ) \
+                WHERE (status BETWEEN 200 AND 299 OR status = 304) \
+                AND time < ?1 \
+                AND url_id NOT IN (SELECT url_id FROM deferred)",
+                (before, start, POSITION_GAP)
             )
+            return self.con.changes()
 
 
     def requeue_check(self, url: str) -> int | bool:
@@ -169,28 +323,75 @@ class Queue(Index):
 
 
     def pop(self) -> str | None:
+        # positions are indexed, so finding & removing the head is cheap
+        # the remaining entries keep their positions
         with self.con:
-            cur = self.con.cursor()
-            pos_and_url = cur.execute(
+            url = self.con.execute(
                 "DELETE FROM frontier \
                 WHERE position = (SELECT min(position) FROM frontier) \
-                RETURNING position, (SELECT url FROM url WHERE id = url_id)"
+                RETURNING (SELECT url FROM url WHERE id = url_id)"
             ).fetchone()
-            if pos_and_url:
-                pos, url = pos_and_url
-                if pos >= 0:
-                    #TODO: optimize by not shifting down after every single pop
-                    self.shift(cur, pos, -1)
-                else:
-                    warnings.warn(f"queue entry with negative position {pos}")
-                return url
+            if url:
+                return url[0]
             else:
                 return None
 
 
+    def pop_many(self, count: int) -> list[str]:
+        '''
+        Take up to `count` URLs from the head of the frontier, in order
+        '''
+        if count <= 0:
+            return []
+        with self.con:
+            rows = self.con.execute(
+                "DELETE FROM frontier \
+                WHERE position IN ( \
+                    SELECT position FROM frontier \
+                    ORDER BY position \
+                    LIMIT ?1 \
+                ) \
+                RETURNING position, (SELECT url FROM url WHERE id = url_id)",
+                (count, )
+            ).fetchall()
+        rows.sort()
+        return [url for _, url in rows]
+
+
+    def scan(self, after: int | None, count: int) -> list[tuple[int, str]]:
+        '''
+        Up to `count` entries of the frontier after `position`, or from its
+        head if `None`, in order without taking them out
+
+        Returns:
+        list[tuple[int, str]]: The positions & URLs.
+        '''
+        return self.con.execute(
+            "SELECT position, url FROM frontier \
+            JOIN url ON url_id = url.id \
+            WHERE position > ?1 \
+            ORDER BY position \
+            LIMIT ?2",
+            (-1 if after is None else after, count)
+        ).fetchall()
+
+
+    def remove(self, url: str):
+        '''
+        Take the URL out of the frontier, if it is queued
+        '''
+        self.con.execute(
+            "DELETE FROM frontier \
+            WHERE url_id = (SELECT id FROM url WHERE url = ?1)",
+            (url, )
+        )
+
+
     def insert(self, url, position):
         '''
-        Insert an URL into the `url` table and add it to the frontier at the given position, without creating gaps
+        Insert an URL into the `url` table and add it to the frontier so that it is preceded by `position` entries
+
+        Picks a position in the gap between its neighbours, only shifts the following entries if there is no space left.
         '''
         # TODO: normalize URL
         with self.con:
@@ -199,24 +400,19 @@ class Queue(Index):
             id_and_position = cur.execute(
                 "SELECT id, frontier.position FROM url \
                 FULL OUTER JOIN frontier ON url.id = frontier.url_id \
-                WHERE url.url LIKE ?1",
+                WHERE url.url = ?1",
                 (url, )
             ).fetchone()
             if id_and_position:
                 url_id, prev_pos = id_and_position
                 #print(f"URL already stored with id {url_id}")
-                if prev_pos == position:
-                    return
-                elif prev_pos is not None:
+                if prev_pos is not None:
                     #print(f"URL already queued at {prev_pos}")
-                    # take it out of the frontier
+                    # take it out of the frontier, leaving a gap
                     cur.execute(
                         "DELETE FROM frontier WHERE position = ?1",
                         (prev_pos, )
                     )
-                    # close the gap
-                    self.shift(cur, prev_pos, -1)
-                    # TODO: optimize by checking if prev_pos < position, only shift once
             else:
                 # insert URL into url table
                 res = cur.execute(
@@ -228,19 +424,48 @@ class Queue(Index):
                 assert self.con.changes() == 1, f"failed to store {url} in db"
                 assert res != None
                 (url_id, ) = res
+                if self.seen is not None:
+                    self.seen.add(url)
 
-            # make space for the frontier entry
-            self.shift(cur, position)
-            # insert frontier entry into the gap or at the end, but not after
+            # find the entries that will end up before & after the new one
+            position = max(0, position)
+            if position == 0:
+                before = None
+                after = cur.execute(
+                    "SELECT min(position) FROM frontier"
+                ).fetchone()[0]
+            else:
+                neighbours = [
+                    pos for (pos, ) in cur.execute(
+                        "SELECT position FROM frontier \
+                        ORDER BY position \
+                        LIMIT 2 OFFSET ?1",
+                        (position - 1, )
+                    )
+                ]
+                if neighbours:
+                    before = neighbours[0]
+                    after = neighbours[1] if len(neighbours) > 1 else None
+                else:
+                    # past the end
+                    before = cur.execute(
+                        "SELECT max(position) FROM frontier"
+                    ).fetchone()[0]
+                    after = None
+
+            if before is None and after is None:
+                new_pos = 0
+            elif after is None:
+                new_pos = before + POSITION_GAP
+            elif before is None and after > 0:
+                new_pos = max(after - POSITION_GAP, after // 2)
+            elif before is not None and after - before > 1:
+                new_pos = (before + after) // 2
+            else:
+                # no space left, make some
+                self.shift(cur, after, POSITION_GAP)
+                new_pos = after
             cur.execute(
-                "INSERT INTO frontier (position, url_id) \
-                VALUES ( \
-                    MAX(0, MIN( \
-                        ?1, \
-                        IFNULL((SELECT max(position) + 1 FROM frontier), 0) \
-                    )), \
-                    ?2 \
-                )",
-                (position, url_id)
+                "INSERT INTO frontier (position, url_id) VALUES (?1, ?2)",
+                (new_pos, url_id)
             )
-
@@ -1,28 +1,63 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from enum import IntEnum
+import hashlib
+import json
+import math
+import threading
 import apsw
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_ACCEPT_ENCODING
 
 from crawl import DEFAULT_CRAWLER_DB
+from crawl.compress import DEFAULT_CODEC, compress
 from crawl.document import Document
 from crawl.robots import USER_AGENT
 
 
 REQUEST_TIMEOUT = 3.0
+# maximum size of a response body in bytes, larger downloads are aborted
+MAX_CONTENT_SIZE = 4 * 2**20
+CHUNK_SIZE = 64 * 2**10
+HTML_TYPES = {"text/html", "application/xhtml+xml"}
+# file signatures of common non-HTML formats that are served as text/html
+BINARY_SIGNATURES = (
+    b"%PDF",
+    b"\x89PNG",
+    b"GIF8",
+    b"\xff\xd8\xff",
+    b"PK\x03\x04",
+    b"\x1f\x8b",
+)
 HEADERS = {
     "Accept-Language": "en-US,en,en-GB",
-    "Accept": "text/html,application/xhtml+xml,application/xml,text/*",
+    "Accept": "text/html,application/xhtml+xml",
     "User-Agent": USER_AGENT,
-    # TODO: check if requests takes care of this
-    #"Accept-Encoding": "gzip, deflate, br"
+    # whatever urllib3 can decode, i.e. gzip & deflate, br / zstd if installed
+    "Accept-Encoding": DEFAULT_ACCEPT_ENCODING,
 }
 
+# per-process pools of keep-alive connections, one session per host
+MAX_SESSIONS = 64
+MAX_POOL_SIZE = 10
+# servers close idle keep-alive connections after a few seconds, don't keep
+# connections to hosts that we aren't allowed to request that often
+KEEP_ALIVE_TIMEOUT = 15.0
+_sessions: OrderedDict[str, 'PooledSession'] = OrderedDict()
+_sessions_lock = threading.Lock()
+
 
 class Status(IntEnum):
     # Custom non-HTTP statuses
     FAILED = 10
     TIMEOUT = 11
     PROHIBITED = 20
+    # download aborted, the response isn't stored
+    UNSUPPORTED_TYPE = 30
+    TOO_LARGE = 31
+    BINARY = 32
 
     # 1xx Informational
     CONTINUE = 100
@@ -102,6 +137,9 @@ STATUS_DESCRIPTIONS = {
     Status.FAILED: "Request failed",
     Status.TIMEOUT: "Timed out",
     Status.PROHIBITED: "Crawling prohibited",
+    Status.UNSUPPORTED_TYPE: "Content-Type is not HTML",
+    Status.TOO_LARGE: "Response body too large",
+    Status.BINARY: "Response body is binary",
 
     Status.CONTINUE: "Continue",
     Status.SWITCHING_PROTOCOLS: "Switching Protocols",
@@ -168,14 +206,115 @@ STATUS_DESCRIPTIONS = {
 }
 
 
+def _new_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class PooledSession:
+    def __init__(self, session: requests.Session, last_used: float):
+        self.session = session
+        self.last_used = last_used
+        # requests in progress, the session is only closed when there are none
+        self.users = 0
+
+
+def _close_idle(now: float):
+    # close connections that have been idle for too long, least recently
+    # used first, sessions in use are newer than that or skipped
+    for origin, pooled in list(_sessions.items()):
+        if now - pooled.last_used <= KEEP_ALIVE_TIMEOUT:
+            break
+        if pooled.users == 0:
+            del _sessions[origin]
+            pooled.session.close()
+
+
+def _evict():
+    # make room for another session, closing the least recently used one
+    # that isn't in use, the pool grows while all of them are
+    for origin, pooled in _sessions.items():
+        if pooled.users == 0:
+            del _sessions[origin]
+            pooled.session.close()
+            return
+
+
+@contextmanager
+def session_for(origin: str, refill_rate: float | None):
+    '''
+    Use the pooled session of a host, sized by its token-bucket refill rate
+
+    Yields `None` without an origin or if the host is requested too rarely to
+    keep connections open.
+    Sessions are shared by the threads that request the same host & only
+    closed once none of them is using it.
+    '''
+    if origin is None or refill_rate is None or 1 / refill_rate > KEEP_ALIVE_TIMEOUT:
+        yield None
+        return
+    now = time.time()
+    with _sessions_lock:
+        _close_idle(now)
+        if origin in _sessions:
+            pooled = _sessions[origin]
+            _sessions.move_to_end(origin)
+        else:
+            # enough connections for the requests that may be in flight
+            # at the same time, given the request timeout
+            pool_size = min(
+                max(1, math.ceil(refill_rate * REQUEST_TIMEOUT)),
+                MAX_POOL_SIZE
+            )
+            if len(_sessions) >= MAX_SESSIONS:
+                _evict()
+            pooled = PooledSession(_new_session(pool_size), now)
+            _sessions[origin] = pooled
+        pooled.users += 1
+        pooled.last_used = now
+    try:
+        yield pooled.session
+    finally:
+        with _sessions_lock:
+            pooled.users -= 1
+            pooled.last_used = time.time()
+            if _sessions.get(origin) is pooled:
+                _sessions.move_to_end(origin)
+
+
+def looks_binary(chunk: bytes) -> bool:
+    '''
+    Sniff the first chunk of a response body for data that isn't HTML
+    '''
+    return chunk.startswith(BINARY_SIGNATURES) or b"\x00" in chunk[:1024]
+
+
 class Request:
     def __init__(self, url: str) -> None:
         self.time = time.time()
         self.elapsed = None
         self.headers = None
+        # compressed with `self.encoding` once the request has been made
         self.data = None
+        self.encoding = None
+        self.compression = DEFAULT_CODEC
+        # SHA-256 of the uncompressed body, identical bodies are stored once
+        self.digest = None
+        self.body_id = None
+        # whether the body had already been stored for an earlier request
+        self.known_body = False
         self.url = url
         self.id = None
+        # set from the host's token bucket, to size its connection pool
+        self.origin = None
+        self.refill_rate = None
+        self.max_size = MAX_CONTENT_SIZE
+        # If-None-Match / If-Modified-Since when recrawling
+        self.conditional_headers = {}
 
 
     @staticmethod
@@ -185,13 +324,6 @@ class Request:
         return req
 
 
-    @staticmethod
-    def rate_limited(url: str, seconds: float):
-        req = Request(url)
-        req.status = time.time() + seconds
-        return req
-
-
     @staticmethod
     def stats(con: apsw.Connection):
         res = con.execute(
@@ -240,27 +372,105 @@ class Request:
                 raise Exception(f"{self.url}: invalid status {other}")
 
 
-    def make(self) -> bool:
-        try:
-            response = requests.get(
-                self.url,
-                timeout=REQUEST_TIMEOUT,
-                headers=HEADERS
-            )
-            self.elapsed = response.elapsed
-            response.raise_for_status()
-        except requests.Timeout:
-            self.status = Status.TIMEOUT
-        except requests.RequestException as e:
-            #print(f"request for {self.url} failed: {e}")
-            self.status = Status.FAILED
+    def load_validators(self, db: apsw.Connection | str = DEFAULT_CRAWLER_DB):
+        """
+        Make the request conditional on the page having changed since the last successful request
+        """
+        if type(db) == str:
+            con = apsw.Connection(db)
+        elif type(db) == apsw.Connection:
+            con = db
         else:
-            self.status = Status(response.status_code)
-            self.headers = response.headers
-            self.data = response.content
+            raise Exception("invalid db argument")
+
+        res = con.execute(
+            "SELECT JSON(headers) FROM request \
+            JOIN url on url_id = url.id \
+            WHERE url = ?1 \
+            AND headers IS NOT NULL \
+            AND (status BETWEEN 200 AND 299 OR status = 304) \
+            ORDER BY request.time DESC \
+            LIMIT 1",
+            (self.url, )
+        ).fetchone()
+        if not res:
+            return
+        headers = {
+            name.lower(): value
+            for name, value in json.loads(res[0]).items()
+        }
+        if etag := headers.get("etag"):
+            self.conditional_headers["If-None-Match"] = etag
+        if last_modified := headers.get("last-modified"):
+            self.conditional_headers["If-Modified-Since"] = last_modified
+
+
+    def make(self) -> bool:
+        with session_for(self.origin, self.refill_rate) as session:
+            try:
+                # only read the body after checking the headers
+                if session:
+                    response = session.get(
+                        self.url,
+                        timeout=REQUEST_TIMEOUT,
+                        headers=self.conditional_headers,
+                        stream=True
+                    )
+                else:
+                    response = requests.get(
+                        self.url,
+                        timeout=REQUEST_TIMEOUT,
+                        headers={
+                            **HEADERS,
+                            **self.conditional_headers,
+                            "Connection": "close"
+                        },
+                        stream=True
+                    )
+                with response:
+                    self.elapsed = response.elapsed
+                    response.raise_for_status()
+                    self.headers = response.headers
+                    self.status, data = self.read(response)
+                if data is not None:
+                    self.digest = hashlib.sha256(data).digest()
+                    self.data, self.encoding = compress(data, self.compression)
+            except requests.Timeout:
+                self.status = Status.TIMEOUT
+            except requests.RequestException as e:
+                #print(f"request for {self.url} failed: {e}")
+                self.status = Status.FAILED
         return self.data is not None
 
 
+    def read(self, response: requests.Response) -> tuple[Status, bytes | None]:
+        '''
+        Download the body of a streamed response, unless it isn't HTML or too large
+        '''
+        if response.status_code == Status.NOT_MODIFIED:
+            # unchanged since the last request, nothing to download
+            return Status.NOT_MODIFIED, None
+        content_type = response.headers.get("Content-Type", "")
+        mime_type = content_type.split(";")[0].strip().lower()
+        if mime_type and mime_type not in HTML_TYPES:
+            return Status.UNSUPPORTED_TYPE, None
+        length = response.headers.get("Content-Length", "")
+        if length.isdigit() and int(length) > self.max_size:
+            return Status.TOO_LARGE, None
+
+        chunks = []
+        size = 0
+        # decodes the Content-Encoding, the limit applies to the decoded size
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if not chunks and looks_binary(chunk):
+                return Status.BINARY, None
+            size += len(chunk)
+            if size > self.max_size:
+                return Status.TOO_LARGE, None
+            chunks.append(chunk)
+        return Status(response.status_code), b"".join(chunks)
+
+
     def save(self, db: apsw.Connection | str = DEFAULT_CRAWLER_DB) -> int:
         """
         Store the request in the database.
@@ -282,6 +492,9 @@ class Request:
         else:
             raise Exception("invalid db argument")
 
+        if self.data is not None:
+            self.save_body(con)
+
         res = con.execute(
             "INSERT INTO request ( \
                 url_id, \
@@ -289,11 +502,18 @@ class Request:
                 duration, \
                 status, \
                 headers, \
-                data \
+                body_id \
             ) \
             VALUES ((SELECT id FROM url WHERE url = ?1), ?2, ?3, ?4, ?5, ?6) \
             RETURNING id",
-            (self.url, self.time, elapsed, self.status, headers, self.data)
+            (
+                self.url,
+                self.time,
+                elapsed,
+                self.status,
+                headers,
+                self.body_id
+            )
         ).fetchone()
         #print(f"result: {res}, rows changed: {con.changes()}")
         #print(f"inserted request with id {con.last_insert_rowid()}")
@@ -304,7 +524,40 @@ class Request:
             raise Exception("failed to store request")
 
 
+    def save_body(self, con: apsw.Connection) -> int:
+        """
+        Store the response body unless a body with the same digest exists
+        """
+        if self.digest is None:
+            raise Exception("cannot store body without digest")
+        res = con.execute(
+            "SELECT id FROM body WHERE digest = ?1",
+            (self.digest, )
+        ).fetchone()
+        if res:
+            (self.body_id, ) = res
+            self.known_body = True
+        else:
+            (self.body_id, ) = con.execute(
+                "INSERT INTO body (digest, data, encoding) \
+                VALUES (?1, ?2, ?3) \
+                RETURNING id",
+                (self.digest, self.data, self.encoding)
+            ).fetchone()
+        return self.body_id
+
+
     def document(self) -> Document | None:
-        if not self.data or not self.headers:
+        """
+        The document to parse, `None` if there is no body or it is an exact
+        duplicate of one that has already been parsed
+        """
+        if not self.data or not self.headers or self.known_body:
             return None
-        return Document(self.id, self.url, self.headers, self.data)
+        return Document(
+            self.id,
+            self.url,
+            self.headers,
+            self.data,
+            self.encoding
+        )
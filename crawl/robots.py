@@ -1,22 +1,213 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
 import os
+import re
+import threading
 import apsw
 import time
-from http.client import RemoteDisconnected
-from urllib import error, request
-from urllib.parse import urlparse
+from urllib.parse import quote, unquote, urlparse
 from urllib.robotparser import RobotFileParser
+import requests
+from requests.adapters import HTTPAdapter
 
 from crawl import DEFAULT_HOSTS_DB
 
 
 # TODO: actually use this when making requests
 USER_AGENT = 'MSE_Crawler'
+# product token at the start of a user-agent line, e.g. of "Name/1.0" (RFC 9309)
+PRODUCT_TOKEN = re.compile(r"[A-Za-z_-]*")
 DEFAULT_REFILL_CAP = 60
 DEFAULT_REFILL_RATE = DEFAULT_REFILL_CAP / 30
 
 # TODO: make this configurable / robust
 HOSTS_DB_SQL = "hosts.sql"
 
+# number of hosts whose parsed robots.txt is kept in memory
+DEFAULT_HOST_CACHE_SIZE = 10_000
+# seconds between writing the in-memory token buckets to the hosts database
+CHECKPOINT_INTERVAL = 5.0
+
+# robots.txt fetches in flight at the same time
+ROBOTS_CONCURRENCY = 32
+# seconds to connect, between bytes & for the whole download
+ROBOTS_TIMEOUT = 5.0
+# RFC 9309 asks to parse at least 500 KiB, the rest is ignored
+ROBOTS_MAX_SIZE = 500 * 2**10
+# seconds after which a robots.txt is fetched again
+ROBOTS_TTL = 24 * 60 * 60
+_robots_session: requests.Session | None = None
+_robots_session_lock = threading.Lock()
+
+
+def normalize_path(path: str) -> str:
+    # same percent-encoding for rule patterns & URLs
+    return quote(unquote(path), safe="/")
+
+
+def translate_pattern(pattern: str) -> str:
+    """
+    Regex for a robots.txt path pattern, with `*` & `$` wildcards
+    """
+    anchored = pattern.endswith("$")
+    if anchored:
+        pattern = pattern[:-1]
+    regex = ".*".join(
+        re.escape(normalize_path(part)) for part in pattern.split("*")
+    )
+    return regex + r"\Z" if anchored else regex
+
+
+class RobotRules:
+    """
+    The allow & disallow rules of a robots.txt that apply to `USER_AGENT`,
+    compiled into a single regex
+
+    Like RFC 9309, the rule with the longest pattern decides, allow wins ties
+    & URLs that no rule matches are allowed. The alternatives of the regex are
+    ordered by pattern length, so the first one that matches decides.
+    """
+    def __init__(self, rules: list[tuple[str, bool]]):
+        self.rules = sorted(
+            set((pattern, allow) for pattern, allow in rules if pattern),
+            key=lambda rule: (len(rule[0]), rule[1]),
+            reverse=True
+        )
+        self.allowances = [allow for _, allow in self.rules]
+        if self.rules:
+            self.regex = re.compile("|".join(
+                f"({translate_pattern(pattern)})" for pattern, _ in self.rules
+            ))
+        else:
+            self.regex = None
+
+
+    @staticmethod
+    def parse(robots_txt: str) -> 'RobotRules':
+        """
+        Collect the rules of the groups for `USER_AGENT`, or for `*` if
+        there are none. Product tokens are compared case-insensitively.
+        """
+        token = USER_AGENT.split("/")[0].lower()
+        # (user agents, rules) of every group
+        groups: list[tuple[list[str], list[tuple[str, bool]]]] = []
+        in_rules = True
+        for line in robots_txt.splitlines():
+            line = line.split("#", 1)[0].strip()
+            if ":" not in line:
+                continue
+            field, value = line.split(":", 1)
+            field = field.strip().lower()
+            value = value.strip()
+            if field == "user-agent":
+                if in_rules:
+                    groups.append(([], []))
+                    in_rules = False
+                if value != "*":
+                    value = PRODUCT_TOKEN.match(value).group()
+                groups[-1][0].append(value.lower())
+            elif field in ("allow", "disallow") and groups:
+                in_rules = True
+                groups[-1][1].append((value, field == "allow"))
+
+        specific = [
+            rules
+            for agents, rules in groups
+            if token in agents
+        ]
+        default = [rules for agents, rules in groups if "*" in agents]
+        return RobotRules([
+            rule for rules in (specific or default) for rule in rules
+        ])
+
+
+    def dump(self) -> str:
+        return json.dumps(self.rules)
+
+
+    @staticmethod
+    def load(stored: str) -> 'RobotRules':
+        if stored.startswith("["):
+            return RobotRules([
+                (pattern, allow) for pattern, allow in json.loads(stored)
+            ])
+        # stored by older versions as re-serialized RobotFileParser
+        return RobotRules.parse(stored)
+
+
+    def global_policy(self) -> bool | None:
+        """
+        `True` / `False` if the rules allow / disallow every URL
+        """
+        if not any(not allow for _, allow in self.rules):
+            return True
+        if self.rules == [("/", False)]:
+            return False
+        return None
+
+
+    def allows(self, path: str) -> bool:
+        """
+        Whether the path (including the query) of an URL may be crawled
+        """
+        if self.regex is None:
+            return True
+        match = self.regex.match(normalize_path(path))
+        return match is None or self.allowances[match.lastindex - 1]
+
+
+def robots_session() -> requests.Session:
+    """
+    Session shared by all robots.txt fetches of a process, keeps connections
+    open for redirects & refreshes
+    """
+    global _robots_session
+    with _robots_session_lock:
+        if _robots_session is None:
+            _robots_session = requests.Session()
+            _robots_session.headers["User-Agent"] = USER_AGENT
+            adapter = HTTPAdapter(
+                pool_connections=ROBOTS_CONCURRENCY,
+                pool_maxsize=ROBOTS_CONCURRENCY
+            )
+            _robots_session.mount("http://", adapter)
+            _robots_session.mount("https://", adapter)
+        return _robots_session
+
+
+def read_robots_txt(origin: str, timeout=ROBOTS_TIMEOUT) -> str:
+    """
+    Download the robots.txt of a host, raises `requests.HTTPError` for
+    statuses other than 2xx
+    """
+    deadline = time.time() + timeout
+    with robots_session().get(
+        origin + "/robots.txt",
+        timeout=timeout,
+        stream=True
+    ) as response:
+        response.raise_for_status()
+        if response.status_code >= 300:
+            # too many or broken redirects
+            raise requests.HTTPError(response=response)
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(16 * 2**10):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= ROBOTS_MAX_SIZE:
+                break
+            # the timeout only applies to single reads, not to slow hosts
+            if time.time() > deadline:
+                raise requests.Timeout(f"{origin}/robots.txt took too long")
+    raw = b"".join(chunks)
+    if len(raw) >= ROBOTS_MAX_SIZE:
+        # drop the line that was cut off, it may end inside a rule or a
+        # multibyte character
+        raw = raw[:ROBOTS_MAX_SIZE].rpartition(b"\n")[0]
+    return raw.decode("utf-8", "strict")
+
 
 class Host:
     @staticmethod
@@ -27,6 +218,16 @@ class Host:
             with open(HOSTS_DB_SQL) as file:
                 schema = file.read()
                 con.execute(schema)
+        elif not any(
+            name == "fetched"
+            for _, name, *_ in con.execute("PRAGMA table_info(host)")
+        ):
+            # hosts databases from before robots.txt were refreshed
+            with con:
+                con.execute(
+                    "ALTER TABLE host ADD COLUMN fetched REAL; \
+                    UPDATE host SET fetched = updated;"
+                )
         return con
 
 
@@ -34,56 +235,45 @@ class Host:
         self.origin = origin
 
 
-    def fetch(self) -> None:
+    def fetch(self, timeout=ROBOTS_TIMEOUT) -> None:
         """
-        Copy of RobotFileParser.read(), with some modifications
+        Fetch & compile the robots.txt, like RobotFileParser.read() but
+        with timeouts & a size limit
         """
+        raw = None
         try:
-            self.rfp = RobotFileParser()
-            f = request.urlopen(self.origin + "/robots.txt")
-            raw = f.read()
-            self.rfp.parse(raw.decode("utf-8").splitlines())
-        except error.HTTPError as err:
-            if err.code in (401, 403):
-                self.global_policy = False
-            if err.code in range(300, 400):
-                self.global_policy = False
-            elif err.code >= 400 and err.code < 500:
-                self.global_policy = True
-            elif err.code >= 500:
-                self.global_policy = False
-            else:
-                # TODO make robust (ignore if they can't even serve robots.txt?)
-                raise Exception(
-                    f"failed to fetch robots for {self.origin}: {err}"
-                )
-            self.refill_cap = DEFAULT_REFILL_CAP
-            self.refill_rate = DEFAULT_REFILL_RATE
-            self.tokens = DEFAULT_REFILL_CAP
-            self.robots_txt = None
-        except (error.URLError, UnicodeDecodeError, RemoteDisconnected):
+            raw = read_robots_txt(self.origin, timeout)
+        except requests.HTTPError as err:
+            # no robots.txt, everything is allowed (RFC 9309), but not if
+            # the server is failing or redirects in circles
+            status = err.response.status_code if err.response is not None else 0
+            self.global_policy = 400 <= status < 500
+        except (requests.RequestException, UnicodeDecodeError):
             #TODO: log
             # ignore hosts that have robots.txt with invalid unicode
             # ignore hosts that we can't fetch robots.txt from
             self.global_policy = False
+
+        if raw is None:
             self.refill_cap = DEFAULT_REFILL_CAP
             self.refill_rate = DEFAULT_REFILL_RATE
-            self.tokens = DEFAULT_REFILL_CAP
             self.robots_txt = None
         else:
             # TODO: log this instead of printing
             #print(f"fetched robots.txt for {self.origin}")
 
-            # No global allow/disallow policy, store the robots.txt content
-            # don't store the raw file, re-serialize the parsed RFP
-            self.robots_txt = str(self.rfp)
-            # TODO: technically the robots.txt could boil down to a global policy as well
-            self.global_policy = None
+            # store the rules that apply to us instead of the raw file
+            self.rules = RobotRules.parse(raw)
+            self.robots_txt = self.rules.dump()
+            self.global_policy = self.rules.global_policy()
 
-            if rate := self.rfp.request_rate(USER_AGENT):
+            # only used for the rate limits, the rules are compiled
+            rfp = RobotFileParser()
+            rfp.parse(raw.splitlines())
+            if rate := rfp.request_rate(USER_AGENT):
                 self.refill_cap = rate.requests
                 self.refill_rate = rate.seconds
-            elif delay := self.rfp.crawl_delay(USER_AGENT):
+            elif delay := rfp.crawl_delay(USER_AGENT):
                 self.refill_cap = 1
                 self.refill_rate = 1 / float(delay)
             else:
@@ -91,10 +281,14 @@ class Host:
                 self.refill_rate = DEFAULT_REFILL_RATE
 
         self.updated = time.time()
+        self.fetched = self.updated
         # start with full token bucket
         # TODO: seems to overshoot the intended rate in the very first period
         self.tokens = self.refill_cap
-        # TODO: keep track of how old the robots.txt / host entry is
+
+
+    def expired(self, now: float, ttl=ROBOTS_TTL) -> bool:
+        return self.fetched is None or now - self.fetched > ttl
 
 
     def store(self, con: apsw.Connection):
@@ -109,9 +303,10 @@ class Host:
                 refill_rate, \
                 refill_cap, \
                 updated, \
-                tokens \
+                tokens, \
+                fetched \
             ) \
-            VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7)",
+            VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8)",
             (
                 self.origin,
                 self.global_policy,
@@ -119,43 +314,56 @@ class Host:
                 self.refill_rate,
                 self.refill_cap,
                 self.updated,
-                self.tokens
+                self.tokens,
+                self.fetched
             )
         )
 
 
-    def try_take_token(self, con: apsw.Connection, url: str) -> bool | float:
+    def try_take_token(self, url: str) -> bool | float:
+        """
+        Take a token from the in-memory bucket, see `HostCache.checkpoint`
+
+        Returns:
+        bool: Whether crawling the URL is allowed at all.
+        float: Seconds until the bucket contains a token again.
+        """
         if self.global_policy == False:
             return False
         if self.global_policy is None:
-            if not self.rfp.can_fetch(USER_AGENT, url):
+            # URLs of a host always start with its origin
+            if not self.rules.allows(url[len(self.origin):] or "/"):
                 return False
         now = time.time()
-        # TODO: ensure this is actually atomic (disable journal?, share conn?)
-        try:
-            # TODO: this breaks if the clock shifts backward
-            con.execute(
-                "UPDATE host \
-                SET tokens = MIN( \
-                        tokens + ((?2 - updated) * refill_rate), \
-                        refill_cap \
-                    ) - 1, \
-                    updated = ?2 \
-                WHERE origin = ?1",
-                (self.origin, now)
+        ready = self.next_token_time()
+        if ready > now:
+            return ready - now
+        # TODO: this breaks if the clock shifts backward
+        self.refill(now)
+        # rounding errors mustn't violate the CHECK constraint when stored
+        self.tokens = max(self.tokens - 1, 0.0)
+        return True
+
+
+    def refill(self, now: float):
+        """
+        Bring the bucket up to date without taking a token
+        """
+        if now > self.updated:
+            self.tokens = min(
+                self.tokens + (now - self.updated) * self.refill_rate,
+                self.refill_cap
             )
-            # TODO: logging
-        except apsw.ConstraintError:
-            # TODO: logging
-            # constraint violated because bucket is empty
-            # calculate remaining time
-            needed = (1 - self.tokens) / self.refill_rate
-            waited = now - self.updated
-            # TODO: should only happen due to concurrent update, retry instantly
-            assert needed > waited, f"{self.origin}, should have tokens"
-            return needed - waited
-        else:
-            return True
+            self.updated = now
+
+
+    def next_token_time(self) -> float:
+        """
+        Point in time at which the token bucket will contain a token again
+        """
+        if self.tokens >= 1:
+            return self.updated
+        return self.updated + (1 - self.tokens) / self.refill_rate
 
 
     def try_load(self, con: apsw.Connection) -> bool:
@@ -167,7 +375,8 @@ class Host:
                 refill_rate, \
                 refill_cap, \
                 updated, \
-                tokens \
+                tokens, \
+                fetched \
             FROM host \
             WHERE origin = ?1",
             (self.origin, )
@@ -176,21 +385,198 @@ class Host:
             (
                 self.origin,
                 self.global_policy,
-                robots_txt,
+                self.robots_txt,
                 self.refill_rate,
                 self.refill_cap,
                 self.updated,
-                self.tokens
+                self.tokens,
+                self.fetched
             ) = res
             if self.global_policy is None:
-                self.rfp = RobotFileParser()
-                self.rfp.parse(robots_txt.splitlines())
+                self.rules = RobotRules.load(self.robots_txt)
             return True
         else:
             return False
 
 
 
+class HostCache:
+    """
+    LRU cache of the hosts in a hosts database, keyed by origin
+
+    Saves the query & re-parsing the robots.txt every time a host is looked
+    up. Hosts have to be written through `store` to keep the cache coherent.
+    With `exact`, the stored token buckets are trusted as they are: for
+    callers that checkpoint every token they take right away.
+    """
+    def __init__(
+        self,
+        con: apsw.Connection,
+        size=DEFAULT_HOST_CACHE_SIZE,
+        exact=False
+    ):
+        self.con = con
+        self.size = size
+        self.exact = exact
+        # `None` for hosts that aren't in the database yet
+        self.entries: OrderedDict[str, Host | None] = OrderedDict()
+        # hosts that took tokens since the last checkpoint, never evicted
+        self.dirty: dict[str, Host] = {}
+        self.started = time.time()
+        self.checkpointed = self.started
+
+
+    def get(self, origin: str) -> Host | None:
+        """
+        The host with its parsed robots.txt, `None` if it needs to be fetched
+        """
+        if origin in self.entries:
+            self.entries.move_to_end(origin)
+            return self.entries[origin]
+        if origin in self.dirty:
+            host = self.dirty[origin]
+        else:
+            host = Host(origin)
+            if not host.try_load(self.con):
+                host = None
+            elif not self.exact and host.updated < self.started:
+                # a previous run may have taken tokens after its last
+                # checkpoint, at worst until it stopped: assume that it
+                # emptied the bucket then
+                host.tokens = 0.0
+                host.updated = min(
+                    host.updated + CHECKPOINT_INTERVAL,
+                    self.started
+                )
+        self.put(origin, host)
+        return host
+
+
+    def put(self, origin: str, host: Host | None):
+        self.entries[origin] = host
+        self.entries.move_to_end(origin)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+    def store(self, host: Host):
+        """
+        Write the host to the database & replace the cached entry
+        """
+        host.store(self.con)
+        self.dirty.pop(host.origin, None)
+        self.put(host.origin, host)
+
+
+    def try_take_token(self, host: Host, url: str) -> bool | float:
+        res = host.try_take_token(url)
+        if res == True:
+            self.dirty[host.origin] = host
+        return res
+
+
+    def checkpoint(self, force=False) -> int:
+        """
+        Write the token buckets that changed to the database, in one
+        transaction every `CHECKPOINT_INTERVAL` seconds unless `force`d
+
+        Returns:
+        int: The number of hosts that were written.
+        """
+        now = time.time()
+        if not force and now - self.checkpointed < CHECKPOINT_INTERVAL:
+            return 0
+        self.checkpointed = now
+        hosts = list(self.dirty.values())
+        for host in hosts:
+            # the stored bucket is as of the checkpoint, see `get`
+            host.refill(now)
+        with self.con:
+            self.con.executemany(
+                "UPDATE host SET tokens = ?2, updated = ?3 WHERE origin = ?1",
+                ((host.origin, host.tokens, host.updated) for host in hosts)
+            )
+        self.dirty.clear()
+        return len(hosts)
+
+
+def fetch_host(origin: str) -> Host:
+    host = Host(origin)
+    host.fetch()
+    return host
+
+
+class RobotsPrefetcher:
+    """
+    Fetches the robots.txt of hosts in a thread pool, as soon as their first
+    URL is queued & again once it is older than `ttl` seconds
+
+    Fetched hosts are only stored by `collect`, which has to be called from
+    the thread that uses the hosts database.
+    """
+    def __init__(
+        self,
+        cache: HostCache,
+        concurrency=ROBOTS_CONCURRENCY,
+        ttl=ROBOTS_TTL
+    ):
+        self.cache = cache
+        self.ttl = ttl
+        self.pool = ThreadPoolExecutor(concurrency, "robots")
+        self.pending: dict[str, Future] = {}
+
+
+    def check(self, origin: str) -> Host | None:
+        """
+        The cached host, its robots.txt is fetched if it is unknown or expired
+
+        Returns:
+        Host: The host, possibly with an expired robots.txt that is in use until
+        the new one has been collected.
+        None: If the robots.txt is still being fetched.
+        """
+        host = self.cache.get(origin)
+        if origin not in self.pending and (
+            host is None or host.expired(time.time(), self.ttl)
+        ):
+            self.pending[origin] = self.pool.submit(fetch_host, origin)
+        return host
+
+
+    def watch(self, urls):
+        """
+        Start fetching the robots.txt of the hosts of newly queued URLs
+        """
+        for origin in set(get_host(url) for url in urls):
+            self.check(origin)
+
+
+    def collect(self) -> list[Host]:
+        """
+        Store the hosts whose robots.txt has been fetched since the last call
+        """
+        done = [
+            origin
+            for origin, future in self.pending.items()
+            if future.done()
+        ]
+        hosts = []
+        for origin in done:
+            host = self.pending.pop(origin).result()
+            if old := self.cache.get(origin):
+                # refreshed, keep the state of the token bucket
+                host.tokens = min(old.tokens, host.refill_cap)
+                host.updated = old.updated
+            self.cache.store(host)
+            hosts.append(host)
+        return hosts
+
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+
 def get_host(url):
     '''
     Extracts the host (scheme and netloc) from the given URL.
@@ -208,7 +594,8 @@ def get_host(url):
 def can_crawl(
     url: str,
     con: apsw.Connection | None = None,
-    hosts_db_path=DEFAULT_HOSTS_DB
+    hosts_db_path=DEFAULT_HOSTS_DB,
+    cache: HostCache | None = None
 ) -> bool | float:
     '''
     Determines if the given URL is allowed to be crawled according to the robots.txt rules of the host and the rate-limiter.
@@ -217,9 +604,23 @@ def can_crawl(
     Parameters:
     url (str): The URL to check against the robots.txt rules.
     hosts_db_path: path of the hosts database file (created if nonexistent).
+    cache (HostCache): The cache of a caller that keeps it, otherwise the token
+    buckets are loaded as checkpointed.
 
     Returns:
     bool: `True` if the URL is allowed to be crawled now, `False` if crawling the URL is prohibited.
     float: Time in seconds until this function is expected to return `True`.
     '''
-    return Host(get_host(url), con, hosts_db_path).try_take_token(url)
+    if cache is None:
+        if con is None:
+            con = Host.open_db(hosts_db_path)
+        # the token is checkpointed below, as every one taken this way
+        cache = HostCache(con, exact=True)
+    origin = get_host(url)
+    if (host := cache.get(origin)) is None:
+        host = Host(origin)
+        host.fetch()
+        cache.store(host)
+    res = cache.try_take_token(host, url)
+    cache.checkpoint(force=True)
+    return res
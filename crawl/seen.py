@@ -0,0 +1,150 @@
+import hashlib
+import math
+import os
+import struct
+
+import apsw
+
+DEFAULT_SEEN_CAPACITY = 10_000_000
+DEFAULT_SEEN_ERROR_RATE = 0.001
+
+# magic, bit count, hash count, highest url id contained & a digest of its
+# URL, which tells whether the file belongs to the database
+HEADER = struct.Struct("<8sQQq16s")
+MAGIC = b"MSESEEN2"
+
+
+class SeenFilter:
+    """
+    Bloom filter over the URLs in the `url` table
+
+    Answers whether an URL is definitely new or has probably been seen before.
+    A false positive means that a new URL is not queued, which happens with
+    about `error_rate` probability once `capacity` URLs have been added.
+    """
+    def __init__(
+        self,
+        capacity: int = DEFAULT_SEEN_CAPACITY,
+        error_rate: float = DEFAULT_SEEN_ERROR_RATE
+    ):
+        # optimal number of bits & hash functions
+        # https://en.wikipedia.org/wiki/Bloom_filter#Optimal_number_of_hash_functions
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        # highest `url.id` that has been added, for catching up after loading
+        self.max_url_id = 0
+
+
+    def _positions(self, url: str):
+        # double hashing with two 64 bit halves of a single digest
+        digest = hashlib.blake2b(url.encode(), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+
+    def add(self, url: str):
+        for pos in self._positions(url):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+
+    def update(self, urls):
+        for url in urls:
+            self.add(url)
+
+
+    def __contains__(self, url: str) -> bool:
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7))
+            for pos in self._positions(url)
+        )
+
+
+    def memory(self) -> int:
+        return len(self.bits)
+
+
+    @staticmethod
+    def url_digest(con: apsw.Connection, url_id: int) -> bytes | None:
+        """
+        Digest of the URL with the given id, `None` if there is none
+        """
+        row = con.execute("SELECT url FROM url WHERE id = ?1", (url_id, )).fetchone()
+        if row is None:
+            return None
+        return hashlib.blake2b(row[0].encode(), digest_size=16).digest()
+
+
+    def catch_up(self, con: apsw.Connection) -> int:
+        """
+        Add all URLs from the `url` table that are newer than the filter
+        """
+        count = 0
+        for url_id, url in con.execute(
+            "SELECT id, url FROM url WHERE id > ?1 ORDER BY id",
+            (self.max_url_id, )
+        ):
+            self.add(url)
+            self.max_url_id = url_id
+            count += 1
+        return count
+
+
+    def save(self, path: str, con: apsw.Connection):
+        """
+        Write the filter to `path`, replacing it atomically.
+
+        Assumes that every URL in the `url` table of `con` has been added.
+        """
+        (max_url_id, ) = con.execute(
+            "SELECT IFNULL(max(id), 0) FROM url"
+        ).fetchone()
+        self.max_url_id = max(self.max_url_id, max_url_id)
+        digest = SeenFilter.url_digest(con, self.max_url_id) or bytes(16)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as file:
+            file.write(HEADER.pack(
+                MAGIC,
+                self.size,
+                self.hashes,
+                self.max_url_id,
+                digest
+            ))
+            file.write(self.bits)
+        os.replace(tmp, path)
+
+
+    @staticmethod
+    def load(
+        path: str,
+        con: apsw.Connection,
+        capacity: int = DEFAULT_SEEN_CAPACITY,
+        error_rate: float = DEFAULT_SEEN_ERROR_RATE
+    ) -> 'SeenFilter':
+        """
+        Load the filter saved at `path`, or build it from the `url` table if
+        there is none, it was created with a different configuration or for
+        another database.
+        """
+        seen = SeenFilter(capacity, error_rate)
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                header = file.read(HEADER.size)
+                if len(header) == HEADER.size:
+                    magic, size, hashes, max_url_id, digest = HEADER.unpack(header)
+                    # the URL it ends with has to be the same, a recreated
+                    # database would otherwise see new URLs as seen
+                    if max_url_id > 0:
+                        belongs = SeenFilter.url_digest(con, max_url_id) == digest
+                    else:
+                        belongs = True
+                    if belongs and (magic, size, hashes) == (MAGIC, seen.size, seen.hashes):
+                        bits = file.read()
+                        if len(bits) == len(seen.bits):
+                            seen.bits = bytearray(bits)
+                            seen.max_url_id = max_url_id
+        seen.catch_up(con)
+        return seen
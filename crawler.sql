@@ -22,10 +22,29 @@ CREATE TABLE IF NOT EXISTS "request" (
 	"duration"	REAL,
 	"status"	ANY,
 	"headers"	TEXT,
-	"data"	BLOB,
-	FOREIGN KEY("url_id") REFERENCES "url"
+	"body_id"	INTEGER,
+	FOREIGN KEY("url_id") REFERENCES "url",
+	FOREIGN KEY("body_id") REFERENCES "body"
 ) STRICT;
 
+-- response bodies, stored once no matter how many requests returned them
+CREATE TABLE IF NOT EXISTS "body" (
+	"id"	INTEGER NOT NULL PRIMARY KEY,
+	-- SHA-256 of the uncompressed body
+	"digest"	BLOB NOT NULL UNIQUE,
+	"data"	BLOB NOT NULL,
+	-- NULL if "data" is uncompressed, see crawl/compress.py
+	"encoding"	TEXT
+) STRICT;
+
+-- preset dictionaries for compressing "body"."data" with zlib
+CREATE TABLE IF NOT EXISTS "compression_dict" (
+	"id"	INTEGER PRIMARY KEY,
+	"data"	BLOB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS "request_url_time" ON "request" ("url_id", "time");
+
 CREATE TABLE IF NOT EXISTS "url" (
 	"id"	INTEGER	PRIMARY KEY,
 	"url"	TEXT NOT NULL UNIQUE,
@@ -33,12 +52,39 @@ CREATE TABLE IF NOT EXISTS "url" (
 	FOREIGN KEY("document_id") REFERENCES "document"
 );
 
+-- positions only determine the order, there can be gaps between them
 CREATE TABLE IF NOT EXISTS "frontier" (
 	"position"	INTEGER	UNIQUE,
 	"url_id"	INTEGER PRIMARY KEY,
 	FOREIGN KEY("url_id") REFERENCES "url"
 );
 
+-- keep track of the frontier size, COUNT() would have to scan it
+CREATE TABLE IF NOT EXISTS "frontier_size" (
+	"size"	INTEGER NOT NULL
+);
+INSERT INTO "frontier_size" ("size")
+	SELECT 0 WHERE NOT EXISTS (SELECT * FROM "frontier_size");
+
+CREATE TRIGGER IF NOT EXISTS "frontier_size_insert"
+AFTER INSERT ON "frontier" BEGIN
+	UPDATE "frontier_size" SET "size" = "size" + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS "frontier_size_delete"
+AFTER DELETE ON "frontier" BEGIN
+	UPDATE "frontier_size" SET "size" = "size" - 1;
+END;
+
+-- URLs that can't be fetched before "ready" (a timestamp)
+CREATE TABLE IF NOT EXISTS "deferred" (
+	"url_id"	INTEGER PRIMARY KEY,
+	"ready"	REAL NOT NULL,
+	FOREIGN KEY("url_id") REFERENCES "url"
+);
+
+CREATE INDEX IF NOT EXISTS "deferred_ready" ON "deferred" ("ready");
+
 CREATE VIEW IF NOT EXISTS "frontier_urls" AS
 	SELECT
 		frontier.position AS 'position',
@@ -55,9 +101,11 @@ CREATE VIEW IF NOT EXISTS "request_urls" AS
 		duration,
 		status,
 		headers,
-		data
+		body.data,
+		body.encoding
 	FROM request
 	JOIN url ON url_id = url.id
+	LEFT JOIN body ON body_id = body.id
 	ORDER BY time;
 
 CREATE VIEW IF NOT EXISTS "size_by_extension" AS
@@ -79,9 +127,13 @@ CREATE VIEW IF NOT EXISTS "size_by_extension" AS
 	FROM request
 	JOIN extension on url_id = extension.id
 	JOIN url on url_id = url.id
+	LEFT JOIN body on body_id = body.id
 	WHERE extension IS NOT NULL
 	GROUP BY extension
 	ORDER BY total DESC;
 
+-- number of migrations in crawl/migrate.py reflected by this schema
+PRAGMA user_version = 6;
+
 COMMIT;
 
@@ -8,7 +8,9 @@ CREATE TABLE IF NOT EXISTS "host" (
 	"refill_rate"	REAL,
 	"refill_cap"	REAL CHECK(refill_cap >= 0),
 	"updated"	REAL,
-	"tokens"	REAL CHECK(tokens >= 0 AND tokens <= refill_cap)
+	"tokens"	REAL CHECK(tokens >= 0 AND tokens <= refill_cap),
+	-- when the robots.txt was fetched, it is refreshed after a day
+	"fetched"	REAL
 );
 
 COMMIT;
@@ -16,9 +16,18 @@ CREATE TABLE IF NOT EXISTS "inverted_index" (
     "word_id" INTEGER NOT NULL,
     "document_id" INTEGER NOT NULL,
     "position" INTEGER NOT NULL,
-    UNIQUE("document_id", "position"),
     FOREIGN KEY("word_id") REFERENCES "word",
     FOREIGN KEY("document_id") REFERENCES "document"
 );
 
+-- explicit, so that bulk loads can drop & rebuild them (see crawl.index)
+CREATE UNIQUE INDEX IF NOT EXISTS "inverted_index_position" ON "inverted_index" ("document_id", "position");
+CREATE INDEX IF NOT EXISTS "inverted_index_word" ON "inverted_index" ("word_id");
+
+-- word -> lemma, warm-starts the lemmatizer cache of the next index build
+CREATE TABLE IF NOT EXISTS "lemma" (
+    "word"  TEXT NOT NULL PRIMARY KEY,
+    "lemma" TEXT NOT NULL
+) WITHOUT ROWID;
+
 COMMIT;
@@ -0,0 +1,109 @@
+import os
+import time
+
+import apsw
+import pytest
+
+import crawl.document
+from crawl.document import Document
+import crawl.process
+from crawl.robots import Host
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def repo_dir(monkeypatch):
+    # the SQL scripts are looked up relative to the working directory
+    monkeypatch.chdir(REPO)
+
+
+def create_db(path: str, script: str) -> apsw.Connection:
+    con = apsw.Connection(path)
+    with open(os.path.join(REPO, script)) as file:
+        con.execute(file.read())
+    return con
+
+
+def store_document(
+    con: apsw.Connection,
+    url: str,
+    text: str,
+    title: str | None = None,
+    simhash: int = 1
+) -> int:
+    """
+    Store a crawled page without fetching & parsing it, returns its id
+    """
+    con.execute("INSERT OR IGNORE INTO url (url) VALUES (?1)", (url, ))
+    (request_id, ) = con.execute(
+        "INSERT INTO request (url_id, time, status) \
+        VALUES ((SELECT id FROM url WHERE url = ?1), ?2, 200) \
+        RETURNING id",
+        (url, time.time())
+    ).fetchone()
+    doc = Document(request_id, url, None, None)
+    doc.title = title
+    doc.text_content = text
+    doc.lang = "en"
+    doc.relevance_score = 1.0
+    doc.simhash_value = simhash
+    return doc.save(con)
+
+
+def open_host(origin: str, refill_cap: float = 1) -> Host:
+    """
+    A host without robots.txt & a full bucket, refilled once per second
+    """
+    host = Host(origin)
+    host.global_policy = True
+    host.robots_txt = None
+    host.refill_cap = refill_cap
+    host.refill_rate = 1.0
+    host.updated = time.time()
+    host.fetched = host.updated
+    host.tokens = host.refill_cap
+    return host
+
+
+@pytest.fixture
+def crawl_db(tmp_path) -> str:
+    path = str(tmp_path / "crawler.db")
+    create_db(path, "crawler.sql").close()
+    return path
+
+
+@pytest.fixture
+def index_db(tmp_path) -> str:
+    path = str(tmp_path / "index.db")
+    create_db(path, "index.sql").close()
+    return path
+
+
+class FakeLemmatizer:
+    # strips a plural "s", enough to tell lemmas from words
+    def lemmatize(self, word, pos='n'):
+        return word[:-1] if word.endswith("s") and len(word) > 3 else word
+
+
+@pytest.fixture
+def fake_nltk(monkeypatch):
+    """
+    Lemmatize & filter stop words without the NLTK corpora
+    """
+    monkeypatch.setattr(crawl.process, "lemmatizer", FakeLemmatizer)
+    monkeypatch.setattr(
+        crawl.process,
+        "stop_words",
+        lambda: frozenset({"a", "and", "are", "is", "of", "on", "the"})
+    )
+    caches = [
+        crawl.process.lemma_cache.entries.clear,
+        crawl.document.stemmed_keywords.cache_clear,
+        crawl.document.keyword_prefilter.cache_clear,
+    ]
+    for clear in caches:
+        clear()
+    yield
+    for clear in caches:
+        clear()
@@ -0,0 +1,55 @@
+import apsw
+import pytest
+
+import crawl.compress
+from crawl.compress import CODECS, compress, decompress, recompress_db, store_dictionary, train_dictionary
+
+PAGES = [
+    f"<html><head><title>page {i}</title></head><body><p>text {i}</p></body></html>".encode()
+    for i in range(10)
+]
+
+
+@pytest.fixture(autouse=True)
+def dictionaries(monkeypatch):
+    # dictionary ids are only unique per database
+    monkeypatch.setattr(crawl.compress, "_dictionaries", {})
+
+
+@pytest.mark.parametrize("codec", [*CODECS, None])
+def test_round_trip(codec):
+    data, encoding = compress(PAGES[0], codec)
+    assert encoding == codec
+    assert decompress(data, encoding) == PAGES[0]
+
+
+def test_dictionary_round_trip(crawl_db):
+    con = apsw.Connection(crawl_db)
+    zdict = train_dictionary(PAGES)
+    assert b"<head>" in zdict
+    dict_id = store_dictionary(con, zdict)
+    data, encoding = compress(PAGES[0], "zlib", (dict_id, zdict))
+    assert encoding == f"zlib:{dict_id}"
+    assert len(data) < len(compress(PAGES[0], "zlib")[0])
+
+    # loaded from the database
+    crawl.compress._dictionaries.clear()
+    assert decompress(data, encoding, con) == PAGES[0]
+    with pytest.raises(Exception):
+        decompress(data, encoding)
+
+
+def test_recompress_db(crawl_db):
+    con = apsw.Connection(crawl_db)
+    for i, page in enumerate(PAGES):
+        # some uncompressed, some zlib
+        data, encoding = compress(page, "zlib" if i % 2 else None)
+        con.execute(
+            "INSERT INTO body (digest, data, encoding) VALUES (?1, ?2, ?3)",
+            (bytes([i]), data, encoding)
+        )
+    batches = list(recompress_db(con, "lzma", batch_size=4))
+    assert [count for count, _, _ in batches] == [4, 4, 2]
+    rows = con.execute("SELECT data, encoding FROM body ORDER BY id").fetchall()
+    assert all(encoding == "lzma" for _, encoding in rows)
+    assert [decompress(data, encoding) for data, encoding in rows] == PAGES
@@ -0,0 +1,92 @@
+import random
+
+import apsw
+import pytest
+
+from conftest import create_db, store_document
+import crawl.dedup
+from crawl.dedup import SIMHASH_BITS, SimhashIndex
+from crawl.document import Document
+from crawl.process import SIMHASH_THRESHOLD, is_near_duplicate_simhash
+
+
+def flip(simhash: int, rng: random.Random, bits: int) -> int:
+    for bit in rng.sample(range(SIMHASH_BITS), bits):
+        simhash ^= 1 << bit
+    return simhash
+
+
+@pytest.mark.parametrize("block_count", [None, 16, 8, 6, 4])
+def test_finds_what_a_scan_finds(block_count):
+    rng = random.Random(0)
+    fingerprints = [rng.getrandbits(SIMHASH_BITS) for _ in range(200)]
+    # variants right at & just past the threshold
+    fingerprints += [flip(fingerprints[i], rng, SIMHASH_THRESHOLD + i % 2) for i in range(100)]
+    index = SimhashIndex(block_count=block_count)
+    for doc_id, simhash in enumerate(fingerprints, start=1):
+        index.add(doc_id, simhash)
+    for query in fingerprints[:100]:
+        assert index.near_duplicates(query) == [
+            doc_id
+            for doc_id, simhash in enumerate(fingerprints, start=1)
+            if is_near_duplicate_simhash(query, simhash)
+        ]
+
+
+def test_block_count_follows_the_size(monkeypatch):
+    monkeypatch.setattr(crawl.dedup, "PLANNED_DOCUMENTS", 16)
+    rng = random.Random(0)
+    index = SimhashIndex()
+    assert index.block_count == 16
+    fingerprints = {}
+    for doc_id in range(1, 3001):
+        fingerprints[doc_id] = rng.getrandbits(SIMHASH_BITS)
+        index.add(doc_id, fingerprints[doc_id])
+    # rebuilt with wider blocks & still complete
+    assert index.block_count < 16
+    assert sum(len(bucket) for bucket in index.tables[0].values()) == 3000
+    for doc_id in range(1, 3001, 100):
+        query = flip(fingerprints[doc_id], rng, SIMHASH_THRESHOLD)
+        assert doc_id in index.near_duplicates(query)
+
+
+def test_load_catches_up(crawl_db):
+    con = apsw.Connection(crawl_db)
+    first = store_document(con, "https://a.test/", "a", simhash=1)
+    path = crawl_db + ".simhash"
+    SimhashIndex.load(path, con).save(path, con)
+    second = store_document(con, "https://b.test/", "b", simhash=2)
+    index = SimhashIndex.load(path, con)
+    assert index.fingerprints == {first: 1, second: 2}
+    assert index.max_doc_id == second
+
+
+def test_load_rejects_other_db(crawl_db, tmp_path):
+    con = apsw.Connection(crawl_db)
+    store_document(con, "https://a.test/", "a", simhash=1)
+    path = crawl_db + ".simhash"
+    SimhashIndex.load(path, con).save(path, con)
+
+    # same id, another document
+    other = create_db(str(tmp_path / "other.db"), "crawler.sql")
+    store_document(other, "https://a.test/", "a", simhash=2)
+    assert SimhashIndex.load(path, other).fingerprints == {1: 2}
+
+    empty = create_db(str(tmp_path / "empty.db"), "crawler.sql")
+    assert len(SimhashIndex.load(path, empty)) == 0
+
+
+def test_duplicates_of_other_urls(crawl_db):
+    con = apsw.Connection(crawl_db)
+    index = SimhashIndex()
+    doc_id = store_document(con, "https://a.test/", "a", simhash=1)
+    index.add(doc_id, 1)
+    # left over from another database
+    index.add(doc_id + 1, 1)
+
+    doc = Document(None, "https://a.test/", None, None)
+    doc.simhash_value = 1
+    # a recrawl of the same page
+    assert not doc.check_for_duplicates(con, index)
+    doc.url = "https://b.test/"
+    assert doc.check_for_duplicates(con, index)
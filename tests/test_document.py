@@ -0,0 +1,47 @@
+import re
+
+import crawl.document
+from crawl.document import Document, keyword_prefilter
+
+PAGES = [
+    ("https://example.org/", "Walking along the Neckar in spring"),
+    ("https://example.org/", "Two Neckars and the Swabians of old"),
+    ("https://example.org/", "TÜBINGEN is a university town"),
+    ("https://example.org/", "Schwäbisch food is hearty"),
+    ("https://example.org/", "Nothing of interest is on this page"),
+    ("https://example.org/tuebingen", "A page with the keyword only in its URL"),
+    ("https://example.org/", ""),
+]
+
+
+def relevance(url: str, text: str, lang="en") -> Document:
+    doc = Document(None, url, None, None)
+    doc.lang = lang
+    doc.text_content = text
+    doc.relevance()
+    return doc
+
+
+def test_prefilter_keeps_scores(fake_nltk, monkeypatch):
+    prefiltered = [relevance(url, text) for url, text in PAGES]
+    assert [doc.prefiltered for doc in prefiltered] == [False] * 4 + [True, False, True]
+    assert all(doc.relevance_score > 0 for doc in prefiltered[:4])
+
+    # every page lemmatized
+    monkeypatch.setattr(crawl.document, "keyword_prefilter", lambda: re.compile(""))
+    unfiltered = [relevance(url, text) for url, text in PAGES]
+    assert not any(doc.prefiltered for doc in unfiltered)
+    assert [doc.relevance_score for doc in prefiltered] == [doc.relevance_score for doc in unfiltered]
+
+
+def test_prefilter_matches_inflections(fake_nltk):
+    prefilter = keyword_prefilter()
+    for word in ("neckar", "neckars", "swabians", "tübinger", "hohenzollern's"):
+        assert prefilter.search(word), word
+    assert not prefilter.search("necklace")
+
+
+def test_other_languages_are_irrelevant(fake_nltk):
+    doc = relevance("https://example.org/", "Tübingen am Neckar", lang="de")
+    assert doc.relevance_score == 0.0
+    assert not doc.prefiltered
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from crawl.document import Document
+
+PAGES = os.path.join(os.path.dirname(__file__), "pages")
+
+
+def extract(data: bytes, parser: str) -> dict:
+    doc = Document(1, "https://example.org/dir/page", {}, data)
+    doc.parser = parser
+    doc.parse()
+    return {
+        "language": doc.lang,
+        "title": doc.title,
+        "description": doc.meta_description,
+        "text": doc.text_content,
+        "links": doc.link_urls,
+    }
+
+
+@pytest.mark.parametrize("page", sorted(os.listdir(PAGES)))
+def test_stream_matches_soup(page):
+    with open(os.path.join(PAGES, page), "rb") as file:
+        data = file.read()
+    assert extract(data, "stream") == extract(data, "soup")
+
+
+def test_extracts_page():
+    with open(os.path.join(PAGES, "structure.html"), "rb") as file:
+        data = file.read()
+    assert extract(data, "stream") == {
+        "language": "en",
+        "title": "Hi & there",
+        "description": "desc",
+        "text": "Hi & there Hello world ! X",
+        "links": ["https://example.org/n", "https://example.org/dir/x.html"],
+    }
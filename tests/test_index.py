@@ -0,0 +1,196 @@
+import apsw
+import pytest
+
+from conftest import create_db, store_document
+from crawl.document import Document
+import crawl.index
+from crawl.index import INDEXES, index, index_all_db
+from crawl.migrate import current_documents
+
+
+def indexed(index_db: str) -> dict[str, tuple[int, list[str]]]:
+    # URL -> document id & its words in order
+    con = apsw.Connection(index_db)
+    documents = {}
+    for doc_id, url in con.execute("SELECT id, url FROM document"):
+        words = [
+            word for (word, ) in con.execute(
+                "SELECT word FROM inverted_index \
+                JOIN word ON word_id = word.id \
+                WHERE document_id = ?1 \
+                ORDER BY position",
+                (doc_id, )
+            )
+        ]
+        documents[url] = (doc_id, words)
+    (orphans, ) = con.execute(
+        "SELECT COUNT() FROM inverted_index \
+        WHERE document_id NOT IN (SELECT id FROM document)"
+    ).fetchone()
+    assert orphans == 0
+    return documents
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_recrawl_replaces_document(crawl_db, index_db, fake_nltk, jobs):
+    con = apsw.Connection(crawl_db)
+    old = store_document(con, "https://a.test/", "old crawler pages")
+    other = store_document(con, "https://b.test/", "search engines")
+    index_all_db(crawl_db, index_db, jobs=jobs)
+    assert indexed(index_db) == {
+        "https://a.test/": (old, ["old", "crawler", "page"]),
+        "https://b.test/": (other, ["search", "engine"]),
+    }
+
+    new = store_document(con, "https://a.test/", "new text")
+    assert con.execute(
+        "SELECT document_id FROM url WHERE url = 'https://a.test/'"
+    ).fetchone() == (new, )
+    index_all_db(crawl_db, index_db, jobs=jobs)
+    assert indexed(index_db) == {
+        "https://a.test/": (new, ["new", "text"]),
+        "https://b.test/": (other, ["search", "engine"]),
+    }
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_interrupted_run_keeps_indexes(crawl_db, index_db, fake_nltk, monkeypatch, jobs):
+    con = apsw.Connection(crawl_db)
+    first = store_document(con, "https://a.test/", "crawler pages")
+    second = store_document(con, "https://b.test/", "search engines")
+    with monkeypatch.context() as patch:
+        if jobs == 1:
+            load_all = Document.load_all
+
+            def interrupted(con, doc_ids=None):
+                yield next(load_all(con, doc_ids))
+                raise KeyboardInterrupt
+            patch.setattr(Document, "load_all", staticmethod(interrupted))
+        else:
+            merge_run = crawl.index.merge_run
+            merged = []
+
+            def interrupted(con, run_db):
+                if merged:
+                    raise KeyboardInterrupt
+                merge_run(con, run_db)
+                merged.append(run_db)
+            patch.setattr(crawl.index, "merge_run", interrupted)
+            patch.setattr(crawl.index, "RUNS_PER_JOB", 1)
+        with pytest.raises(KeyboardInterrupt):
+            index_all_db(crawl_db, index_db, jobs=jobs)
+
+    index_con = apsw.Connection(index_db)
+    assert {
+        name for (name, ) in index_con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )
+    } >= set(INDEXES)
+    assert indexed(index_db) == {"https://a.test/": (first, ["crawler", "page"])}
+
+    index_all_db(crawl_db, index_db, jobs=jobs)
+    assert indexed(index_db) == {
+        "https://a.test/": (first, ["crawler", "page"]),
+        "https://b.test/": (second, ["search", "engine"]),
+    }
+
+
+def test_index_replaces_document(crawl_db, index_db, fake_nltk):
+    crawl_con = apsw.Connection(crawl_db)
+    old = store_document(crawl_con, "https://a.test/", "old text")
+    new = store_document(crawl_con, "https://a.test/", "new text")
+    index_con = apsw.Connection(index_db)
+    old_doc, new_doc = Document.load_all(crawl_con, [old, new])
+    index(old_doc, index_con)
+    index(new_doc, index_con)
+    # an older document doesn't replace a newer one
+    index(old_doc, index_con)
+    assert indexed(index_db) == {"https://a.test/": (new, ["new", "text"])}
+
+
+def test_migration_sets_current_documents(crawl_db):
+    con = apsw.Connection(crawl_db)
+    store_document(con, "https://a.test/", "old text")
+    new = store_document(con, "https://a.test/", "new text")
+    con.execute("UPDATE url SET document_id = NULL")
+    current_documents(con)
+    assert con.execute("SELECT url, document_id FROM url").fetchall() == [
+        ("https://a.test/", new)
+    ]
+
+
+LEGACY_SCHEMA = """
+CREATE TABLE "document" (
+    "id" INTEGER NOT NULL PRIMARY KEY,
+    "content" TEXT,
+    "title" TEXT,
+    "url" TEXT NOT NULL UNIQUE
+);
+CREATE TABLE "word" (
+    "id" INTEGER NOT NULL PRIMARY KEY,
+    "word" TEXT NOT NULL UNIQUE
+);
+CREATE TABLE "inverted_index" (
+    "word_id" INTEGER NOT NULL,
+    "document_id" INTEGER NOT NULL,
+    "position" INTEGER NOT NULL,
+    UNIQUE("document_id", "position"),
+    FOREIGN KEY("word_id") REFERENCES "word",
+    FOREIGN KEY("document_id") REFERENCES "document"
+);
+"""
+
+
+def test_migrates_legacy_index(crawl_db, tmp_path, fake_nltk):
+    index_db = str(tmp_path / "legacy.db")
+    con = apsw.Connection(index_db)
+    con.execute(LEGACY_SCHEMA)
+    con.execute(
+        "INSERT INTO document (id, content, title, url) VALUES (100, 'old', NULL, 'https://old.test/'); \
+        INSERT INTO word (id, word) VALUES (1, 'old'); \
+        INSERT INTO inverted_index (word_id, document_id, position) VALUES (1, 100, 0);"
+    )
+    doc_id = store_document(apsw.Connection(crawl_db), "https://a.test/", "new text")
+    index_all_db(crawl_db, index_db)
+
+    assert indexed(index_db) == {
+        "https://old.test/": (100, ["old"]),
+        "https://a.test/": (doc_id, ["new", "text"]),
+    }
+    assert sorted(
+        name for (name, ) in con.execute(
+            "SELECT name FROM sqlite_master \
+            WHERE type = 'index' AND tbl_name = 'inverted_index'"
+        )
+    ) == ["inverted_index_position", "inverted_index_word"]
+    with pytest.raises(apsw.ConstraintError):
+        con.execute(
+            "INSERT INTO inverted_index (word_id, document_id, position) VALUES (1, 100, 0)"
+        )
+
+
+def test_parallel_runs_match_single_job(crawl_db, tmp_path, fake_nltk):
+    con = apsw.Connection(crawl_db)
+    texts = [
+        f"page {i} about crawlers, indexes and {'rivers' if i % 2 else 'towns'} number {i % 3}"
+        for i in range(10)
+    ]
+    for i, text in enumerate(texts[:3]):
+        store_document(con, f"https://a.test/{i}", text)
+    parallel_db = str(tmp_path / "parallel.db")
+    create_db(parallel_db, "index.sql").close()
+    # word ids of the runs are translated into those already in the index
+    index_all_db(crawl_db, parallel_db, jobs=2)
+    for i, text in enumerate(texts[3:], start=3):
+        store_document(con, f"https://a.test/{i}", text)
+    index_all_db(crawl_db, parallel_db, jobs=2, batch_size=5)
+
+    single_db = str(tmp_path / "single.db")
+    create_db(single_db, "index.sql").close()
+    index_all_db(crawl_db, single_db)
+    assert len(indexed(single_db)) == 10
+    assert indexed(parallel_db) == indexed(single_db)
+    lemmas = "SELECT word, lemma FROM lemma ORDER BY word"
+    stored = apsw.Connection(parallel_db).execute(lemmas).fetchall()
+    assert ("rivers", "river") in stored
+    assert stored == apsw.Connection(single_db).execute(lemmas).fetchall()
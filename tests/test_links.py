@@ -0,0 +1,72 @@
+from crawl.links import LinkNormalizer
+
+BASE = "https://example.org/dir/page"
+
+
+def test_resolves_relative_links():
+    links = LinkNormalizer()
+    assert links.normalize_all(BASE, [
+        "other",
+        "../up",
+        "/root",
+        "//cdn.example.net/lib",
+        "https://example.com/a/../b",
+        "?q=1",
+        None,
+        "",
+    ]) == [
+        "https://example.org/dir/other",
+        "https://example.org/up",
+        "https://example.org/root",
+        "https://cdn.example.net/lib",
+        "https://example.com/b",
+        "https://example.org/dir/page?q=1",
+    ]
+
+
+def test_fragments():
+    links = LinkNormalizer()
+    assert links.normalize(BASE, "#top") is None
+    assert links.normalize(BASE, "other#top") == "https://example.org/dir/other"
+    links = LinkNormalizer(skip_fragments=False)
+    assert links.normalize(BASE, "#top") == BASE
+
+
+def test_schemes():
+    links = LinkNormalizer()
+    for href in ("mailto:someone@example.org", "javascript:void(0)", "ftp://example.org/file"):
+        assert links.normalize(BASE, href) is None
+    links = LinkNormalizer(schemes=("https", "ftp"))
+    assert links.normalize(BASE, "ftp://example.org/file") == "ftp://example.org/file"
+    assert links.normalize(BASE, "http://example.org/") is None
+
+
+def test_wikipedia_languages():
+    hrefs = ["https://en.wikipedia.org/wiki/A", "https://de.wikipedia.org/wiki/A"]
+    assert LinkNormalizer().normalize_all(BASE, hrefs) == hrefs[:1]
+    assert LinkNormalizer(wikipedia_languages=("de", )).normalize_all(BASE, hrefs) == hrefs[1:]
+    assert LinkNormalizer(wikipedia_languages=None).normalize_all(BASE, hrefs) == hrefs
+
+
+def test_cache_is_shared_across_pages():
+    links = LinkNormalizer()
+    pages = ["https://example.org/a", "https://example.org/b/c?x=1"]
+    for page in pages:
+        links.normalize_all(page, ["/nav", "https://example.com/", "//cdn.example.net/lib"])
+    assert links.stats() == {"size": 3, "hits": 3, "misses": 3}
+
+    # only the part of the base the result depends on
+    assert links.normalize("https://example.net/a", "/nav") == "https://example.net/nav"
+    assert links.normalize("http://example.org/a", "//cdn.example.net/lib") == "http://cdn.example.net/lib"
+    assert links.normalize("https://example.org/b/c", "d") == "https://example.org/b/d"
+    assert links.normalize("https://example.org/e/f", "d") == "https://example.org/e/d"
+    assert links.stats()["misses"] == 7
+
+
+def test_cache_size():
+    links = LinkNormalizer(size=2)
+    for href in ("/a", "/b", "/c"):
+        links.normalize(BASE, href)
+    assert links.stats()["size"] == 2
+    links.normalize(BASE, "/a")
+    assert links.stats()["misses"] == 4
@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+
+from conftest import open_host
+import crawl.loop
+import crawl.robots
+from crawl.loop import ROBOTS_WAIT, Crawler
+from crawl.migrate import POSITION_GAP
+
+
+class FakePipe:
+    def __init__(self):
+        self.sent = []
+
+
+    def send(self, work):
+        self.sent.append(work)
+
+
+@pytest.fixture
+def crawler(crawl_db, tmp_path, monkeypatch):
+    # robots.txt fetches never finish
+    released = threading.Event()
+    monkeypatch.setattr(crawl.robots, "fetch_host", lambda origin: released.wait())
+    crawler = Crawler(
+        crawl_db,
+        str(tmp_path / "hosts.db"),
+        seen_capacity=1000,
+        seen_file=False,
+        simhash_file=False
+    )
+    yield crawler
+    released.set()
+    crawler.prefetcher.close()
+
+
+def test_waits_for_robots(crawler):
+    crawler.queue.push("https://a.test/1")
+    pipe = FakePipe()
+    crawler.give_work(pipe)
+    assert crawler.buffered == 1
+    assert crawler.ready == []
+    assert pipe.sent == [ROBOTS_WAIT]
+
+
+def test_alternates_hosts(crawler):
+    for origin in ("https://a.test", "https://b.test"):
+        crawler.host_cache.store(open_host(origin))
+    for url in ("https://a.test/1", "https://a.test/2", "https://b.test/1"):
+        crawler.queue.push(url)
+    pipe = FakePipe()
+    for _ in range(3):
+        crawler.give_work(pipe)
+    first, second, wait = pipe.sent
+    assert {first.url, second.url} == {"https://a.test/1", "https://b.test/1"}
+    # both buckets are empty, a.test has the next URL
+    assert 0.0 < wait <= 1.0
+    assert crawler.buffered == 1
+    assert list(crawler.back_queues) == ["https://a.test"]
+
+
+def test_host_queues_are_capped(crawler, monkeypatch):
+    monkeypatch.setattr(crawl.loop, "HOST_QUEUE_CAPACITY", 3)
+    crawler.queue.push_many_if_new(
+        [f"https://big.test/{i}" for i in range(10)] + ["https://small.test/1"]
+    )
+    crawler.give_work(FakePipe())
+    assert {
+        origin: [req.url for req in back_queue]
+        for origin, back_queue in crawler.back_queues.items()
+    } == {
+        "https://big.test": [f"https://big.test/{i}" for i in range(3)],
+        "https://small.test": ["https://small.test/1"],
+    }
+    # the rest waits in the frontier
+    assert len(crawler.queue) == 11
+
+
+def test_urls_leave_the_frontier_when_dispatched(crawler):
+    crawler.host_cache.store(open_host("https://a.test"))
+    crawler.queue.push_many_if_new(["https://a.test/1", "https://a.test/2"])
+    pipe = FakePipe()
+    crawler.give_work(pipe)
+    assert pipe.sent[0].url == "https://a.test/1"
+    assert crawler.buffered == 1
+    # a crash now keeps the buffered URL
+    assert crawler.queue.scan(None, 10) == [(POSITION_GAP, "https://a.test/2")]
+    crawler.close()
+    assert len(crawler.queue) == 1
@@ -0,0 +1,109 @@
+import hashlib
+import re
+
+import apsw
+import pytest
+
+import crawl.process
+from crawl.process import LemmaCache, compute_simhash, preprocess_text
+
+TEXT = "The towers of Tübingen are old and the towers are tall, Neckar boats float on the Neckar"
+
+
+def uncached(text: str) -> list[str]:
+    lemmatizer = crawl.process.lemmatizer()
+    stop = crawl.process.stop_words()
+    words = re.findall(r'\b\w+\b', text.lower())
+    return [
+        lemma
+        for lemma in (lemmatizer.lemmatize(word) for word in words)
+        if lemma not in stop
+    ]
+
+
+@pytest.mark.parametrize("size", [crawl.process.LEMMA_CACHE_SIZE, 2])
+def test_cached_lemmas_match_the_lemmatizer(fake_nltk, monkeypatch, size):
+    cache = LemmaCache(size)
+    monkeypatch.setattr(crawl.process, "lemma_cache", cache)
+    expected = uncached(TEXT)
+    assert "tower" in expected
+
+    assert preprocess_text(TEXT) == expected
+    # warm, or evicting all the time with a tiny cache
+    assert preprocess_text(TEXT) == expected
+    assert len(cache.entries) <= size
+    if size > 2:
+        assert cache.stats()["misses"] == len(set(re.findall(r'\b\w+\b', TEXT.lower())))
+
+
+def test_lemmas_round_trip_through_the_index(fake_nltk, index_db, tmp_path):
+    # older index databases don't have the table yet
+    assert LemmaCache().load(apsw.Connection(str(tmp_path / "old.db"))) == 0
+
+    con = apsw.Connection(index_db)
+    cache = LemmaCache()
+    cache.lemmatize_all(["towers", "boats", "is"])
+    cache.store(con)
+    assert set(con.execute("SELECT word, lemma FROM lemma")) == {
+        ("towers", "tower"),
+        ("boats", "boat"),
+        ("is", "is"),
+    }
+
+    loaded = LemmaCache()
+    assert loaded.load(con) == 3
+    assert loaded.entries == cache.entries
+    # answered from the loaded entries
+    assert loaded.lemmatize_all(["boats", "towers"]) == ["boat", "tower"]
+    assert loaded.stats() == {"size": 3, "hits": 2, "misses": 0}
+
+
+MASK64 = 2**64 - 1
+
+
+def fmix64(h: int) -> int:
+    h ^= h >> 33
+    h = h * 0xff51afd7ed558ccd & MASK64
+    h ^= h >> 33
+    h = h * 0xc4ceb9fe1a85ec53 & MASK64
+    return h ^ h >> 33
+
+
+def fnv_hash(shingle: str) -> int:
+    h = 0xcbf29ce484222325
+    for char in shingle:
+        h = (h ^ ord(char)) * 0x100000001b3 & MASK64
+    high, low = (fmix64(h ^ seed) for seed in (0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f))
+    return high << 64 | low
+
+
+@pytest.mark.parametrize("shingle", ["abcde", "Spätz", "首都です🏯"])
+def test_one_shingle_is_its_own_simhash(shingle):
+    assert compute_simhash([shingle], len(shingle), "md5") == int(hashlib.md5(shingle.encode()).hexdigest(), 16)
+    assert compute_simhash([shingle], len(shingle), "fnv") == fnv_hash(shingle)
+
+
+# stored fingerprints have to stay comparable with new ones
+@pytest.mark.parametrize("texts, md5, fnv", [
+    (
+        ["The old town has half-timbered houses and a castle above the river"],
+        0x061d7a8f5efeddc552fc0f98a0da2444,
+        0x76aa8f9a299c1f532321feae47621b6d,
+    ),
+    (
+        ["Schwäbisch Gmünd & Tübingen: Spätzle, Maultaschen", "Straße"],
+        0xb3acd878110c041ab2cefeab9627198d,
+        0x4cb9a637e186f032eeb8ce2a6ceba54b,
+    ),
+    (
+        ["東京は日本の首都です 🏯"],
+        0xf5a76bf7b5a6dd6afdffd3d93fd5f5be,
+        0x6c16bff5f2e3ddebe69e4e8dff557aec,
+    ),
+    # too short for a single shingle
+    (["abc"], 2**128 - 1, 2**128 - 1),
+    ([], 2**128 - 1, 2**128 - 1),
+])
+def test_simhash_is_stable(texts, md5, fnv):
+    assert compute_simhash(texts, hash="md5") == md5
+    assert compute_simhash(texts, hash="fnv") == fnv
@@ -0,0 +1,111 @@
+from crawl.migrate import POSITION_GAP
+from crawl.queue import Queue
+
+
+def positions(queue: Queue) -> list[tuple[int, str]]:
+    return list(queue.con.execute(
+        "SELECT position, url FROM frontier \
+        JOIN url ON url_id = url.id \
+        ORDER BY position"
+    ))
+
+
+def test_pop_keeps_positions(crawl_db):
+    queue = Queue(crawl_db)
+    for url in ("a", "b", "c"):
+        queue.push(url)
+    assert len(queue) == 3
+    assert queue.pop() == "a"
+    assert positions(queue) == [(POSITION_GAP, "b"), (2 * POSITION_GAP, "c")]
+    assert len(queue) == 2
+    assert list(queue) == ["b", "c"]
+    assert queue.pop() is None
+    assert len(queue) == 0
+
+
+def test_push_skips_queued(crawl_db):
+    queue = Queue(crawl_db)
+    queue.push("a")
+    queue.push("a")
+    assert len(queue) == 1
+
+
+def test_insert_uses_gap(crawl_db):
+    queue = Queue(crawl_db)
+    queue.push("a")
+    queue.push("c")
+    queue.insert("b", 1)
+    assert positions(queue) == [
+        (0, "a"),
+        (POSITION_GAP // 2, "b"),
+        (POSITION_GAP, "c"),
+    ]
+    queue.insert("first", 0)
+    assert [url for _, url in positions(queue)] == ["first", "a", "b", "c"]
+
+
+def test_insert_shifts_without_gap(crawl_db):
+    queue = Queue(crawl_db)
+    queue.push("a")
+    queue.push("z")
+    # fill the gap between "a" & "z" until there is no room left
+    for i in range(20):
+        queue.insert(f"m{i}", 1)
+    urls = [url for _, url in positions(queue)]
+    assert urls == ["a", *(f"m{i}" for i in reversed(range(20))), "z"]
+    assert len(queue) == 22
+
+
+def test_insert_moves_queued_url(crawl_db):
+    queue = Queue(crawl_db)
+    for url in ("a", "b", "c"):
+        queue.push(url)
+    queue.insert("c", 0)
+    assert [url for _, url in positions(queue)] == ["c", "a", "b"]
+    assert len(queue) == 3
+
+
+def test_pop_many(crawl_db):
+    queue = Queue(crawl_db)
+    for url in ("a", "b", "c"):
+        queue.push(url)
+    assert queue.pop_many(2) == ["a", "b"]
+    assert queue.pop_many(0) == []
+    assert queue.pop_many(5) == ["c"]
+    assert len(queue) == 0
+
+
+def test_push_many_if_new(crawl_db):
+    queue = Queue(crawl_db)
+    queue.push("b")
+    queue.pop()
+    new = queue.push_many_if_new(["a", "b", "c", "a", "d"])
+    # "b" was fetched before, duplicates are dropped
+    assert new == ["a", "c", "d"]
+    assert [url for _, url in positions(queue)] == ["a", "c", "d"]
+    assert queue.push_many_if_new(["c", "e"]) == ["e"]
+    assert queue.push_many_if_new([]) == []
+
+
+def test_requeue_due(crawl_db):
+    queue = Queue(crawl_db)
+    for url in ("a", "b", "c", "d"):
+        queue.push(url)
+    assert queue.pop_many(4) == ["a", "b", "c", "d"]
+    queue.push("d")
+    queue.defer("a", 30.0)
+    queue.defer("b", 10.0)
+    queue.defer("c", 50.0)
+    queue.defer("b", 20.0)
+    # queued anyway
+    queue.defer("d", 5.0)
+    assert queue.next_due() == 5.0
+    assert queue.requeue_due(0.0) == 0
+
+    # in the order they became ready, after the queued URLs
+    assert queue.requeue_due(40.0) == 3
+    assert [url for _, url in positions(queue)] == ["d", "b", "a"]
+    assert queue.next_due() == 50.0
+    assert queue.requeue_due(50.0) == 1
+    assert queue.next_due() is None
+    assert list(queue) == ["d", "b", "a", "c"]
@@ -0,0 +1,186 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+import apsw
+import pytest
+
+import crawl.request
+from crawl.request import MAX_CONTENT_SIZE, Request, Status, looks_binary, session_for
+
+
+class FakeSession:
+    def __init__(self):
+        self.closed = False
+
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    monkeypatch.setattr(crawl.request, "_sessions", crawl.request.OrderedDict())
+    monkeypatch.setattr(crawl.request, "_new_session", lambda pool_size: FakeSession())
+    monkeypatch.setattr(crawl.request, "MAX_SESSIONS", 2)
+    return crawl.request._sessions
+
+
+def test_rare_hosts_have_no_session(sessions):
+    with session_for("https://a.test", 1 / 60) as session:
+        assert session is None
+    with session_for(None, 1.0) as session:
+        assert session is None
+    assert not sessions
+
+
+def test_session_is_shared(sessions):
+    with session_for("https://a.test", 1.0) as first:
+        with session_for("https://a.test", 1.0) as second:
+            assert first is second
+            assert sessions["https://a.test"].users == 2
+    assert sessions["https://a.test"].users == 0
+    assert not first.closed
+
+
+def test_eviction_skips_sessions_in_use(sessions):
+    with session_for("https://a.test", 1.0) as a:
+        with session_for("https://b.test", 1.0) as b:
+            pass
+        with session_for("https://c.test", 1.0):
+            # a.test is the least recently used but still in use
+            assert list(sessions) == ["https://a.test", "https://c.test"]
+            assert b.closed
+            assert not a.closed
+        with session_for("https://d.test", 1.0):
+            # all in use, the pool grows
+            with session_for("https://e.test", 1.0):
+                assert len(sessions) == 3
+        assert not a.closed
+
+
+def test_idle_sessions_are_closed(sessions, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(crawl.request.time, "time", lambda: now)
+    with session_for("https://a.test", 1.0) as a:
+        with session_for("https://b.test", 1.0) as b:
+            pass
+        now += crawl.request.KEEP_ALIVE_TIMEOUT + 1
+        with session_for("https://c.test", 1.0):
+            # a.test has been idle as long, but is in use
+            assert list(sessions) == ["https://a.test", "https://c.test"]
+            assert b.closed
+    assert not a.closed
+
+
+class Handler(BaseHTTPRequestHandler):
+    # chunked responses need HTTP/1.1
+    protocol_version = "HTTP/1.1"
+    etag = '"v1"'
+    body = b"<html><title>page</title></html>"
+
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        match self.path:
+            case "/image":
+                self.send_body("image/png", b"\x89PNG\r\n\x1a\n")
+            case "/disguised":
+                self.send_body("text/html", b"%PDF-1.4\n" + bytes(64))
+            case "/chunked":
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for _ in range(4):
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(self.body), self.body))
+                self.wfile.write(b"0\r\n\r\n")
+            case _:
+                self.send_body("text/html", self.body)
+
+
+    def send_body(self, content_type: str, body: bytes):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    with ThreadingHTTPServer(("127.0.0.1", 0), Handler) as httpd:
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        yield f"http://127.0.0.1:{httpd.server_address[1]}"
+        httpd.shutdown()
+
+
+def test_conditional_request(crawl_db, server):
+    con = apsw.Connection(crawl_db)
+    url = server + "/page"
+    con.execute("INSERT INTO url (url) VALUES (?1)", (url, ))
+
+    first = Request(url)
+    first.load_validators(con)
+    assert first.conditional_headers == {}
+    assert first.make()
+    assert first.status == Status.OK
+    first.save(con)
+
+    second = Request(url)
+    second.load_validators(con)
+    assert second.conditional_headers == {"If-None-Match": '"v1"'}
+    assert not second.make()
+    assert second.status == Status.NOT_MODIFIED
+    assert second.data is None
+
+
+def test_identical_bodies_are_stored_once(crawl_db):
+    con = apsw.Connection(crawl_db)
+    requests = []
+    for url in ("https://a.test/", "https://b.test/"):
+        con.execute("INSERT INTO url (url) VALUES (?1)", (url, ))
+        req = Request(url)
+        req.status = Status.OK
+        req.data = b"<html></html>"
+        req.digest = hashlib.sha256(req.data).digest()
+        req.save(con)
+        requests.append(req)
+    first, second = requests
+    assert not first.known_body
+    assert second.known_body
+    assert first.body_id == second.body_id
+    assert con.execute("SELECT COUNT() FROM body").fetchone() == (1, )
+
+
+@pytest.mark.parametrize("path, max_size, status", [
+    ("/page", len(Handler.body), Status.OK),
+    ("/image", MAX_CONTENT_SIZE, Status.UNSUPPORTED_TYPE),
+    # Content-Length over the limit
+    ("/page", len(Handler.body) - 1, Status.TOO_LARGE),
+    # no Content-Length, the download is aborted
+    ("/chunked", 2 * len(Handler.body), Status.TOO_LARGE),
+    ("/chunked", 4 * len(Handler.body), Status.OK),
+    ("/disguised", MAX_CONTENT_SIZE, Status.BINARY),
+])
+def test_read(server, path, max_size, status):
+    req = Request(server + path)
+    req.max_size = max_size
+    assert req.make() == (status == Status.OK)
+    assert req.status == status
+
+
+def test_looks_binary():
+    assert looks_binary(b"\x1f\x8b\x08\x00")
+    assert looks_binary(b"<html>\x00</html>")
+    assert not looks_binary("<html><title>péage</title></html>".encode())
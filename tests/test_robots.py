@@ -0,0 +1,155 @@
+import time
+
+from conftest import open_host
+import crawl.robots
+from crawl.robots import Host, HostCache, RobotRules, RobotsPrefetcher, can_crawl, read_robots_txt
+
+
+def test_can_crawl_uses_checkpointed_tokens(tmp_path):
+    con = Host.open_db(str(tmp_path / "hosts.db"))
+    # stored by a crawl-next a moment ago
+    open_host("https://a.test", refill_cap=2).store(con)
+
+    assert can_crawl("https://a.test/1", con) == True
+    # the token taken before is checkpointed
+    assert can_crawl("https://a.test/2", con) == True
+    wait = can_crawl("https://a.test/3", con)
+    assert type(wait) == float and 0.0 < wait <= 1.0
+
+
+def test_cache_assumes_empty_bucket_after_restart(tmp_path):
+    con = Host.open_db(str(tmp_path / "hosts.db"))
+    host = open_host("https://a.test", refill_cap=2)
+    host.updated = time.time() - 1
+    host.store(con)
+
+    # a previous run may have taken tokens since
+    restored = HostCache(con).get("https://a.test")
+    assert restored.tokens == 0.0
+    assert HostCache(con, exact=True).get("https://a.test").tokens == 2
+
+
+def test_refreshed_robots_txt_replaces_cached_rules(tmp_path, monkeypatch):
+    con = Host.open_db(str(tmp_path / "hosts.db"))
+    host = open_host("https://a.test")
+    host.fetched -= 60
+    cache = HostCache(con, exact=True)
+    cache.store(host)
+    prefetcher = RobotsPrefetcher(cache, ttl=30)
+    monkeypatch.setattr(
+        crawl.robots,
+        "read_robots_txt",
+        lambda origin, timeout: "User-agent: *\nDisallow: /private\n"
+    )
+
+    # the expired host is used until the new robots.txt is collected
+    assert prefetcher.check("https://a.test") is host
+    while not prefetcher.collect():
+        time.sleep(0.01)
+    prefetcher.close()
+
+    refreshed = cache.get("https://a.test")
+    assert refreshed is not host
+    assert refreshed.try_take_token("https://a.test/private/1") == False
+    # the stored host has the new rules as well
+    assert HostCache(con, exact=True).get("https://a.test").rules.allows("/private") == False
+
+
+class FakeResponse:
+    def __init__(self, body: bytes):
+        self.body = body
+        self.status_code = 200
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        pass
+
+
+    def raise_for_status(self):
+        pass
+
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+class FakeSession:
+    def __init__(self, body: bytes):
+        self.body = body
+
+
+    def get(self, url, **kwargs):
+        return FakeResponse(self.body)
+
+
+def test_truncated_robots_txt_drops_the_last_line(monkeypatch):
+    body = "User-agent: *\nDisallow: /a\nDisallow: /é\n".encode()
+    monkeypatch.setattr(crawl.robots, "robots_session", lambda: FakeSession(body))
+
+    # cut inside the "é"
+    monkeypatch.setattr(crawl.robots, "ROBOTS_MAX_SIZE", len(body) - 2)
+    assert read_robots_txt("https://a.test") == "User-agent: *\nDisallow: /a"
+
+    monkeypatch.setattr(crawl.robots, "ROBOTS_MAX_SIZE", len(body) + 1)
+    assert read_robots_txt("https://a.test") == body.decode()
+
+
+def rules_for(robots_txt: str) -> RobotRules:
+    return RobotRules.parse(robots_txt.replace("\n    ", "\n"))
+
+
+def test_product_token_must_match_exactly():
+    robots_txt = """
+    User-agent: *
+    Disallow: /default
+
+    User-agent: MSE
+    User-agent: crawler
+    User-agent: MSE_Crawler_Pro
+    Disallow: /other
+    """
+    assert rules_for(robots_txt).rules == [("/default", False)]
+    for agent in ("MSE_Crawler", "mse_crawler", "MSE_CRAWLER/2.1", "MSE_Crawler (+https://example.com)"):
+        rules = rules_for(robots_txt + f"\nUser-agent: {agent}\nDisallow: /ours\n")
+        assert rules.rules == [("/ours", False)], agent
+
+
+def test_longest_match_decides():
+    rules = rules_for("""
+    User-agent: *
+    Disallow: /private
+    Allow: /private/public
+    Disallow: /*.pdf$
+    Allow: /same
+    Disallow: /same
+    """)
+    assert rules.global_policy() is None
+    assert rules.allows("/")
+    assert not rules.allows("/private/page")
+    assert rules.allows("/private/public/page")
+    assert not rules.allows("/files/report.pdf")
+    assert rules.allows("/files/report.pdf?page=2")
+    # allow wins ties
+    assert rules.allows("/same")
+
+
+def test_paths_are_normalized():
+    rules = rules_for("""
+    User-agent: *
+    Disallow: /caf%C3%A9
+    Disallow: /a b
+    """)
+    assert not rules.allows("/café/menu")
+    assert not rules.allows("/caf%c3%a9")
+    assert not rules.allows("/a%20b")
+
+
+def test_global_policy():
+    assert rules_for("User-agent: *\nDisallow:\n").global_policy() == True
+    assert rules_for("User-agent: *\nDisallow: /\n").global_policy() == False
+    assert RobotRules.load(rules_for("User-agent: *\nDisallow: /x\n").dump()).rules == [("/x", False)]
@@ -0,0 +1,49 @@
+import apsw
+
+from conftest import create_db
+from crawl.seen import SeenFilter
+
+
+def add_urls(con, urls):
+    con.executemany("INSERT INTO url (url) VALUES (?1)", [(url, ) for url in urls])
+
+
+def test_no_false_negatives():
+    seen = SeenFilter(capacity=1000, error_rate=0.01)
+    urls = [f"https://example.com/{i}" for i in range(1000)]
+    seen.update(urls)
+    assert all(url in seen for url in urls)
+    false_positives = sum(f"https://example.org/{i}" in seen for i in range(1000))
+    assert false_positives < 50
+
+
+def test_load_catches_up(crawl_db):
+    con = apsw.Connection(crawl_db)
+    add_urls(con, ["https://a.com/", "https://b.com/"])
+    path = crawl_db + ".seen"
+    SeenFilter.load(path, con, capacity=1000).save(path, con)
+    add_urls(con, ["https://c.com/"])
+    seen = SeenFilter.load(path, con, capacity=1000)
+    assert seen.max_url_id == 3
+    assert all(url in seen for url in ("https://a.com/", "https://b.com/", "https://c.com/"))
+
+
+def test_load_rejects_other_db(crawl_db, tmp_path):
+    con = apsw.Connection(crawl_db)
+    add_urls(con, [f"https://old.com/{i}" for i in range(3)])
+    path = crawl_db + ".seen"
+    SeenFilter.load(path, con, capacity=1000).save(path, con)
+    con.close()
+
+    # a recreated database reuses the ids for other URLs
+    other = create_db(str(tmp_path / "other.db"), "crawler.sql")
+    add_urls(other, [f"https://new.com/{i}" for i in range(3)])
+    seen = SeenFilter.load(path, other, capacity=1000)
+    assert "https://old.com/0" not in seen
+    assert "https://new.com/0" in seen
+
+    # fewer URLs than the file claims
+    empty = create_db(str(tmp_path / "empty.db"), "crawler.sql")
+    seen = SeenFilter.load(path, empty, capacity=1000)
+    assert seen.max_url_id == 0
+    assert "https://old.com/0" not in seen